@@ -1,14 +1,22 @@
+import threading
+from collections import OrderedDict
 import torch
+from torch.utils.checkpoint import checkpoint
 
 class Contractable:
     """
-    Container for tensors with labeled indices and a global batch size
+    Container for tensors with labeled indices and a batch index
 
     The labels for our indices give some high-level knowledge of the tensor
     layout, and permit the contraction of pairs of indices in a more 
     systematic manner. However, much of the actual heavy lifting is done 
     through specific contraction routines in different subclasses
 
+    The batch size of a Contractable is always read off from its tensor, so
+    that separate contractions (e.g. in different threads) never share any
+    batch size information. Tensors without a batch index can be expanded
+    along a new one by giving an explicit batch_size on initialization
+
     Attributes:
         tensor (Tensor):    A Pytorch tensor whose first index is a batch
                             index. Sub-classes of Contractable may put other 
@@ -16,49 +24,46 @@ class Contractable:
         bond_str (str):     A string whose letters each label a separate mode 
                             of our tensor, and whose length equals the order 
                             (number of modes) of our tensor
-        global_bs (int):    The batch size associated with all Contractables.
-                            This is shared between all Contractable instances 
-                            and allows for automatic expanding of tensors
+        mul_plans (dict):   Cache of contraction plans used by __mul__, which
+                            is shared between all Contractable instances
+        unchecked (bool):   Whether __mul__ skips validation of its outputs
     """
-    # The global batch size
-    global_bs = None
+    # Contraction plans used by __mul__, keyed by (left bond_str, right
+    # bond_str, rmul). Each plan holds an einsum string, the output bond_str,
+    # the output class, and a callable wrapping output tensors in that class
+    mul_plans = {}
+
+    # Setting this to True skips the validation of output contractables in
+    # __mul__, which is only worthwhile once a model is known to be correct
+    unchecked = False
 
-    def __init__(self, tensor, bond_str):
+    def __init__(self, tensor, bond_str, batch_size=None):
         shape = list(tensor.shape)
         num_dim = len(shape)
         str_len = len(bond_str)
 
-        global_bs = Contractable.global_bs
-        batch_dim = tensor.size(0)
-
         # Expand along a new batch dimension if needed
         if ('b' not in bond_str and str_len == num_dim) or \
            ('b' == bond_str[0] and str_len == num_dim + 1):
-            if global_bs is not None:
-                tensor = tensor.unsqueeze(0).expand([global_bs] + shape)
+            if batch_size is not None:
+                tensor = tensor.unsqueeze(0).expand([batch_size] + shape)
             else:
-                raise RuntimeError("No batch size given and no previous "
-                                   "batch size set")
+                raise RuntimeError("Tensor has no batch index and no "
+                                   "batch_size was given")
             if bond_str[0] != 'b':
                 bond_str = 'b' + bond_str
 
         # Check for correct formatting in bond_str
         elif bond_str[0] != 'b' or str_len != num_dim:
-            raise ValueError("Length of bond string '{bond_str}' "
+            raise ValueError(f"Length of bond string '{bond_str}' "
                             f"({len(bond_str)}) must match order of "
                             f"tensor ({len(shape)})")
 
-        # Set the global batch size if it hasn't been set yet
-        elif global_bs is None:
-            Contractable.global_bs = batch_dim
-
-        # Check that global batch size agrees with input tensor's first dim
-        elif global_bs != batch_dim:
-                raise RuntimeError(f"Batch size previously set to {global_bs}"
-                                    ", but input tensor has batch size "
-                                   f"{batch_dim}. Try calling "
-                                    "Contractable.unset_batch_size() first")
-        
+        # Check that any given batch size agrees with input tensor's first dim
+        elif batch_size is not None and batch_size != tensor.size(0):
+            raise RuntimeError(f"batch_size given as {batch_size}, but input "
+                               f"tensor has batch size {tensor.size(0)}")
+
         # Set the defining attributes of our Contractable
         self.tensor = tensor
         self.bond_str = bond_str
@@ -80,64 +85,30 @@ class Contractable:
            type(contractable) is MatRegion:
             return NotImplemented
 
-        tensors = [self.tensor, contractable.tensor]
-        bond_strs = [list(self.bond_str), list(contractable.bond_str)]
-        lowercases = [chr(c) for c in range(ord('a'), ord('z')+1)]
-
-        # Reverse the order of tensors if needed
-        if rmul:
-            tensors = tensors[::-1]
-            bond_strs = bond_strs[::-1]
-
-        # Check that bond strings are in proper format
-        for i, bs in enumerate(bond_strs):
-            assert bs[0] == 'b'
-            assert len(set(bs)) == len(bs)
-            assert all([c in lowercases for c in bs])
-            assert (i == 0 and 'r' in bs) or (i == 1 and 'l' in bs)
-
-        # Get used and free characters
-        used_chars = set(bond_strs[0]).union(bond_strs[1])
-        free_chars = [c for c in lowercases if c not in used_chars]
-
-        # Rename overlapping indices in the bond strings (except 'b', 'l', 'r')
-        specials = ['b', 'l', 'r']
-        for i, c in enumerate(bond_strs[1]):
-            if c in bond_strs[0] and c not in specials:
-                bond_strs[1][i] = free_chars.pop()
-
-        # Combine right bond of left tensor and left bond of right tensor
-        sum_char = free_chars.pop()
-        bond_strs[0][bond_strs[0].index('r')] = sum_char
-        bond_strs[1][bond_strs[1].index('l')] = sum_char
-        specials.append(sum_char)
-
-        # Build bond string of ouput tensor
-        out_str = ['b']
-        for bs in bond_strs:
-            out_str.extend([c for c in bs if c not in specials])
-        out_str.append('l' if 'l' in bond_strs[0] else '')
-        out_str.append('r' if 'r' in bond_strs[1] else '')
-
-        # Build the einsum string for this operation
-        bond_strs = [''.join(bs) for bs in bond_strs]
-        out_str = ''.join(out_str)
-        ein_str = f"{bond_strs[0]},{bond_strs[1]}->{out_str}"
+        # Look up the contraction plan for this pair of bond strings, which
+        # is only built (and checked) the first time the pair is seen
+        plan_key = (self.bond_str, contractable.bond_str, rmul)
+        plan = Contractable.mul_plans.get(plan_key)
+        if plan is None:
+            plan = build_mul_plan(*plan_key)
+            Contractable.mul_plans[plan_key] = plan
+        ein_str, out_str, out_class, wrapper = plan
 
         # Contract along the linear dimension to get an output tensor
-        out_tensor = torch.einsum(ein_str, [tensors[0], tensors[1]])
-
-        # Return our output tensor wrapped in an appropriate class
-        if out_str == 'br':
-            return EdgeVec(out_tensor, is_left_vec=True)
-        elif out_str == 'bl':
-            return EdgeVec(out_tensor, is_left_vec=False)
-        elif out_str == 'blr':
-            return SingleMat(out_tensor)
-        elif out_str == 'bolr':
-            return OutputCore(out_tensor)
+        if rmul:
+            tensors = [contractable.tensor, self.tensor]
         else:
-            return Contractable(out_tensor, out_str)
+            tensors = [self.tensor, contractable.tensor]
+        out_tensor = torch.einsum(ein_str, tensors)
+
+        # Return our output tensor wrapped in an appropriate class, skipping
+        # the usual constructor checks when running in unchecked mode
+        if Contractable.unchecked:
+            output = out_class.__new__(out_class)
+            output.tensor, output.bond_str = out_tensor, out_str
+            return output
+        else:
+            return wrapper(out_tensor)
 
     def __rmul__(self, contractable):
         """
@@ -154,6 +125,82 @@ class Contractable:
         """
         return self
 
+def build_mul_plan(left_str, right_str, rmul=False):
+    """
+    Build the plan used by Contractable.__mul__ for a pair of bond strings
+
+    The default behavior is to contract the 'r' index of left_str with the 'l'
+    index of right_str, matching the batch ('b') index of both and taking the
+    outer product of other indices. If rmul is True, the order of the two
+    bond strings is reversed before contracting
+
+    Returns:
+        ein_str (str):      Einsum string taking the (possibly reversed) pair
+                            of tensors to the output tensor
+        out_str (str):      Bond string of the output tensor
+        out_class (type):   Contractable subclass the output is wrapped in
+        wrapper (function): Takes an output tensor and returns it wrapped as
+                            an instance of out_class
+    """
+    bond_strs = [list(left_str), list(right_str)]
+    lowercases = [chr(c) for c in range(ord('a'), ord('z')+1)]
+
+    # Reverse the order of bond strings if needed
+    if rmul:
+        bond_strs = bond_strs[::-1]
+
+    # Check that bond strings are in proper format
+    for i, bs in enumerate(bond_strs):
+        assert bs[0] == 'b'
+        assert len(set(bs)) == len(bs)
+        assert all([c in lowercases for c in bs])
+        assert (i == 0 and 'r' in bs) or (i == 1 and 'l' in bs)
+
+    # Get used and free characters
+    used_chars = set(bond_strs[0]).union(bond_strs[1])
+    free_chars = [c for c in lowercases if c not in used_chars]
+
+    # Rename overlapping indices in the bond strings (except 'b', 'l', 'r')
+    specials = ['b', 'l', 'r']
+    for i, c in enumerate(bond_strs[1]):
+        if c in bond_strs[0] and c not in specials:
+            bond_strs[1][i] = free_chars.pop()
+
+    # Combine right bond of left tensor and left bond of right tensor
+    sum_char = free_chars.pop()
+    bond_strs[0][bond_strs[0].index('r')] = sum_char
+    bond_strs[1][bond_strs[1].index('l')] = sum_char
+    specials.append(sum_char)
+
+    # Build bond string of ouput tensor
+    out_str = ['b']
+    for bs in bond_strs:
+        out_str.extend([c for c in bs if c not in specials])
+    out_str.append('l' if 'l' in bond_strs[0] else '')
+    out_str.append('r' if 'r' in bond_strs[1] else '')
+
+    # Build the einsum string for this operation
+    bond_strs = [''.join(bs) for bs in bond_strs]
+    out_str = ''.join(out_str)
+    ein_str = f"{bond_strs[0]},{bond_strs[1]}->{out_str}"
+
+    # Choose the class our output tensor gets wrapped in
+    if out_str == 'br':
+        out_class = EdgeVec
+        wrapper = lambda tensor: EdgeVec(tensor, is_left_vec=True)
+    elif out_str == 'bl':
+        out_class = EdgeVec
+        wrapper = lambda tensor: EdgeVec(tensor, is_left_vec=False)
+    elif out_str == 'blr':
+        out_class = wrapper = SingleMat
+    elif out_str == 'bolr':
+        out_class = wrapper = OutputCore
+    else:
+        out_class = Contractable
+        wrapper = lambda tensor: Contractable(tensor, out_str)
+
+    return ein_str, out_str, out_class, wrapper
+
 class ContractableList(Contractable):
     """
     A list of contractables which can all be multiplied together in order
@@ -172,6 +219,13 @@ class ContractableList(Contractable):
 
         self.contractable_list = contractable_list
 
+    # Multiplication orders used by reduce, keyed by the layout of the list.
+    # Layouts change whenever adaptive bond dimensions do, so only the
+    # max_reduce_plans most recently used layouts are kept
+    reduce_plans = OrderedDict()
+    max_reduce_plans = 256
+    plan_lock = threading.Lock()
+
     def __mul__(self, contractable, rmul=False):
         """
         Multiply a contractable by everything in ContractableList in order
@@ -199,42 +253,172 @@ class ContractableList(Contractable):
     def reduce(self, parallel_eval=False):
         """
         Reduce all the contractables in list before multiplying them together
+
+        The order in which contractables get multiplied is chosen by 
+        plan_reduce to minimize the estimated cost of the whole contraction.
+        Plans are cached according to the layout of our list, so planning 
+        only happens the first time a given layout is seen, unless it was
+        evicted by many more recently used layouts
         """
         c_list = self.contractable_list
         # For parallel_eval, reduce all contractables in c_list
         if parallel_eval:
             c_list = [item.reduce() for item in c_list]
 
-        # Multiply together all the contractables. This multiplies in right to 
-        # left order, but certain inefficient contractions are unsupported.
-        # If we encounter an unsupported operation, then try multiplying from
-        # the left end of the list instead
-        while len(c_list) > 1:
-            try:
-                c_list[-2] = c_list[-2] * c_list[-1]
-                del c_list[-1]
-            except TypeError:
-                c_list[1] = c_list[0] * c_list[1]
-                del c_list[0]
+        # Look up the plan for our layout, which ignores the batch size
+        layout = tuple((type(item), item.bond_str, tuple(item.tensor.shape[1:]))
+                       for item in c_list)
+        plans = ContractableList.reduce_plans
+        with ContractableList.plan_lock:
+            plan = plans.get(layout)
+            if plan is not None:
+                plans.move_to_end(layout)
+        if plan is None:
+            plan = plan_reduce(layout)
+            with ContractableList.plan_lock:
+                plans[layout] = plan
+                while len(plans) > ContractableList.max_reduce_plans:
+                    plans.popitem(last=False)
+
+        # Multiply together all the contractables in the planned order
+        def contract(node):
+            if isinstance(node, int):
+                return c_list[node]
+            else:
+                return contract(node[0]) * contract(node[1])
+
+        return contract(plan)
+
+def plan_product(left_desc, right_desc):
+    """
+    Estimate the cost and output of multiplying a pair of contractables
+
+    Both inputs are descriptions of contractables given as tuples (class,
+    bond_str, shape), where shape includes a batch index of size 1. The
+    rules for which products are supported follow those used when the
+    contractables themselves are multiplied
 
-        return c_list[0]
+    Returns:
+        flops (int):        Number of multiply-adds per batch index, or None
+                            if this product isn't supported
+        out_desc (tuple):   Description of the output contractable
+    """
+    l_class, l_str, l_shape = left_desc
+    r_class, r_str, r_shape = right_desc
+
+    # MatRegion instances can only be multiplied with edge vectors
+    if l_class is MatRegion or r_class is MatRegion:
+        if l_class is MatRegion and r_class is EdgeVec and r_str == 'bl':
+            flops = l_shape[1] * l_shape[2] * l_shape[3]
+            return flops, (EdgeVec, 'bl', (1, l_shape[2]))
+        elif r_class is MatRegion and l_class is EdgeVec and l_str == 'br':
+            flops = r_shape[1] * r_shape[2] * r_shape[3]
+            return flops, (EdgeVec, 'br', (1, r_shape[3]))
+        else:
+            return None, None
+
+    # Pairs of edge vectors give a scalar, and scalars aren't planned for
+    if l_class is Scalar or r_class is Scalar:
+        return None, None
+    if l_class is EdgeVec and r_class is EdgeVec:
+        if (l_str, r_str) == ('br', 'bl'):
+            return l_shape[1], (Scalar, 'b', (1,))
+        else:
+            return None, None
+
+    # Everything else is handled by Contractable.__mul__
+    if 'r' not in l_str or 'l' not in r_str:
+        return None, None
+    plan = Contractable.mul_plans.get((l_str, r_str, False))
+    if plan is None:
+        plan = build_mul_plan(l_str, r_str)
+        Contractable.mul_plans[l_str, r_str, False] = plan
+    ein_str, out_str, out_class, _ = plan
+
+    # Read off the dimension of each index from our einsum string
+    in_strs = ein_str.split('->')[0].split(',')
+    dims = dict(zip(in_strs[0], l_shape))
+    dims.update(zip(in_strs[1], r_shape))
+
+    flops = 1
+    for dim in dims.values():
+        flops *= dim
+    out_shape = tuple(dims[c] for c in out_str)
+
+    return flops, (out_class, out_str, out_shape)
+
+def plan_reduce(layout):
+    """
+    Find the cheapest order for multiplying together a list of contractables
+
+    The cost of each order is estimated as the total number of FLOPs, plus the
+    total size of all intermediate tensors, and is minimized by dynamic 
+    programming over all ways of bracketing our list. Products that aren't
+    supported (e.g. a MatRegion with anything besides an edge vector) are 
+    never used, so vector-matrix products are preferred wherever possible
+
+    Args:
+        layout (tuple):     Description of each contractable in our list,
+                            given as a tuple (class, bond_str, shape), where
+                            shape doesn't include the batch index
+
+    Returns:
+        plan:               Nested pairs of list indices giving the order of
+                            multiplication, e.g. ((0, 1), 2) for a list of
+                            length 3 which is multiplied from the left
+    """
+    num_items = len(layout)
+
+    # best[i, j] holds (cost, plan, description) for the items i through j
+    best = {}
+    for i, (item_class, bond_str, shape) in enumerate(layout):
+        best[i, i] = (0, i, (item_class, bond_str, (1,) + tuple(shape)))
+
+    for length in range(2, num_items + 1):
+        for i in range(num_items - length + 1):
+            j = i + length - 1
+            for k in range(i, j):
+                if (i, k) not in best or (k+1, j) not in best:
+                    continue
+                l_cost, l_plan, l_desc = best[i, k]
+                r_cost, r_plan, r_desc = best[k+1, j]
+
+                flops, out_desc = plan_product(l_desc, r_desc)
+                if flops is None:
+                    continue
+
+                out_size = 1
+                for dim in out_desc[2]:
+                    out_size *= dim
+                cost = l_cost + r_cost + flops + out_size
+
+                if (i, j) not in best or cost < best[i, j][0]:
+                    best[i, j] = (cost, (l_plan, r_plan), out_desc)
+
+    if (0, num_items-1) not in best:
+        raise TypeError("No supported order exists for multiplying together "
+                        f"contractables with layout {layout}")
+
+    return best[0, num_items-1][1]
 
 class MatRegion(Contractable):
     """
     A contiguous collection of matrices which are multiplied together
 
     The input tensor defining our MatRegion must have shape 
-    [batch_size, num_mats, D, D], or [num_mats, D, D] when the global batch
-    size is already known
+    [batch_size, num_mats, D, D], or [num_mats, D, D] when batch_size is
+    given explicitly. When num_mats is 1, our matrices can instead have
+    shape [D_l, D_r]
     """
-    def __init__(self, mats):
+    def __init__(self, mats, batch_size=None):
         shape = list(mats.shape)
-        if len(shape) not in [3, 4] or shape[-2] != shape[-1]:
+        if len(shape) not in [3, 4] or (shape[-2] != shape[-1] and
+                                        shape[-3] != 1):
             raise ValueError("MatRegion tensors must have shape "
                              "[batch_size, num_mats, D, D], or [num_mats,"
-                             " D, D] if batch size has already been set")
+                             " D, D] if batch_size is given")
 
-        super().__init__(mats, bond_str='bslr')
+        super().__init__(mats, bond_str='bslr', batch_size=batch_size)
 
     def __mul__(self, edge_vec, rmul=False):
         """
@@ -244,25 +428,11 @@ class MatRegion(Contractable):
         if not isinstance(edge_vec, EdgeVec):
             return NotImplemented
 
-        mats = self.tensor
-        num_mats = mats.size(1)
-        batch_size = mats.size(0)
-
-        # Load our vector and matrix batches
-        dummy_ind = 1 if rmul else 2
-        vec = edge_vec.tensor.unsqueeze(dummy_ind)
-        mat_list = [mat.squeeze(1) for mat in torch.chunk(mats, num_mats, 1)]
-
-        # Do the repeated matrix-vector multiplications in the proper order
-        log_norm = 0
-        for i, mat in enumerate(mat_list[::(1 if rmul else -1)], 1):
-            if rmul:
-                vec = torch.bmm(vec, mat)
-            else:
-                vec = torch.bmm(mat, vec)
+        # Sweep our vector through all of the matrices in the proper order
+        vec = sweep_mats(self.tensor, edge_vec.tensor, from_left=rmul)
 
         # Since we only have a single vector, wrap it as a EdgeVec
-        return EdgeVec(vec.squeeze(dummy_ind), is_left_vec=rmul)
+        return EdgeVec(vec, is_left_vec=rmul)
 
     def __rmul__(self, edge_vec):
         return self.__mul__(edge_vec, rmul=True)
@@ -274,56 +444,442 @@ class MatRegion(Contractable):
         This method uses iterated batch multiplication to evaluate the full 
         matrix product in depth O( log(num_mats) )
         """
-        mats = self.tensor
-        shape = list(mats.shape)
-        batch_size = mats.size(0)
-        size, D = shape[1:3]
-
-        # Iteratively multiply pairs of matrices until there is only one
-        while size > 1:
-            odd_size = (size % 2 == 1)
-            half_size = size // 2
-            nice_size = 2 * half_size
-        
-            even_mats = mats[:, 0:nice_size:2]
-            odd_mats = mats[:, 1:nice_size:2]
-            # For odd sizes, set aside one batch of matrices for the next round
-            leftover = mats[:, nice_size:]
-
-            # Multiply together all pairs of matrices (except leftovers)
-            mats = torch.einsum('bslu,bsur->bslr', [even_mats, odd_mats])
-            mats = torch.cat([mats, leftover], 1)
-
-            size = half_size + int(odd_size)
-
         # Since we only have a single matrix, wrap it as a SingleMat
-        return SingleMat(mats.squeeze(1))
+        return SingleMat(reduce_mats(self.tensor))
+
+def reduce_mats(mats, workspace=None):
+    """
+    Multiply together a batch of matrix chains in depth O( log(num_mats) )
+
+    Args:
+        mats (Tensor):          Matrices with shape [batch_size, num_mats,
+                                D, D]
+        workspace (Workspace):  Arena whose buffers hold the intermediate
+                                products when gradients aren't needed
+
+    Returns:
+        mat (Tensor):           Products of each chain with shape
+                                [batch_size, D, D]
+    """
+    if workspace is not None and not torch.is_grad_enabled():
+        return reduce_mats_inplace(mats, workspace)
+    size = mats.size(1)
+
+    # Iteratively multiply pairs of matrices until there is only one
+    while size > 1:
+        odd_size = (size % 2 == 1)
+        half_size = size // 2
+        nice_size = 2 * half_size
+    
+        even_mats = mats[:, 0:nice_size:2]
+        odd_mats = mats[:, 1:nice_size:2]
+        # For odd sizes, set aside one batch of matrices for the next round
+        leftover = mats[:, nice_size:]
+
+        # Multiply together all pairs of matrices (except leftovers)
+        mats = torch.einsum('bslu,bsur->bslr', [even_mats, odd_mats])
+        mats = torch.cat([mats, leftover], 1)
+
+        size = half_size + int(odd_size)
+
+    return mats.squeeze(1)
+
+def reduce_mats_inplace(mats, workspace):
+    """
+    Version of reduce_mats writing intermediate products to workspace buffers
+
+    The buffers hold each round of products in site-major order, so that the
+    products of each round can be written to a contiguous slice. Only the
+    final product is newly allocated, since it outlives this call
+    """
+    mats = mats.transpose(0, 1)
+    size, batch_size, D_l, D_r = mats.shape
+    if size == 1:
+        return mats[0].clone()
+
+    parity = 0
+    while size > 1:
+        half_size = size // 2
+        nice_size = 2 * half_size
+        new_size = half_size + size % 2
+        if new_size == 1:
+            return torch.matmul(mats[0], mats[1])
+
+        # Multiply together all pairs of matrices, then copy any leftovers.
+        # Successive rounds alternate between a pair of buffers
+        buf = workspace.get(('reduce_mats', parity),
+                            [new_size, batch_size, D_l, D_r],
+                            mats.dtype, mats.device)
+        torch.matmul(mats[0:nice_size:2], mats[1:nice_size:2],
+                     out=buf[:half_size])
+        if nice_size < size:
+            buf[half_size].copy_(mats[nice_size])
+
+        mats, size, parity = buf, new_size, 1 - parity
+
+def sweep_mats(mats, vec=None, from_left=True, log_norm=None,
+               workspace=None):
+    """
+    Multiply a batch of boundary vectors through a batch of matrix chains
+
+    Args:
+        mats (Tensor):      Matrices with shape [batch_size, num_mats, D, D]
+        vec (Tensor):       Boundary vectors with shape [batch_size, D], or
+                            None for the one-hot vectors sitting at the open
+                            edges of an MPS. In the latter case, the first
+                            multiplication just pulls out a row (or column)
+        from_left (bool):   Whether vec sits on the left of our chain and
+                            gets swept rightwards (True), or vice versa
+        log_norm (Tensor):  If given, our vectors are renormalized after each
+                            step, with the log of each norm added to log_norm,
+                            a tensor with shape [batch_size]
+        workspace (Workspace): Arena whose buffers hold our intermediate
+                            vectors when gradients aren't needed. The output
+                            then lives in one of these buffers
+
+    Returns:
+        vec (Tensor):       Output vectors with shape [batch_size, D]. When
+                            log_norm is given, the pair (vec, log_norm) is
+                            returned instead
+    """
+    # Split our matrices in a single op, which keeps the backward pass cheap
+    mat_list = torch.unbind(mats, 1)
+    if len(mat_list) == 0:
+        return vec if log_norm is None else (vec, log_norm)
+    if not from_left:
+        mat_list = mat_list[::-1]
+
+    # Keep a dummy index on our vector so that each step is a single bmm
+    pulled = vec is None
+    if vec is None and from_left:
+        vec, mat_list = mat_list[0][:, 0:1], mat_list[1:]
+    elif vec is None:
+        vec, mat_list = mat_list[0][:, :, 0:1], mat_list[1:]
+    else:
+        vec = vec.unsqueeze(1 if from_left else 2)
+    if log_norm is not None:
+        vec, log_norm = normalize_vecs(vec, log_norm)
+
+    # Without gradients, alternate between writing to a pair of buffers,
+    # starting with whichever one doesn't hold our input vector
+    if workspace is not None and not torch.is_grad_enabled():
+        batch_size, D_l, D_r = mats.size(0), mats.size(2), mats.size(3)
+        shape = [batch_size, 1, D_r] if from_left else [batch_size, D_l, 1]
+        bufs = [workspace.get(('sweep_mats', from_left, parity), shape,
+                              mats.dtype, mats.device) for parity in [0, 1]]
+        if bufs[0].data_ptr() == vec.data_ptr():
+            bufs = bufs[::-1]
+        # Vectors pulled out of mats can't outlive mats, which may itself be
+        # a workspace buffer
+        if pulled:
+            vec = bufs[1].copy_(vec)
+        bufs = bufs * ((len(mat_list) + 1) // 2)
+    else:
+        bufs = [None] * len(mat_list)
+
+    # Do the repeated matrix-vector multiplications in the proper order
+    for mat, buf in zip(mat_list, bufs):
+        if from_left:
+            vec = torch.bmm(vec, mat, out=buf)
+        else:
+            vec = torch.bmm(mat, vec, out=buf)
+        if log_norm is not None:
+            vec, log_norm = normalize_vecs(vec, log_norm)
+
+    vec = vec.squeeze(1 if from_left else 2)
+    return vec if log_norm is None else (vec, log_norm)
+
+def normalize_vecs(vec, log_norm):
+    """
+    Normalize a batch of vectors, adding the log of their norms to log_norm
+
+    Args:
+        vec (Tensor):       Vectors with a leading batch index, and with any
+                            number of other indices
+        log_norm (Tensor):  Running log norms with shape [batch_size]
+
+    Returns:
+        vec (Tensor),
+        log_norm (Tensor):  The normalized vectors and updated log norms
+    """
+    # Reduced precision vectors are normalized in the precision of log_norm
+    batch_size, vec_dtype = vec.size(0), vec.dtype
+    vec = vec.to(log_norm.dtype)
+    norm = vec.reshape([batch_size, -1]).norm(dim=1)
+    norm = norm.clamp(min=torch.finfo(norm.dtype).tiny)
+
+    vec = vec / norm.view([batch_size] + [1] * (len(vec.shape) - 1))
+    return vec.to(vec_dtype), log_norm + torch.log(norm)
+
+def block_mats(mats, block_size):
+    """
+    Multiply together the matrices within consecutive blocks of a chain
+
+    The products for all blocks (and all batch indices) are built in parallel,
+    using block_size-1 rounds of batch multiplication. The last block holds
+    any leftover matrices when block_size doesn't divide the chain length
+
+    Args:
+        mats (Tensor):      Matrices with shape [batch_size, num_mats, D, D]
+        block_size (int):   Number of matrices multiplied within each block
+
+    Returns:
+        mats (Tensor):      Block products with shape [batch_size,
+                            ceil(num_mats / block_size), D, D]
+    """
+    batch_size, num_mats, D_l, D_r = mats.shape
+    num_blocks = num_mats // block_size
+    nice_size = num_blocks * block_size
+    if block_size <= 1 or num_mats <= 1:
+        return mats
+
+    def block_product(blocks):
+        # blocks has shape [batch_size, num_blocks, size, D, D]
+        mat_list = torch.unbind(blocks, 2)
+        prods = mat_list[0]
+        for mat in mat_list[1:]:
+            prods = torch.matmul(prods, mat)
+        return prods
+
+    prod_list = []
+    if num_blocks > 0:
+        blocks = mats[:, :nice_size].reshape([batch_size, num_blocks,
+                                              block_size, D_l, D_r])
+        prod_list.append(block_product(blocks))
+    if nice_size < num_mats:
+        prod_list.append(block_product(mats[:, nice_size:].unsqueeze(1)))
+
+    return torch.cat(prod_list, 1)
+
+def choose_block_size(batch_size, num_mats, D, num_threads=None,
+                      op_cost=1e-5, flop_rate=1e10, matvec_penalty=8):
+    """
+    Use a simple cost model to pick the block size used by block_mats
+
+    Sweeping a vector through a chain of num_mats matrices serially takes
+    num_mats sequential matrix-vector products, each of which only exposes
+    batch_size independent pieces of work. Multiplying blocks of size k
+    first costs k-1 rounds of matrix-matrix products (O(D^3) each, but
+    parallel over all blocks), then num_mats/k sequential matrix-vector
+    products. We estimate the runtime of each option by charging op_cost
+    seconds per op and dividing FLOPs by flop_rate times the number of
+    threads that can be kept busy, with matrix-vector products running
+    matvec_penalty times slower due to being memory bound
+
+    Returns:
+        block_size (int):   The block size with the lowest estimated cost,
+                            where a block size of 1 denotes serial evaluation
+    """
+    if num_threads is None:
+        num_threads = torch.get_num_threads()
+
+    def op_time(flops, num_pieces, penalty=1):
+        busy_threads = max(1, min(num_threads, num_pieces))
+        return op_cost + penalty * flops / (flop_rate * busy_threads)
+
+    best_size, best_time = 1, None
+    block_size = 1
+    while block_size <= max(num_mats, 1):
+        num_blocks = -(-num_mats // block_size)
+        matmul_time = op_time(2 * batch_size * num_blocks * D**3,
+                              batch_size * num_blocks)
+        matvec_time = op_time(2 * batch_size * D**2, batch_size,
+                              penalty=matvec_penalty)
+        total_time = (block_size - 1) * matmul_time + num_blocks * matvec_time
+
+        if best_time is None or total_time < best_time:
+            best_size, best_time = block_size, total_time
+        block_size *= 2
+
+    return best_size
+
+def jump_table(mats):
+    """
+    Multiply together the matrices over all ranges of power-of-two lengths
+
+    Entry [j, s] of our output holds the product of the matrices at sites
+    s, s+1, ..., s+2^j-1, and is built from two entries of the previous row
+    in a single round of batch multiplication. Any product of consecutive
+    matrices can then be written using at most log2(num_mats) entries, so
+    that a long chain of repeated matrices can be skipped over in a handful
+    of steps. Entries whose range would run off the end are left as zeros
+
+    Args:
+        mats (Tensor):  Matrices with shape [num_mats, D, D]
+
+    Returns:
+        table (Tensor): Range products with shape [num_mats.bit_length(),
+                        num_mats, D, D]
+    """
+    num_mats = mats.size(0)
+    table = [mats]
+    size = 1
+    while 2 * size <= num_mats:
+        prev, num_prods = table[-1], num_mats - 2 * size + 1
+        prods = torch.zeros_like(mats)
+        prods[:num_prods] = torch.matmul(prev[:num_prods],
+                                         prev[size:size+num_prods])
+        table.append(prods)
+        size *= 2
+
+    return torch.stack(table)
+
+def jump_schedule(nondefault):
+    """
+    Plan the steps taken by sweeps through chains of mostly default matrices
+
+    Each chain has a default matrix at every site, except for those sites
+    marked in nondefault. Its product is broken into steps which either
+    multiply a single non-default matrix, or jump over a power-of-two range
+    of default matrices using an entry of a jump_table. Each maximal run of
+    g default matrices takes popcount(g) jumps, so a chain with k non-default
+    sites needs O(k log(num_sites)) steps. Chains needing fewer steps than the
+    longest one are padded with identity steps at their end
+
+    Steps are given as indices into the concatenation of a flattened jump
+    table, a single identity matrix, and the non-default matrices in the
+    (row-major) order of nondefault.nonzero()
+
+    Args:
+        nondefault (Tensor):    Boolean tensor with shape [batch_size,
+                                num_sites]
+
+    Returns:
+        schedule (Tensor):      Indices with shape [batch_size, num_steps],
+                                where num_steps is the largest number of
+                                steps needed by any chain
+    """
+    batch_size, num_sites = nondefault.shape
+    num_bits = num_sites.bit_length()
+    device = nondefault.device
+    sites = torch.arange(num_sites, device=device)
+    identity = num_bits * num_sites
+
+    # Find the sites where runs of default sites start, and their lengths
+    next_site = torch.where(nondefault, sites, num_sites).flip(1)
+    next_site = torch.cummin(next_site, 1)[0].flip(1)
+    run_starts = torch.cat([torch.ones_like(nondefault[:, :1]),
+                            nondefault[:, :-1]], 1) & ~nondefault
+    run_batch, run_site = run_starts.nonzero(as_tuple=True)
+    run_lens = next_site[run_batch, run_site] - run_site
+
+    # Each run is skipped using the binary digits of its length, largest
+    # jumps first, while each non-default site takes a single step
+    bits = torch.arange(num_bits - 1, -1, -1, device=device)
+    run_bits = ((run_lens[:, None] >> bits) & 1) == 1
+    site_steps = nondefault.long()
+    site_steps[run_batch, run_site] = run_bits.sum(1)
+    first_steps = torch.cumsum(site_steps, 1) - site_steps
+    num_steps = int((first_steps[:, -1] + site_steps[:, -1]).max())
+
+    schedule = torch.full([batch_size, num_steps], identity, device=device)
+    mat_batch, mat_site = nondefault.nonzero(as_tuple=True)
+    schedule[mat_batch, first_steps[mat_batch, mat_site]] = \
+                    torch.arange(identity + 1, identity + 1 + len(mat_batch),
+                                 device=device)
+
+    run_inds, bit_inds = run_bits.nonzero(as_tuple=True)
+    run_batch, run_site = run_batch[run_inds], run_site[run_inds]
+    jump_bits = bits[bit_inds]
+    jump_ranks = (torch.cumsum(run_bits, 1) - 1)[run_inds, bit_inds]
+    offsets = (run_lens[run_inds] >> (jump_bits + 1)) << (jump_bits + 1)
+    schedule[run_batch, first_steps[run_batch, run_site] + jump_ranks] = \
+                    jump_bits * num_sites + run_site + offsets
+    return schedule
+
+def stream_cores(cores, inputs, vec=None, from_left=True, segment_size=None,
+                 log_norm=None):
+    """
+    Sweep boundary vectors through MPS cores, contracting inputs on the fly
+
+    Each step contracts the boundary vector with a single core before
+    contracting the result with that site's input, so that only tensors of
+    size [batch_size, D, feature_dim] are ever built. When gradients are
+    needed and segment_size is given, the sites are split into segments which
+    are checkpointed, so that only the boundary vectors between segments are
+    stored for the backward pass
+
+    Args:
+        cores (Tensor):     MPS cores with shape [num_sites, D, D, feature_dim]
+        inputs (Tensor):    Input with shape [batch_size, num_sites,
+                                              feature_dim]
+        vec (Tensor):       Boundary vectors with shape [batch_size, D], or
+                            None for the one-hot vectors sitting at the open
+                            edges of an MPS
+        from_left (bool):   Whether vec sits on the left of our cores and gets
+                            swept rightwards (True), or vice versa (False)
+        segment_size (int): Number of sites in each checkpointed segment
+        log_norm (Tensor):  If given, our vectors are renormalized after each
+                            step, with the log of each norm added to log_norm,
+                            a tensor with shape [batch_size]
+
+    Returns:
+        vec (Tensor):       Output vectors with shape [batch_size, D]. When
+                            log_norm is given, the pair (vec, log_norm) is
+                            returned instead
+    """
+    def stream_segment(cores, inputs, vec, log_norm):
+        # Split up cores and inputs in single ops to keep backward pass cheap
+        site_list = list(zip(torch.unbind(cores), torch.unbind(inputs, 1)))
+        if not from_left:
+            site_list = site_list[::-1]
+
+        for core, inp in site_list:
+            if vec is None and from_left:
+                vec = torch.einsum('ri,bi->br', [core[0], inp])
+            elif vec is None:
+                vec = torch.einsum('li,bi->bl', [core[:, 0], inp])
+            elif from_left:
+                vec = torch.einsum('bl,lri->bri', [vec, core])
+                vec = torch.einsum('bri,bi->br', [vec, inp])
+            else:
+                vec = torch.einsum('lri,br->bli', [core, vec])
+                vec = torch.einsum('bli,bi->bl', [vec, inp])
+            if log_norm is not None:
+                vec, log_norm = normalize_vecs(vec, log_norm)
+
+        return vec, log_norm
+
+    num_sites = cores.size(0)
+    if segment_size is None or segment_size >= num_sites or \
+       not torch.is_grad_enabled():
+        vec, log_norm = stream_segment(cores, inputs, vec, log_norm)
+    else:
+        # Stream through each segment in turn, checkpointing along the way
+        starts = list(range(0, num_sites, segment_size))
+        for start in (starts if from_left else starts[::-1]):
+            stop = start + segment_size
+            vec, log_norm = checkpoint(stream_segment, cores[start:stop],
+                                       inputs[:, start:stop], vec, log_norm,
+                                       use_reentrant=False)
+
+    return vec if log_norm is None else (vec, log_norm)
 
 class OutputCore(Contractable):
     """
     A single MPS core with a single output index
     """
-    def __init__(self, tensor):
+    def __init__(self, tensor, batch_size=None):
         # Check the input shape
         if len(tensor.shape) not in [3, 4]:
             raise ValueError("OutputCore tensors must have shape [batch_size, "
                              "output_dim, D_l, D_r], or else [output_dim, D_l,"
-                             " D_r] if batch size has already been set")
+                             " D_r] if batch_size is given")
 
-        super().__init__(tensor, bond_str='bolr')
+        super().__init__(tensor, bond_str='bolr', batch_size=batch_size)
 
 class SingleMat(Contractable):
     """
     A batch of matrices associated with a single location in our MPS
     """
-    def __init__(self, mat):
+    def __init__(self, mat, batch_size=None):
         # Check the input shape
         if len(mat.shape) not in [2, 3]:
             raise ValueError("SingleMat tensors must have shape [batch_size, "
-                             "D_l, D_r], or else [D_l, D_r] if batch size "
-                             "has already been set")
+                             "D_l, D_r], or else [D_l, D_r] if batch_size "
+                             "is given")
 
-        super().__init__(mat, bond_str='blr')
+        super().__init__(mat, bond_str='blr', batch_size=batch_size)
 
 class EdgeVec(Contractable):
     """
@@ -333,16 +889,16 @@ class EdgeVec(Contractable):
     requires the is_left_vec flag to be set to True (vector on left edge) or 
     False (vector on right edge)
     """
-    def __init__(self, vec, is_left_vec):
+    def __init__(self, vec, is_left_vec, batch_size=None):
         # Check the input shape
         if len(vec.shape) not in [1, 2]:
             raise ValueError("EdgeVec tensors must have shape "
-                             "[batch_size, D], or else [D] if batch size "
-                             "has already been set")
+                             "[batch_size, D], or else [D] if batch_size "
+                             "is given")
 
         # EdgeVecs on left edge will have a right-facing bond, and vice versa
         bond_str = 'b' + ('r' if is_left_vec else 'l')
-        super().__init__(vec, bond_str=bond_str)
+        super().__init__(vec, bond_str=bond_str, batch_size=batch_size)
 
     def __mul__(self, right_vec):
         """
@@ -366,7 +922,7 @@ class Scalar(Contractable):
     """
     A batch of scalars
     """
-    def __init__(self, scalar):
+    def __init__(self, scalar, batch_size=None):
         # Add dummy dimension if we have a torch scalar
         shape = list(scalar.shape)
         if shape is []:
@@ -376,10 +932,10 @@ class Scalar(Contractable):
         # Check the input shape
         if len(shape) != 1:
             raise ValueError("input scalar must be a torch tensor with shape "
-                             "[batch_size], or [] or [1] if batch size has "
-                             "been set")
+                             "[batch_size], or [] or [1] if batch_size is "
+                             "given")
 
-        super().__init__(scalar, bond_str='b')
+        super().__init__(scalar, bond_str='b', batch_size=batch_size)
 
     def __mul__(self, contractable):
         """
@@ -0,0 +1,154 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+
+class EmbeddingCache:
+    """
+    Least-recently-used cache of embedded inputs, for repeated epochs of data
+
+    Each input datum, with shape [input_dim], is stored in its embedded form
+    with shape [input_dim, feature_dim], and is looked up by a key given by
+    its index in a dataset, or otherwise by a hash of its contents. Embedded
+    inputs are kept in memory until memory_budget (in bytes) is exceeded,
+    after which the least recently used ones are evicted. When spill_file is
+    given, evicted inputs are moved to a memory-mapped file holding up to
+    spill_size inputs, rather than being discarded
+
+    The cache only makes sense for fixed feature maps, and should be cleared
+    whenever the feature map changes
+    """
+    def __init__(self, memory_budget=None, spill_file=None, spill_size=None):
+        if spill_file is not None and spill_size is None:
+            raise ValueError("spill_size must be given along with spill_file")
+
+        self.memory_budget = memory_budget
+        self.spill_file = spill_file
+        self.spill_size = spill_size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """
+        Remove all embedded inputs from the cache
+        """
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.spill = None
+        self.spill_slots = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def embed(self, input_data, embed_fn, keys=None):
+        """
+        Embed a batch of input, reusing any cached embeddings
+
+        Args:
+            input_data (Tensor):    Input with shape [batch_size, input_dim]
+            embed_fn (function):    Embeds input with shape [num_inputs,
+                                    input_dim] into a tensor with shape
+                                    [num_inputs, input_dim, feature_dim]
+            keys (list):            Keys for each input, such as their indices
+                                    in a dataset. When keys=None, a hash of
+                                    each input's contents is used instead
+
+        Returns:
+            embedded_data (Tensor): Embedded input with shape [batch_size,
+                                    input_dim, feature_dim]
+        """
+        if keys is None:
+            keys = [content_hash(datum) for datum in input_data]
+        elif isinstance(keys, torch.Tensor):
+            keys = keys.tolist()
+        assert len(keys) == input_data.size(0)
+
+        with self.lock:
+            embedded_list = [self.get(key) for key in keys]
+            missing = [i for (i, emb) in enumerate(embedded_list)
+                       if emb is None]
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+
+        # Embed all of our missing inputs together, then add them to the cache
+        if len(missing) > 0:
+            index = torch.tensor(missing, device=input_data.device)
+            new_data = embed_fn(torch.index_select(input_data, 0, index))
+            with self.lock:
+                for i, emb in zip(missing, new_data):
+                    embedded_list[i] = emb
+                    self.put(keys[i], emb)
+
+        embedded_data = torch.stack([emb.to(input_data.device) for emb in
+                                     embedded_list])
+        return embedded_data
+
+    def get(self, key):
+        """
+        Returns the cached embedding for a key, or None if there isn't one
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        # Move spilled embeddings back into memory
+        if key in self.spill_slots:
+            slot = self.spill_slots.pop(key)
+            embedded = torch.from_numpy(np.array(self.spill[slot]))
+            self.free_slots.append(slot)
+            self.put(key, embedded)
+            return embedded
+
+        return None
+
+    def put(self, key, embedded):
+        """
+        Add an embedding to the cache, evicting others if we're over budget
+        """
+        embedded = embedded.detach().cpu().clone()
+        self.entries[key] = embedded
+        self.num_bytes += embedded.numel() * embedded.element_size()
+
+        if self.memory_budget is None:
+            return
+        while self.num_bytes > self.memory_budget and len(self.entries) > 1:
+            old_key, old_embedded = self.entries.popitem(last=False)
+            self.num_bytes -= old_embedded.numel() * old_embedded.element_size()
+            if self.spill_file is not None:
+                self.spill_out(old_key, old_embedded)
+
+    def spill_out(self, key, embedded):
+        """
+        Write an evicted embedding to our spill file
+
+        The spill file is created with the shape of the first embedding it
+        receives, and when full, its least recently used entry is overwritten
+        """
+        if self.spill is None:
+            self.spill = np.memmap(self.spill_file, mode='w+',
+                                   dtype=embedded.numpy().dtype,
+                                   shape=(self.spill_size,) +
+                                         tuple(embedded.shape))
+            self.free_slots = list(range(self.spill_size))[::-1]
+
+        if len(self.free_slots) == 0:
+            _, slot = self.spill_slots.popitem(last=False)
+        else:
+            slot = self.free_slots.pop()
+
+        self.spill[slot] = embedded.numpy()
+        self.spill_slots[key] = slot
+
+    def __len__(self):
+        """
+        Returns the number of embedded inputs held in memory or spilled
+        """
+        return len(self.entries) + len(self.spill_slots)
+
+def content_hash(datum):
+    """
+    Returns a hash of the contents of a single input datum
+    """
+    array = datum.detach().cpu().contiguous().numpy()
+    hasher = hashlib.blake2b(str(array.dtype).encode(), digest_size=16)
+    hasher.update(array.tobytes())
+    return hasher.digest()
@@ -0,0 +1,232 @@
+"""
+Vectorized feature maps for embedding input data into local feature spaces
+
+Each map takes input data with shape [batch_size, input_dim], whose values
+are assumed to lie in the interval [0, 1], and returns embedded data with
+shape [batch_size, input_dim, feature_dim]. The output can optionally be
+written to a preallocated tensor out with this shape, which shouldn't be
+reused while the autograd graph of a previous output is still needed
+
+Custom feature maps given by users are checked and converted into this
+batched form by the functions following the built-in maps
+"""
+
+import math
+from functools import partial
+import torch
+
+def linear_map(input_data, feature_dim=2, out=None):
+    """
+    Embed each input x as the vector [x, 1-x], which requires feature_dim=2
+    """
+    if feature_dim != 2:
+        raise ValueError("linear feature map requires feature_dim = 2, but "
+                        f"feature_dim = {feature_dim}")
+    input_data = float_input(input_data)
+
+    return torch.stack([input_data, 1 - input_data], dim=2, out=out)
+
+def cos_sin_map(input_data, feature_dim=2, out=None):
+    """
+    Embed each input x with the spin-like map of Stoudenmire and Schwab
+
+    The s'th feature (for s = 0, 1, ..., d-1) is given by
+    sqrt(binom(d-1, s)) * cos(pi*x/2)^(d-1-s) * sin(pi*x/2)^s, which gives
+    [cos(pi*x/2), sin(pi*x/2)] for d = 2, and unit vectors for all d
+    """
+    input_data = float_input(input_data)
+    powers = torch.arange(feature_dim, dtype=input_data.dtype,
+                          device=input_data.device)
+    coeffs = torch.tensor([math.sqrt(math.comb(feature_dim - 1, s)) for s in
+                           range(feature_dim)], dtype=input_data.dtype,
+                          device=input_data.device)
+
+    angles = (math.pi / 2) * input_data.unsqueeze(2)
+    cos_part = torch.cos(angles) ** powers.flip(0)
+    sin_part = torch.sin(angles) ** powers
+
+    return torch.mul(coeffs * cos_part, sin_part, out=out)
+
+def poly_map(input_data, feature_dim=2, out=None):
+    """
+    Embed each input x as the vector of monomials [1, x, x^2, ..., x^(d-1)]
+    """
+    input_data = float_input(input_data)
+    powers = torch.arange(feature_dim, dtype=input_data.dtype,
+                          device=input_data.device)
+
+    return torch.pow(input_data.unsqueeze(2), powers, out=out)
+
+def fourier_map(input_data, feature_dim=2, out=None):
+    """
+    Embed each input x as a tower of Fourier modes of increasing frequency
+
+    This gives the vector [1, cos(2*pi*x), sin(2*pi*x), cos(4*pi*x),
+    sin(4*pi*x), ...], truncated to length feature_dim
+    """
+    input_data = float_input(input_data)
+
+    # Each sine is written as a cosine with a phase shift of pi/2
+    inds = torch.arange(feature_dim, device=input_data.device)
+    freqs = (2 * math.pi) * ((inds + 1) // 2).to(input_data.dtype)
+    phases = (math.pi / 2) * (inds % 2 == 0).to(input_data.dtype)
+    phases[0] = 0
+
+    return torch.cos(input_data.unsqueeze(2) * freqs - phases, out=out)
+
+def onehot_map(input_data, feature_dim=2, out=None):
+    """
+    Embed each input x as a one-hot vector giving which of d bins x lies in
+
+    The interval [0, 1] is split into feature_dim bins of equal width, with
+    inputs outside of this interval assigned to the closest bin
+    """
+    input_data = float_input(input_data)
+    bins = torch.floor(input_data * feature_dim).long()
+    bins = bins.clamp(0, feature_dim - 1).unsqueeze(2)
+
+    if out is None:
+        out = torch.zeros(list(input_data.shape) + [feature_dim],
+                          dtype=input_data.dtype, device=input_data.device)
+    else:
+        out.zero_()
+
+    return out.scatter_(2, bins, 1)
+
+def float_input(input_data):
+    """
+    Convert integer-valued input data to the default floating point type
+    """
+    if not input_data.is_floating_point():
+        input_data = input_data.to(torch.get_default_dtype())
+    return input_data
+
+FEATURE_MAPS = {'linear': linear_map, 'cos_sin': cos_sin_map,
+                'poly': poly_map, 'fourier': fourier_map,
+                'onehot': onehot_map}
+
+def get_feature_map(name, feature_dim):
+    """
+    Returns the built-in feature map with a given name and feature dimension
+
+    Args:
+        name (str):             One of 'linear', 'cos_sin', 'poly', 'fourier'
+                                or 'onehot'
+        feature_dim (int):      Dimension of the local feature spaces
+
+    Returns:
+        feature_map (function): Takes input with shape [batch_size,
+                                input_dim] (and optionally an output tensor
+                                out) and returns a tensor with shape
+                                [batch_size, input_dim, feature_dim]
+    """
+    if name not in FEATURE_MAPS:
+        raise ValueError(f"Unknown feature map '{name}', must be one of "
+                         f"{list(FEATURE_MAPS.keys())}")
+    if name == 'linear' and feature_dim != 2:
+        raise ValueError("linear feature map requires feature_dim = 2, but "
+                        f"feature_dim = {feature_dim}")
+
+    return partial(FEATURE_MAPS[name], feature_dim=feature_dim)
+
+def is_batched_map(feature_map, feature_dim):
+    """
+    Check whether a feature map acts on full batches of input data
+
+    Batched feature maps take input with shape [batch_size, input_dim] and
+    return tensors with shape [batch_size, input_dim, feature_dim], which we
+    check using a small batch of probe input
+    """
+    probe = torch.linspace(0, 1, 6).view([2, 3])
+    try:
+        out_shape = feature_map(probe).shape
+    except Exception:
+        return False
+
+    return out_shape == torch.Size([2, 3, feature_dim])
+
+def vectorize_map(feature_map):
+    """
+    Convert a feature map acting on scalars into one acting on full batches
+
+    When possible, the scalar map is vectorized with torch.func.vmap, so that
+    it gets called once per batch. Maps which can't be traced by vmap (e.g.
+    those which build their output with torch.tensor) are instead called
+    separately on each scalar input
+
+    Args:
+        feature_map (function): Takes a single scalar input datum and returns
+                                a vector of size feature_dim
+
+    Returns:
+        batched_map (function): Takes input with shape [batch_size, input_dim]
+                                and returns a tensor with shape [batch_size,
+                                input_dim, feature_dim]
+    """
+    def loop_map(input_data):
+        return torch.stack([torch.stack([feature_map(x) for x in batch])
+                                         for batch in input_data])
+
+    if not hasattr(torch, 'func'):
+        return loop_map
+    vmapped = torch.func.vmap(feature_map)
+
+    def vmap_map(input_data):
+        embedded_data = vmapped(input_data.reshape([-1]))
+        return embedded_data.view(list(input_data.shape) + [-1])
+
+    # Only use the vectorized map if it agrees with the scalar one
+    probe = torch.linspace(0, 1, 6).view([2, 3])
+    try:
+        if torch.allclose(vmap_map(probe), loop_map(probe)):
+            return vmap_map
+    except Exception:
+        pass
+
+    return loop_map
+
+def find_affine_map(batched_map, feature_dim):
+    """
+    Check whether a batched feature map is affine, and if so find its form
+
+    Affine feature maps have the form x -> a + x*c for two fixed vectors a
+    and c, which are found from the outputs at 0 and 1. These are checked
+    against the outputs on two independent sets of irrational probe inputs,
+    so that maps which only agree with an affine map at simple points (such
+    as quantizing maps) aren't mistaken for affine ones. Maps with trainable
+    parameters are never treated as affine
+
+    Args:
+        batched_map (function): Takes input with shape [batch_size,
+                                input_dim] and returns a tensor with shape
+                                [batch_size, input_dim, feature_dim]
+        feature_dim (int):      The size of each embedded input
+
+    Returns:
+        affine_map (tuple):     The pair of vectors (a, c), or None if the
+                                map isn't affine
+    """
+    # Fractional parts of multiples of irrational numbers are spread evenly
+    # over [0, 1), and the second set also covers inputs outside of it
+    steps = torch.arange(1, 17, dtype=torch.float64)
+    probe_sets = [torch.frac(steps * 2 ** .5),
+                  3 * torch.frac(steps * 3 ** .5) - 1]
+    probe = torch.cat([torch.tensor([0., 1.], dtype=torch.float64)] +
+                      probe_sets).float()[None]
+    try:
+        out = batched_map(probe)
+    except Exception:
+        return None
+    if out.shape != torch.Size([1, probe.size(1), feature_dim]) or \
+       out.requires_grad or not out.is_floating_point():
+        return None
+
+    a, c = out[0, 0], out[0, 1] - out[0, 0]
+    affine_out = a + probe[0].unsqueeze(1).to(out.dtype) * c
+    for start in [2, 2 + len(steps)]:
+        probe_slice = slice(start, start + len(steps))
+        if not torch.allclose(out[0, probe_slice], affine_out[probe_slice],
+                              rtol=1e-5, atol=1e-6):
+            return None
+
+    return a.detach().cpu().clone(), c.detach().cpu().clone()
@@ -10,6 +10,7 @@ from torch.utils.data import Dataset, DataLoader
 import torchvision
 from torchvision import transforms, utils
 import random
+import paths
 
 
 class ParseImage:
@@ -37,8 +38,8 @@ class ParseImage:
         """
         image = self.image
         
-        image = torch.transpose(image,0,1)
-        image_vector = image.flatten()
+        path = paths.column_path(*image.shape)
+        image_vector = image.flatten()[path]
         
         return image_vector
         
@@ -50,46 +51,8 @@ class ParseImage:
         """
         image = self.image
         
-        #get dimensions
-        m, n = image.shape
-        
-        #initialize
-        image_vector = torch.zeros(n*m)
-        
-        #begin spiral
-        k = 0
-        l = 0
-        index = 0
-        while (k < m and l < n) : 
-            # add the first row from 
-            # the remaining rows  
-            for i in range(l, n) : 
-                image_vector[index] = image[k,i]
-                index = index + 1
-            k += 1
-            
-            # add the last column from 
-            # the remaining columns  
-            for i in range(k, m) : 
-                image_vector[index] = image[i,(n - 1)]
-                index = index + 1
-            n -= 1
-            
-            # add the last row from 
-            # the remaining rows  
-            if ( k < m) : 
-                for i in range(n - 1, (l - 1), -1) :
-                    image_vector[index] = image[(m - 1),i]
-                    index = index + 1
-                m -= 1
-         
-            # add the first column from 
-            # the remaining columns  
-            if (l < n) : 
-                for i in range(m - 1, k - 1, -1) :
-                    image_vector[index] = image[i,l] 
-                    index = index + 1
-                l += 1
+        path = paths.spiral_path(*image.shape)
+        image_vector = image.flatten()[path]
         
         return image_vector
         
@@ -107,15 +70,10 @@ class ParseImage:
         #initialize
         image_vector = torch.zeros(n*m)
         
-        #begin block
-        i = 0
-        index = 0
-        for row in range(int(m/window_dimension)):
-            j = 0
-            for column in range(int(n/window_dimension)):
-                image_vector[index:(index+window_dimension**2)] = image[i:i+window_dimension,j:j+window_dimension].flatten()
-                j = j+window_dimension
-                index = index + window_dimension**2
-            i = i+window_dimension
+        #only blocks fitting entirely within the image are parsed
+        m_crop = (m // window_dimension) * window_dimension
+        n_crop = (n // window_dimension) * window_dimension
+        path = paths.block_path(m_crop, n_crop, window_dimension)
+        image_vector[:len(path)] = image[:m_crop, :n_crop].flatten()[path]
         
         return image_vector
\ No newline at end of file
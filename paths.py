@@ -0,0 +1,165 @@
+"""
+Vectorized traversal paths through the pixels of a 2D grid
+
+Each path generator takes the height and width of a grid and returns an
+index tensor with shape [height * width], whose t'th entry is the row-major
+(flattened) index of the t'th pixel visited. These can be given directly as
+the path argument of an MPS, or applied to a batch of images with apply_path.
+Paths are built from the coordinates of every pixel at once, without looping
+over pixels
+"""
+
+import torch
+
+def row_path(height, width):
+    """
+    Visit pixels row by row, from left to right
+    """
+    return torch.arange(height * width)
+
+def column_path(height, width):
+    """
+    Visit pixels column by column, from top to bottom
+    """
+    return torch.arange(height * width).view(height, width).t().flatten()
+
+def snake_path(height, width):
+    """
+    Visit pixels row by row, alternating between left to right and right to
+    left, so that consecutive pixels are always neighbors
+    """
+    grid = torch.arange(height * width).view(height, width)
+    grid[1::2] = grid[1::2].flip(1)
+    return grid.flatten()
+
+def spiral_path(height, width):
+    """
+    Visit pixels in a clockwise spiral, starting from the top left corner
+    """
+    rows, cols = grid_coords(height, width)
+
+    # Each pixel lies on a ring, which starts after all of the outer rings
+    ring = torch.min(torch.min(rows, cols),
+                     torch.min(height - 1 - rows, width - 1 - cols))
+    ring_h, ring_w = height - 2 * ring, width - 2 * ring
+    ring_start = height * width - ring_h * ring_w
+
+    # Find the position of each pixel along its ring, going clockwise along
+    # the top, right, bottom, then left edges
+    top, right = rows == ring, cols == width - 1 - ring
+    bottom = rows == height - 1 - ring
+    pos = torch.where(top, cols - ring,
+          torch.where(right, ring_w - 1 + rows - ring,
+          torch.where(bottom, 2 * ring_w + ring_h - 3 - (cols - ring),
+                      2 * ring_w + 2 * ring_h - 4 - (rows - ring))))
+
+    return torch.argsort((ring_start + pos).flatten())
+
+def block_path(height, width, block_size=2):
+    """
+    Visit square blocks of pixels row by row, and the pixels of each block
+    row by row, with any partial blocks at the edges of the grid included
+    """
+    rows, cols = grid_coords(height, width)
+    blocks_per_row = -(-width // block_size)
+
+    block = (rows // block_size) * blocks_per_row + cols // block_size
+    offset = (rows % block_size) * block_size + cols % block_size
+    return torch.argsort((block * block_size ** 2 + offset).flatten())
+
+def hilbert_path(height, width):
+    """
+    Visit pixels along a Hilbert curve, which keeps nearby pixels close
+
+    Grids whose sides aren't equal powers of two are traversed along the
+    Hilbert curve of the smallest enclosing square with such sides, skipping
+    pixels that lie outside of the grid
+    """
+    rows, cols = grid_coords(height, width)
+    size = 1 << max(height - 1, width - 1, 1).bit_length()
+
+    # Find the distance along the curve of each pixel, one bit at a time
+    x, y = cols.flatten(), rows.flatten()
+    dist = torch.zeros_like(x)
+    scale = size // 2
+    while scale > 0:
+        x_bit, y_bit = (x & scale) > 0, (y & scale) > 0
+        dist += scale * scale * ((3 * x_bit.long()) ^ y_bit.long())
+
+        # Rotate our quadrant, so that the curve within it has the standard
+        # orientation
+        flip = ~y_bit & x_bit
+        x = torch.where(flip, size - 1 - x, x)
+        y = torch.where(flip, size - 1 - y, y)
+        x, y = torch.where(y_bit, x, y), torch.where(y_bit, y, x)
+        scale //= 2
+
+    return torch.argsort(dist)
+
+def zorder_path(height, width):
+    """
+    Visit pixels along a Z-order (Morton) curve, which interleaves the bits
+    of the row and column of each pixel
+
+    Grids whose sides aren't equal powers of two skip any pixels of the
+    enclosing curve lying outside of the grid
+    """
+    rows, cols = grid_coords(height, width)
+    num_bits = max(height - 1, width - 1, 1).bit_length()
+
+    code = torch.zeros_like(rows)
+    for bit in range(num_bits):
+        code |= ((rows >> bit) & 1) << (2 * bit + 1)
+        code |= ((cols >> bit) & 1) << (2 * bit)
+    return torch.argsort(code.flatten())
+
+def grid_coords(height, width):
+    """
+    Returns the row and column of each pixel, as tensors of shape [height,
+    width]
+    """
+    return torch.meshgrid(torch.arange(height), torch.arange(width),
+                          indexing='ij')
+
+def apply_path(input_data, path):
+    """
+    Rearrange a batch of images into the order given by a path
+
+    Args:
+        input_data (Tensor):    Images with shape [batch_size, height, width,
+                                ...] or flattened images with shape
+                                [batch_size, height * width, ...]
+        path (Tensor):          Path through the pixels of each image
+
+    Returns:
+        output (Tensor):        Pixels in path order, with shape [batch_size,
+                                len(path), ...]
+    """
+    if input_data.size(1) != len(path):
+        input_data = input_data.flatten(1, 2)
+    return torch.index_select(input_data, 1, path.to(input_data.device))
+
+PATHS = {'row': row_path, 'column': column_path, 'snake': snake_path,
+         'spiral': spiral_path, 'block': block_path, 'hilbert': hilbert_path,
+         'zorder': zorder_path}
+
+def get_path(name, height, width, **kwargs):
+    """
+    Returns the built-in path with a given name through a grid of pixels
+
+    Args:
+        name (str):     One of 'row', 'column', 'snake', 'spiral', 'block',
+                        'hilbert' or 'zorder'
+        height (int):   Number of rows of pixels
+        width (int):    Number of columns of pixels
+        kwargs:         Options for the path, such as block_size for 'block'
+
+    Returns:
+        path (Tensor):  Index tensor with shape [height * width], which can be
+                        given as the path argument of an MPS
+    """
+    if name not in PATHS:
+        raise ValueError(f"Unknown path '{name}', must be one of "
+                         f"{list(PATHS.keys())}")
+
+    return PATHS[name](height, width, **kwargs)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+import io
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS, LinearRegion, module_bonds, pad_module
+
+batch_size = 20
+input_size = 10
+output_dim = 3
+bond_dim = 6
+merge_threshold = 4 * batch_size
+loss_fun = torch.nn.CrossEntropyLoss()
+
+# Training with Adam across many merges keeps bringing our loss down, with
+# the optimizer state of our core store rearranged along with it each merge
+for seed in range(3):
+    torch.manual_seed(seed)
+    input_data = torch.rand([batch_size, input_size])
+    labels = torch.randint(output_dim, [batch_size])
+    mps_module = MPS(input_size, output_dim, bond_dim, adaptive_mode=True,
+                     merge_threshold=merge_threshold, init_std=1e-2)
+    linear_region = mps_module.linear_region
+    optimizer = torch.optim.Adam(mps_module.parameters(), lr=1e-2)
+    mps_module.register_optimizer(optimizer)
+
+    mean_losses, offsets = [], []
+    for period in range(10):
+        losses = []
+        for step in range(merge_threshold // batch_size):
+            loss = loss_fun(mps_module(input_data), labels)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+        mean_losses.append(sum(losses) / len(losses))
+        offsets.append(linear_region.offset)
+
+        # Our optimizer always holds our current core store, with its state
+        # rearranged along with our cores at each merge
+        core_store = linear_region.core_store
+        assert list(mps_module.parameters()) == [core_store]
+        assert optimizer.param_groups[0]['params'] == [core_store]
+        state = optimizer.state[core_store]
+        for key in ['exp_avg', 'exp_avg_sq']:
+            assert state[key].shape == core_store.shape
+            assert torch.any(state[key] != 0)
+        assert torch.all(state['exp_avg_sq'] >= 0)
+
+    assert offsets == [0, 1] * 5
+    assert all(later < earlier for earlier, later in
+               zip(mean_losses, mean_losses[1:]))
+    assert mean_losses[-1] < 0.5 * mean_losses[0]
+
+# Training keeps working across merges where our bonds shrink, and then grow
+# back once we stop truncating, which changes the size of our core store
+torch.manual_seed(0)
+input_data = torch.rand([batch_size, input_size])
+labels = torch.randint(output_dim, [batch_size])
+mps_module = MPS(input_size, output_dim, bond_dim, adaptive_mode=True,
+                 merge_threshold=batch_size, init_std=0.05, cutoff=0.5)
+linear_region = mps_module.linear_region
+optimizer = torch.optim.Adam(mps_module.parameters(), lr=1e-2)
+mps_module.register_optimizer(optimizer)
+
+sizes = []
+for step in range(5):
+    if step == 2:
+        linear_region.cutoff = 1e-10
+    loss = loss_fun(mps_module(input_data), labels)
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+
+    core_store = linear_region.core_store
+    sizes.append(core_store.numel())
+    assert core_store.grad.shape == core_store.shape
+    assert optimizer.param_groups[0]['params'] == [core_store]
+    assert optimizer.state[core_store]['exp_avg'].shape == core_store.shape
+    assert torch.isfinite(loss)
+
+assert sizes[1] < sizes[0]
+assert max(sizes[2:]) > sizes[1]
+
+# Optimizers which weren't registered have our new core store swapped in
+# when they next take a step, with their state for it starting over
+if hasattr(torch.optim.optimizer, 'register_optimizer_step_pre_hook'):
+    torch.manual_seed(0)
+    mps_module = MPS(input_size, output_dim, bond_dim, adaptive_mode=True,
+                     merge_threshold=batch_size, init_std=0.05, cutoff=0.5)
+    linear_region = mps_module.linear_region
+    optimizer = torch.optim.Adam(mps_module.parameters(), lr=1e-2)
+    for step in range(3):
+        loss = loss_fun(mps_module(input_data), labels)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        core_store = linear_region.core_store
+        assert optimizer.param_groups[0]['params'] == [core_store]
+        assert optimizer.state[core_store]['exp_avg'].shape == core_store.shape
+
+# Loading a state dict gives back the same output, whatever offset and bond
+# dimensions the loaded model was in, including after an odd number of merges
+for bc in [False, True]:
+    for async_merge in [False, True]:
+        for num_steps in [3, 7, 10]:
+            torch.manual_seed(0)
+            input_data = torch.rand([batch_size, input_size])
+            labels = torch.randint(output_dim, [batch_size])
+            mps_module = MPS(input_size, output_dim, 2 * bond_dim,
+                             adaptive_mode=True, periodic_bc=bc,
+                             merge_threshold=2 * batch_size, init_std=1e-2,
+                             cutoff=0.1, async_merge=async_merge,
+                             max_staleness=0)
+            optimizer = torch.optim.Adam(mps_module.parameters(), lr=1e-2)
+            mps_module.register_optimizer(optimizer)
+            for step in range(num_steps):
+                loss = loss_fun(mps_module(input_data), labels)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+            # Our cores are stored at their truncated bond dimensions, which
+            # the loaded model has to match
+            with torch.no_grad():
+                output = mps_module(input_data)
+            linear_region = mps_module.linear_region
+            bonds = module_bonds(list(linear_region.module_list))
+            assert any(bond < 2 * bond_dim for bond in bonds[1:-1])
+
+            buffer = io.BytesIO()
+            torch.save(mps_module.state_dict(), buffer)
+            buffer.seek(0)
+            new_mps = MPS(input_size, output_dim, 2 * bond_dim,
+                          adaptive_mode=True, periodic_bc=bc,
+                          merge_threshold=2 * batch_size, cutoff=0.1,
+                          async_merge=async_merge, max_staleness=0)
+            new_mps.load_state_dict(torch.load(buffer))
+
+            new_region = new_mps.linear_region
+            assert new_region.offset == linear_region.offset
+            assert new_region.pending_merge is None
+            assert [m.tensor.shape for m in new_region.module_list] == \
+                   [m.tensor.shape for m in linear_region.module_list]
+            with torch.no_grad():
+                new_output = new_mps(input_data)
+            assert torch.allclose(new_output, output)
+
+# State dicts from before our cores were kept in a single core store hold the
+# padded merged cores of both offsets, and are converted when loaded
+for offset in [0, 1]:
+    torch.manual_seed(0)
+    input_data = torch.rand([batch_size, input_size])
+    mps_module = MPS(input_size, output_dim, bond_dim, adaptive_mode=True,
+                     init_std=1e-2)
+    linear_region = mps_module.linear_region
+    with torch.no_grad():
+        linear_region.bind_views()
+        padded = [pad_module(module, bond_dim) for module in
+                  linear_region.module_list]
+        unmerged_list = linear_region.unmerge_modules(padded)[0]
+        merged_lists = [linear_region.merge_modules(unmerged_list, old_offset)
+                        for old_offset in [0, 1]]
+        old_region = LinearRegion(merged_lists[offset])
+        output = old_region(mps_module.embed_input(input_data))
+
+    state_dict = {key: value for key, value in mps_module.state_dict().items()
+                  if not key.startswith('linear_region.')}
+    for old_offset, merged_list in enumerate(merged_lists):
+        for i, module in enumerate(merged_list):
+            tensor = module.tensor.detach().clone()
+            state_dict[f'linear_region.module_list_{old_offset}.{i}.tensor'] = \
+                tensor
+            if old_offset == offset:
+                state_dict[f'linear_region.module_list.{i}.tensor'] = tensor
+
+    new_mps = MPS(input_size, output_dim, bond_dim, adaptive_mode=True)
+    new_mps.load_state_dict(state_dict)
+    new_region = new_mps.linear_region
+    assert new_region.offset == offset
+    assert new_region.core_store.numel() < \
+           sum([module.tensor.numel() for module in merged_lists[offset]])
+    with torch.no_grad():
+        new_output = new_mps(input_data)
+    assert torch.allclose(new_output, output, rtol=1e-4, atol=1e-6)
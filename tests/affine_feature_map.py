@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS
+
+batch_size = 7
+input_size = 15
+output_dim = 3
+bond_dim = 4
+
+input_data = torch.rand([batch_size, input_size])
+
+# Affine maps are detected for the default map and custom maps, but not for
+# nonlinear ones
+mps_module = MPS(input_size, output_dim, bond_dim)
+assert mps_module.affine_map is not None
+mps_module.register_feature_map('cos_sin')
+assert mps_module.affine_map is None
+mps_module = MPS(input_size, output_dim, bond_dim, feature_dim=3)
+mps_module.register_feature_map(lambda x: torch.stack([x, 1-x, 2*x], dim=2))
+a, c = mps_module.affine_map
+assert torch.equal(a, torch.tensor([0., 1., 0.]))
+assert torch.equal(c, torch.tensor([1., -1., 2.]))
+
+# Piecewise constant maps agree with an affine map at simple points like
+# multiples of 1/4, but aren't affine, so their outputs never take the
+# affine shortcut
+def quantized_map(x):
+    x = torch.round(4 * x) / 4
+    return torch.stack([x, 1-x], dim=2)
+torch.manual_seed(0)
+mps_module = MPS(input_size, output_dim, bond_dim, init_std=0.2,
+                 feature_map=quantized_map)
+assert mps_module.affine_map is None
+output = mps_module(input_data)
+with torch.no_grad():
+    assert torch.allclose(output, mps_module(input_data))
+
+# Without gradients, contracting unembedded input with affine cores should
+# agree with contracting embedded input
+for feature_map in [None, 'poly']:
+    for options in [{}, {'stream_sites': True}, {'parallel_eval': True},
+                    {'periodic_bc': True}, {'adaptive_mode': True},
+                    {'adaptive_mode': True, 'parallel_eval': True}]:
+        for label_site in [None, 0, input_size]:
+            torch.manual_seed(0)
+            mps_module = MPS(input_size, output_dim, bond_dim, init_std=0.2,
+                             label_site=label_site, feature_map=feature_map,
+                             **options)
+            output = mps_module(input_data)
+            with torch.no_grad():
+                affine_output = mps_module(input_data)
+            assert torch.allclose(output, affine_output, rtol=1e-5,
+                                  atol=1e-6)
+
+# Cached affine cores are refreshed after parameter updates
+with torch.no_grad():
+    mps_module(input_data)
+    for param in mps_module.parameters():
+        param.mul_(1.1)
+    new_output = mps_module(input_data)
+assert torch.allclose(new_output, mps_module(input_data), rtol=1e-5, atol=1e-6)
+assert not torch.allclose(new_output, affine_output)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+import copy
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS
+
+torch.manual_seed(0)
+batch_size = 10
+input_size = 17
+output_dim = 3
+bond_dim = 6
+merge_threshold = 2 * batch_size
+
+input_data = torch.rand([batch_size, input_size])
+
+# Without any training, a background merge installed at the next call
+# gives the same cores and bond dimensions as a synchronous one
+for bc in [False, True]:
+    sync_mps = MPS(input_size, output_dim, bond_dim, adaptive_mode=True,
+                   periodic_bc=bc, merge_threshold=merge_threshold,
+                   init_std=0.1)
+    async_mps = copy.deepcopy(sync_mps)
+    async_mps.linear_region.async_merge = True
+    async_mps.linear_region.max_staleness = 0
+
+    for step in range(7):
+        sync_output = sync_mps(input_data)
+        async_output = async_mps(input_data)
+
+        # The synchronous merge happens one call before the async one
+        if step in [2, 4, 6]:
+            assert async_mps.linear_region.pending_merge is not None
+            assert sync_mps.linear_region.offset != \
+                   async_mps.linear_region.offset
+        else:
+            assert sync_mps.linear_region.offset == \
+                   async_mps.linear_region.offset
+            assert torch.allclose(sync_output, async_output, atol=1e-6)
+            assert torch.equal(sync_mps.bond_list, async_mps.bond_list)
+
+    # Models with pending merges can still be copied
+    assert async_mps.linear_region.pending_merge is not None
+    mps_copy = copy.deepcopy(async_mps)
+    assert mps_copy.linear_region.pending_merge is None
+    mps_copy(input_data)
+    assert mps_copy.linear_region.pending_merge is not None
+
+# Training with background merges keeps a single parameter registered
+mps_module = MPS(input_size, output_dim, bond_dim, adaptive_mode=True,
+                 merge_threshold=merge_threshold, async_merge=True,
+                 max_staleness=2)
+num_params = len(list(mps_module.parameters()))
+optimizer = torch.optim.SGD(mps_module.parameters(), lr=1e-3)
+mps_module.register_optimizer(optimizer)
+for _ in range(12):
+    loss = torch.sum(mps_module(input_data) ** 2)
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+    assert len(list(mps_module.parameters())) == num_params
+    assert optimizer.param_groups[0]['params'] == \
+           list(mps_module.parameters())
+    assert mps_module.linear_region.pending_steps <= 2
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MergedInput
+from utils import svd_flex
+
+num_cores = 9
+bond_dim = 5
+feature_dim = 3
+
+# Unmerging all cores at once should match splitting each core separately
+torch.manual_seed(0)
+tensor = torch.randn([num_cores, bond_dim, bond_dim, feature_dim,
+                      feature_dim])
+tensor[0] = torch.einsum('li,rj->lrij', [torch.randn(bond_dim, feature_dim),
+                                         torch.randn(bond_dim, feature_dim)])
+
+for cutoff in [1e-3, 0.5]:
+    (region,), bond_list, sv_list = MergedInput(tensor).unmerge(cutoff)
+    assert len(region) == 2 * num_cores
+    assert bond_list[:3] == [-1, 1, -1]
+
+    for s, merged_core in enumerate(tensor):
+        sv_vec = torch.empty(bond_dim)
+        left_core, right_core, bond = svd_flex(merged_core, 'lrij->lui,urj',
+                                               bond_dim, cutoff, sv_vec=sv_vec)
+        assert bond_list[2*s+1] == bond and bond_list[2*s+2] == -1
+        assert torch.allclose(sv_list[2*s+1], sv_vec, atol=1e-5)
+
+        # Compare products of the split cores, which don't depend on the
+        # choice of signs in each SVD
+        split_core = torch.einsum('lui,urj->lrij', [region.tensor[2*s],
+                                                    region.tensor[2*s+1]])
+        ref_core = torch.einsum('lui,urj->lrij', [left_core, right_core])
+        assert torch.allclose(split_core, ref_core, atol=1e-5)
+
+# Too large of a cutoff is an error, as with svd_flex
+try:
+    MergedInput(tensor).unmerge(cutoff=1e10)
+    assert False
+except RuntimeError:
+    pass
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+import math
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS
+from feature_maps import get_feature_map, FEATURE_MAPS
+
+batch_size = 6
+input_size = 10
+output_dim = 3
+bond_dim = 4
+
+input_data = torch.rand([batch_size, input_size])
+
+# The built-in linear map should agree with our default embedding
+torch.manual_seed(0)
+mps_module = MPS(input_size, output_dim, bond_dim)
+default_output = mps_module(input_data)
+mps_module.register_feature_map('linear')
+assert torch.all(default_output == mps_module(input_data))
+
+# The cos/sin map should agree with an equivalent custom feature map
+def cos_sin2(inp):
+    return torch.stack([torch.cos(math.pi * inp / 2),
+                        torch.sin(math.pi * inp / 2)])
+mps_module.register_feature_map(cos_sin2)
+custom_output = mps_module(input_data)
+mps_module.register_feature_map('cos_sin')
+assert torch.allclose(custom_output, mps_module(input_data))
+
+# Check each map for several feature dimensions, including output buffers
+for name in FEATURE_MAPS:
+    for feature_dim in ([2] if name == 'linear' else [2, 3, 8]):
+        feature_map = get_feature_map(name, feature_dim)
+        embedded_data = feature_map(input_data)
+        assert embedded_data.shape == torch.Size([batch_size, input_size,
+                                                  feature_dim])
+
+        out = torch.empty([batch_size, input_size, feature_dim])
+        assert feature_map(input_data, out=out) is out
+        assert torch.allclose(embedded_data, out)
+
+        mps_module = MPS(input_size, output_dim, bond_dim,
+                         feature_dim=feature_dim, feature_map=name)
+        output = mps_module(input_data)
+        assert output.shape == torch.Size([batch_size, output_dim])
+
+# Spin-like cos/sin embeddings are unit vectors, and one-hot embeddings pick
+# out a single bin for each input
+norms = get_feature_map('cos_sin', 5)(input_data).norm(dim=2)
+assert torch.allclose(norms, torch.ones_like(norms))
+onehot_data = get_feature_map('onehot', 4)(torch.tensor([[0., .3, .99, 1.]]))
+assert torch.all(onehot_data.argmax(dim=2) == torch.tensor([[0, 1, 3, 3]]))
+assert torch.all(onehot_data.sum(dim=2) == 1)
+
+# The linear map requires feature_dim = 2
+try:
+    MPS(input_size, output_dim, bond_dim, feature_dim=3, feature_map='linear')
+    assert False
+except ValueError:
+    pass
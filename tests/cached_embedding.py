@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS
+from embedding_cache import EmbeddingCache
+
+batch_size = 6
+input_size = 10
+output_dim = 3
+bond_dim = 4
+feature_dim = 3
+
+dataset = torch.rand([4 * batch_size, input_size])
+batches = torch.split(torch.arange(len(dataset)), batch_size)
+
+# Count the number of inputs which actually get embedded
+num_embedded = [0]
+def feature_map(inp):
+    num_embedded[0] += inp.size(0)
+    return torch.stack([inp, 1-inp, 2-inp], dim=2)
+
+torch.manual_seed(0)
+mps_module = MPS(input_size, output_dim, bond_dim, feature_dim=feature_dim)
+mps_module.register_feature_map(feature_map)
+ref_outputs = [mps_module(dataset[inds]) for inds in batches]
+
+# Each input is embedded once over several epochs, whether it's looked up by
+# index or by content, and whether or not it gets spilled to a file
+datum_bytes = 4 * input_size * feature_dim
+with tempfile.TemporaryDirectory() as tmp_dir:
+    for use_keys, memory_budget, spill_size in [(True, None, None),
+                                                (False, None, None),
+                                                (True, 5 * datum_bytes, 30)]:
+        spill_file = None if spill_size is None else \
+                     os.path.join(tmp_dir, 'spill.dat')
+        cache = EmbeddingCache(memory_budget=memory_budget,
+                               spill_file=spill_file, spill_size=spill_size)
+        mps_module.set_embedding_cache(cache)
+
+        num_embedded[0] = 0
+        for epoch in range(3):
+            for inds, ref_output in zip(batches, ref_outputs):
+                keys = inds if use_keys else None
+                output = mps_module(dataset[inds], keys=keys)
+                assert torch.allclose(output, ref_output)
+
+        assert num_embedded[0] == len(dataset)
+        assert len(cache) == len(dataset)
+        assert cache.hits == 2 * len(dataset)
+        if memory_budget is not None:
+            assert cache.num_bytes <= memory_budget
+
+# Without a spill file, evicted inputs need to be embedded again
+cache = EmbeddingCache(memory_budget=5 * datum_bytes)
+mps_module.set_embedding_cache(cache)
+num_embedded[0] = 0
+for epoch in range(2):
+    for inds in batches:
+        mps_module(dataset[inds], keys=inds)
+assert num_embedded[0] == 2 * len(dataset)
+assert len(cache) == 5
+
+# Registering a new feature map clears the cache
+mps_module.register_feature_map(feature_map)
+assert len(cache) == 0
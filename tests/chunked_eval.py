@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS
+
+batch_size = 23
+input_size = 21
+output_dim = 4
+bond_dim = 5
+
+torch.manual_seed(0)
+input_data = torch.rand([batch_size, input_size])
+
+# Check that splitting our batch into chunks doesn't change the output or 
+# the gradients of our parameters, for all contraction strategies
+for bc, pe in [(False, False), (False, True), (True, False)]:
+    torch.manual_seed(0)
+    mps_module = MPS(input_size, output_dim, bond_dim, periodic_bc=bc,
+                     parallel_eval=pe, init_std=0.1)
+    output = mps_module(input_data)
+    output.sum().backward()
+    grads = [p.grad.clone() for p in mps_module.parameters()]
+
+    for chunk_size, memory_budget in [(5, None), (None, 20000)]:
+        mps_module.zero_grad()
+        mps_module.linear_region.chunk_size = chunk_size
+        mps_module.linear_region.memory_budget = memory_budget
+        assert mps_module.linear_region.get_chunk_size() < batch_size
+
+        chunk_output = mps_module(input_data)
+        chunk_output.sum().backward()
+        chunk_grads = [p.grad for p in mps_module.parameters()]
+
+        assert torch.allclose(output, chunk_output)
+        for grad, chunk_grad in zip(grads, chunk_grads):
+            assert torch.allclose(grad, chunk_grad, rtol=1e-4, atol=1e-4)
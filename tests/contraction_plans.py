@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+import contractables
+from contractables import Contractable, SingleMat
+from torchmps import MPS
+
+batch_size = 9
+input_size = 12
+output_dim = 3
+bond_dim = 4
+
+input_data = torch.rand([batch_size, input_size])
+
+def module_contractables(mps_module, input_data):
+    """
+    Returns the reduced contractables given by each module of an MPS
+    """
+    linear_region = mps_module.linear_region
+    input_data = mps_module.embed_input(input_data)
+    if mps_module.adaptive_mode:
+        linear_region.bind_views()
+    return [module(mod_input).reduce() for (module, mod_input) in
+            zip(linear_region.module_list,
+                linear_region.split_input(input_data))]
+
+def adjacent_products(items):
+    """
+    Returns the products of each pair of neighboring contractables
+    """
+    return [left * right for (left, right) in zip(items[:-1], items[1:])]
+
+# Count how many contraction plans get built for Contractable.__mul__
+num_built = [0]
+build_mul_plan = contractables.build_mul_plan
+def counting_build(*args):
+    num_built[0] += 1
+    return build_mul_plan(*args)
+contractables.build_mul_plan = counting_build
+
+for periodic_bc, adaptive_mode in [(False, False), (True, False),
+                                   (False, True)]:
+    mps_module = MPS(input_size, output_dim, bond_dim, init_std=0.1,
+                     periodic_bc=periodic_bc, adaptive_mode=adaptive_mode,
+                     parallel_eval=True)
+    mps_module.linear_region.merge_threshold = float('inf')
+    items = module_contractables(mps_module, input_data)
+
+    # Plans are built the first time a pair of bond strings is multiplied,
+    # then reused for later products with the same bond strings
+    Contractable.mul_plans.clear()
+    num_built[0] = 0
+    checked_output = mps_module(input_data)
+    products = adjacent_products(items)
+    assert num_built[0] == len(Contractable.mul_plans) > 0
+    plans = dict(Contractable.mul_plans)
+    mps_module(input_data)
+    adjacent_products(items)
+    assert num_built[0] == len(plans)
+    assert all(Contractable.mul_plans[key] is plans[key] for key in plans)
+
+    # Unchecked mode gives the same tensors and classes as checked mode
+    Contractable.unchecked = True
+    unchecked_output = mps_module(input_data)
+    unchecked_products = adjacent_products(items)
+    Contractable.unchecked = False
+
+    assert torch.equal(checked_output, unchecked_output)
+    assert len(products) == len(unchecked_products) > 0
+    for product, unchecked_product in zip(products, unchecked_products):
+        assert type(product) is type(unchecked_product)
+        assert product.bond_str == unchecked_product.bond_str
+        assert torch.equal(product.tensor, unchecked_product.tensor)
+
+contractables.build_mul_plan = build_mul_plan
+
+# A plan whose output doesn't fit its class is only caught in checked mode
+left = Contractable(torch.randn([batch_size, 2, 3]), 'bxr')
+right = Contractable(torch.randn([batch_size, 3, 4]), 'bly')
+Contractable.mul_plans['bxr', 'bly', False] = ('bxz,bzy->bxzy', 'bxzy',
+                                               SingleMat, SingleMat)
+for unchecked in [False, True, False]:
+    Contractable.unchecked = unchecked
+    try:
+        left * right
+        raised = False
+    except ValueError:
+        raised = True
+    assert raised != unchecked
+Contractable.unchecked = False
+del Contractable.mul_plans['bxr', 'bly', False]
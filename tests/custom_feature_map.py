@@ -14,6 +14,12 @@ def feature_map2(inp):
 def feature_map3(inp):
     return torch.tensor([inp, 1-inp, 2-inp])
 
+# Equivalent maps which can be vectorized, or which act on full batches
+def vector_map2(inp):
+    return torch.stack([inp, 1-inp])
+def batch_map2(inp):
+    return torch.stack([inp, 1-inp], dim=2)
+
 my_mps2 = MPS(10, 5, 2, feature_dim=2)
 default_output2 = my_mps2(std_input)
 
@@ -24,6 +30,13 @@ custom_output2 = my_mps2(std_input)
 # equivalent to that map, which should be identical
 assert torch.all(default_output2 == custom_output2)
 
+# The same should hold for vectorized and batched versions of that map
+for f_map, batched in [(vector_map2, None), (batch_map2, None),
+                       (batch_map2, True)]:
+    my_mps2.register_feature_map(f_map, batched=batched)
+    assert torch.all(default_output2 == my_mps2(std_input))
+my_mps2.register_feature_map(feature_map2)
+
 # Make sure we don't get any errors when using a feature map with higher
 # feature dim
 my_mps3 = MPS(10, 5, 2, feature_dim=3)
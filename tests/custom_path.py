@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS
+
+batch_size = 5
+input_size = 12
+output_dim = 3
+bond_dim = 4
+
+# Our path visits every other site of a larger input in a random order
+full_data = torch.rand([batch_size, 2 * input_size])
+path = (2 * torch.randperm(input_size)).tolist()
+path_data = torch.stack([full_data[:, site] for site in path], dim=1)
+
+torch.manual_seed(0)
+ref_mps = MPS(input_size, output_dim, bond_dim)
+ref_output = ref_mps(path_data)
+
+# Paths given as lists or tensors should both gather the same input
+for my_path in [path, torch.tensor(path)]:
+    torch.manual_seed(0)
+    mps_module = MPS(input_size, output_dim, bond_dim, path=my_path)
+    assert torch.all(mps_module(full_data) == ref_output)
+
+    # Pre-embedded input gets rearranged in the same way
+    embedded_data = torch.stack([full_data, 1 - full_data], dim=2)
+    assert torch.all(mps_module(embedded_data) == ref_output)
+
+# The path index isn't saved in our state dict
+assert len(mps_module.state_dict()) == len(ref_mps.state_dict())
@@ -14,10 +14,11 @@ merge_threshold = 3 * batch_size
 input_data = torch.randn([batch_size, input_size])
 
 # For both open and periodic boundary conditions, place the label site in 
-# different locations and check that the basic behavior is correct
+# different locations and check that the basic behavior is correct. The cores
+# of the current merge state are held in a single parameter
 for bc in [False, True]:
-    for num_params, label_site in [(8, None), (5, 0), (6, 1), 
-                                   (5, input_size), (6, input_size-1)]:
+    for num_params, label_site in [(1, None), (1, 0), (1, 1), 
+                                   (1, input_size), (1, input_size-1)]:
         mps_module = MPS(input_size, output_dim, bond_dim, periodic_bc=bc, 
                          label_site=label_site, adaptive_mode=True, 
                          merge_threshold=merge_threshold)
@@ -16,6 +16,37 @@ mats = torch.randn([batch_size, size, D, D])
 mat_region = MatRegion(mats)
 assert list(mat_region.reduce().tensor.shape) == [batch_size, D, D]
 
+# Check that ContractableList.reduce() plans contractions which sweep edge 
+# vectors inwards, instead of multiplying matrices together
+output_dim = 5
+layout = ((EdgeVec, 'br', (D,)), (MatRegion, 'bslr', (size, D, D)), 
+          (OutputCore, 'bolr', (output_dim, D, D)), (SingleMat, 'blr', (D, D)), 
+          (EdgeVec, 'bl', (D,)))
+assert plan_reduce(layout) == ((0, 1), (2, (3, 4)))
+
+edge_vecs = [EdgeVec(torch.randn([batch_size, D]), is_left_vec=True), 
+             EdgeVec(torch.randn([batch_size, D]), is_left_vec=False)]
+contractables = [edge_vecs[0], mat_region, 
+                 OutputCore(torch.randn([output_dim, D, D]), batch_size), 
+                 SingleMat(torch.randn([batch_size, D, D])), edge_vecs[1]]
+output = ContractableList(contractables).reduce()
+assert list(output.tensor.shape) == [batch_size, output_dim]
+
+# Check that only the most recently used reduction plans are kept, so that
+# many different layouts (e.g. from changing bond dimensions) are bounded
+max_plans = ContractableList.max_reduce_plans
+ContractableList.max_reduce_plans = 3
+ContractableList.reduce_plans.clear()
+for bond_dim in range(1, 6):
+    vecs = [EdgeVec(torch.randn([batch_size, bond_dim]), is_left_vec=True),
+            EdgeVec(torch.randn([batch_size, bond_dim]), is_left_vec=False)]
+    mat = SingleMat(torch.randn([batch_size, bond_dim, bond_dim]))
+    ContractableList([vecs[0], mat, vecs[1]]).reduce()
+assert len(ContractableList.reduce_plans) == 3
+assert [layout[0][2] for layout in ContractableList.reduce_plans] == \
+       [(3,), (4,), (5,)]
+ContractableList.max_reduce_plans = max_plans
+
 # Check that PeriodicBC.reduce() works and gives basically the same
 # answer for left-to-right and right-to-left evaluation
 #periodic_bc = PeriodicBC([mat_region]).reduce()
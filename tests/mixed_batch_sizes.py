@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+import torch
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS
+
+input_size = 21
+output_dim = 4
+bond_dim = 5
+
+# Build models using all of our contraction strategies, and inputs with 
+# several different batch sizes
+mps_modules = [MPS(input_size, output_dim, bond_dim, periodic_bc=bc, 
+                   parallel_eval=pe) for bc in [False, True] 
+                                     for pe in [False, True]]
+input_list = [torch.rand([batch_size, input_size]) for batch_size in 
+              [1, 7, 11, 16]]
+
+# Check that models can be called on different batch sizes back to back
+expected = {}
+for i, mps_module in enumerate(mps_modules):
+    for j, input_data in enumerate(input_list):
+        output = mps_module(input_data)
+        assert list(output.shape) == [input_data.size(0), output_dim]
+        expected[i, j] = output
+
+# Check that concurrent calls in separate threads give the same outputs
+def evaluate(job):
+    i, j = job
+    return job, mps_modules[i](input_list[j])
+
+jobs = 10 * list(expected.keys())
+with torch.no_grad(), ThreadPoolExecutor(max_workers=8) as executor:
+    for job, output in executor.map(evaluate, jobs):
+        assert torch.allclose(output, expected[job])
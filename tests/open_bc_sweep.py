@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS
+
+batch_size = 11
+input_size = 21
+output_dim = 4
+bond_dim = 5
+
+input_data = torch.rand([batch_size, input_size])
+
+# Check that sweeping in from the open edges gives the same output as the 
+# parallel contraction of all our cores, for different label site locations
+for adaptive_mode, label_sites in [(False, [None, 0, input_size]), 
+                                   (True, [None, 0, 1, input_size])]:
+    for label_site in label_sites:
+        mps_module = MPS(input_size, output_dim, bond_dim, init_std=0.1,
+                         label_site=label_site, adaptive_mode=adaptive_mode)
+
+        serial_output = mps_module(input_data)
+        for block_size in [2, 3, 'auto']:
+            mps_module.linear_region.block_size = block_size
+            block_output = mps_module(input_data)
+            assert torch.allclose(serial_output, block_output, rtol=1e-4, 
+                                  atol=1e-6)
+
+        mps_module.linear_region.block_size = None
+        mps_module.linear_region.parallel_eval = True
+        parallel_output = mps_module(input_data)
+
+        assert list(serial_output.shape) == [batch_size, output_dim]
+        assert torch.allclose(serial_output, parallel_output, rtol=1e-4, 
+                              atol=1e-6)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS
+from contractables import ContractableList
+
+batch_size = 8
+input_size = 17
+output_dim = 3
+bond_dim = 5
+
+input_data = torch.rand([batch_size, input_size])
+
+# Check that tracing the output core against a single environment matrix
+# agrees with reducing the full list of contractables and then tracing it
+for adaptive_mode in [False, True]:
+    for label_site in [None, 0, input_size]:
+        torch.manual_seed(0)
+        mps_module = MPS(input_size, output_dim, bond_dim, init_std=0.2,
+                         periodic_bc=True, label_site=label_site,
+                         adaptive_mode=adaptive_mode)
+        output = mps_module(input_data)
+        assert output.shape == torch.Size([batch_size, output_dim])
+
+        linear_region = mps_module.linear_region
+        embedded_data = mps_module.embed_input(input_data)
+        contractable_list = [module(mod_input) for (module, mod_input) in
+                             zip(linear_region.module_list,
+                                 linear_region.split_input(embedded_data))]
+        contractable = ContractableList(contractable_list).reduce(True)
+        assert contractable.bond_str == 'bolr'
+        ref_output = torch.einsum('boll->bo', [contractable.tensor])
+
+        assert torch.allclose(output, ref_output, rtol=1e-4, atol=1e-6)
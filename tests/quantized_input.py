@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS
+
+batch_size = 11
+input_size = 15
+output_dim = 3
+bond_dim = 4
+
+# Quantized input is given as integer levels, which should give the same
+# output and gradients as the embedded value of each level
+for input_levels, feature_map, feature_dim in [(8, None, 2),
+                                               ([0., 0.3, 1.], 'poly', 3),
+                                               ('categorical', None, 4)]:
+    for options in [{}, {'stream_sites': True}, {'parallel_eval': True},
+                    {'periodic_bc': True}, {'adaptive_mode': True},
+                    {'compute_dtype': torch.float64}]:
+        for label_site in [None, 0, input_size]:
+            torch.manual_seed(0)
+            mps_module = MPS(input_size, output_dim, bond_dim,
+                             feature_dim=feature_dim, init_std=0.2,
+                             label_site=label_site, feature_map=feature_map,
+                             input_levels=input_levels, **options)
+            levels = mps_module.level_embeddings
+            input_data = torch.randint(len(levels), [batch_size, input_size],
+                                       dtype=torch.uint8)
+            embedded_data = levels[input_data.long()]
+
+            params = list(mps_module.parameters())
+            output = mps_module(input_data)
+            grads = torch.autograd.grad(output.sum(), params,
+                                        allow_unused=True)
+            embedded_output = mps_module(embedded_data)
+            embedded_grads = torch.autograd.grad(embedded_output.sum(),
+                                                 params, allow_unused=True)
+
+            assert torch.allclose(output, embedded_output, rtol=1e-5,
+                                  atol=1e-6)
+            for grad, embedded_grad in zip(grads, embedded_grads):
+                assert (grad is None) == (embedded_grad is None)
+                if grad is not None:
+                    assert torch.allclose(grad, embedded_grad, rtol=1e-4,
+                                          atol=1e-6)
+
+            with torch.no_grad():
+                lookup_output = mps_module(input_data)
+            assert torch.allclose(lookup_output, embedded_output, rtol=1e-5,
+                                  atol=1e-6)
+
+# Integer levels are embedded as evenly spaced values in [0, 1]
+mps_module = MPS(input_size, output_dim, bond_dim, input_levels=5)
+assert torch.allclose(mps_module.level_embeddings[:, 0],
+                      torch.linspace(0, 1, 5))
+
+# Cached lookup tables are refreshed after parameter updates, and level
+# embeddings follow changes of feature map
+input_data = torch.randint(5, [batch_size, input_size])
+with torch.no_grad():
+    old_output = mps_module(input_data)
+    for param in mps_module.parameters():
+        param.mul_(1.1)
+    new_output = mps_module(input_data)
+    assert not torch.allclose(old_output, new_output)
+    mps_module.register_feature_map('cos_sin')
+    assert torch.allclose(mps_module(input_data),
+                          mps_module(mps_module.level_embeddings[input_data]))
+
+# Without input levels, integer input is embedded like any other input
+mps_module.set_input_levels(None)
+assert mps_module.level_embeddings is None
+mps_module(input_data)
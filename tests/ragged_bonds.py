@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS, LinearRegion, pad_module, cut_modules, \
+                     module_bonds, module_like
+
+torch.manual_seed(0)
+batch_size = 20
+input_size = 30
+output_dim = 4
+bond_dim = 16
+
+input_data = torch.rand([batch_size, input_size])
+
+# After truncating SVDs shrink our bonds, our cores are stored at the trimmed
+# bond dimensions, but give the same output and gradients as padded cores
+for bc in [False, True]:
+    for parallel_eval in [False, True]:
+        mps_module = MPS(input_size, output_dim, bond_dim, adaptive_mode=True,
+                         periodic_bc=bc, parallel_eval=parallel_eval,
+                         merge_threshold=batch_size, cutoff=1e-1,
+                         init_std=0.05)
+        optimizer = torch.optim.Adam(mps_module.parameters(), lr=1e-3)
+        mps_module.register_optimizer(optimizer)
+        for _ in range(4):
+            loss = torch.sum(mps_module(input_data) ** 2)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+        linear_region = mps_module.linear_region
+        linear_region.merge_threshold = float('inf')
+        linear_region.bind_views()
+        modules = list(linear_region.module_list)
+        bonds = module_bonds(modules)
+        assert max(bonds) <= bond_dim
+        assert min(bonds) < bond_dim
+
+        # Our core store only holds the trimmed cores
+        with torch.no_grad():
+            padded = [pad_module(module, bond_dim) for module in modules]
+        padded_size = sum([module.tensor.numel() for module in padded])
+        assert linear_region.core_store.numel() < padded_size
+        assert linear_region.core_store.numel() == \
+               sum([module.tensor.numel() for module in modules])
+
+        # Multi-site modules only hold cores of a single shape
+        for module in modules:
+            shape = module.tensor.shape
+            assert len(shape) < 5 or shape[0] == 1 or shape[1] == shape[2]
+
+        params = [linear_region.core_store]
+        output = mps_module(input_data)
+        grads = torch.autograd.grad(torch.sum(output ** 2), params)
+
+        padded_region = LinearRegion(padded, periodic_bc=bc,
+                                     parallel_eval=parallel_eval)
+        padded_params = [module.tensor for module in padded]
+        full_output = padded_region(mps_module.embed_input(input_data))
+        full_grads = torch.autograd.grad(torch.sum(full_output ** 2),
+                                         padded_params)
+        grad_modules = [module_like(module, grad) for module, grad in
+                        zip(padded, full_grads)]
+        full_grad = torch.cat([module.tensor.reshape(-1) for module in
+                               cut_modules(grad_modules, bonds)])
+
+        assert torch.allclose(output, full_output, rtol=1e-4, atol=1e-6)
+        assert torch.allclose(grads[0], full_grad, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS
+
+batch_size = 7
+input_size = 24
+output_dim = 3
+bond_dim = 5
+
+input_data = torch.rand([batch_size, input_size])
+
+# Check that reduced precision contraction gives roughly the same outputs as
+# full precision, with parameters, outputs and gradients left in full precision
+for compute_dtype in [torch.bfloat16, torch.float16]:
+    for options in [{}, {'renormalize': True}, {'stream_sites': True},
+                    {'parallel_eval': True}, {'periodic_bc': True},
+                    {'adaptive_mode': True}]:
+        torch.manual_seed(0)
+        mps_module = MPS(input_size, output_dim, bond_dim, init_std=0.1,
+                         **options)
+        output = mps_module(input_data)
+
+        mps_module.linear_region.compute_dtype = compute_dtype
+        low_output = mps_module(input_data)
+        if options.get('renormalize'):
+            output = output[0] * torch.exp(output[1])[:, None]
+            low_output = low_output[0] * torch.exp(low_output[1])[:, None]
+        low_output.sum().backward()
+
+        assert low_output.dtype == torch.float32
+        assert torch.allclose(output, low_output, rtol=5e-2, atol=5e-2)
+        for param in mps_module.parameters():
+            assert param.dtype == torch.float32
+            assert param.grad is None or param.grad.dtype == torch.float32
+
+# Without a compute_dtype, the contraction follows the precision of our cores
+# rather than that of our (default float32) embedded input
+for options in [{}, {'parallel_eval': True}, {'periodic_bc': True},
+                {'adaptive_mode': True}]:
+    torch.manual_seed(0)
+    mps_module = MPS(input_size, output_dim, bond_dim, init_std=0.1,
+                     **options).double()
+    output = mps_module(input_data)
+    double_output = mps_module(input_data.double())
+
+    assert output.dtype == torch.float64
+    assert torch.allclose(output, double_output, rtol=1e-12, atol=1e-12)
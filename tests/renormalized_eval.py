@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS
+
+batch_size = 9
+input_size = 30
+output_dim = 3
+bond_dim = 6
+
+input_data = torch.rand([batch_size, input_size])
+
+# Check that renormalized outputs and gradients match the usual ones once the
+# log norms are folded back in, for each of our serial contraction methods
+for adaptive_mode in [False, True]:
+    for options in [{}, {'stream_sites': True, 'segment_size': 4},
+                    {'block_size': 3}, {'chunk_size': 4}]:
+        torch.manual_seed(0)
+        mps_module = MPS(input_size, output_dim, bond_dim, init_std=0.1,
+                         adaptive_mode=adaptive_mode, **options)
+        output = mps_module(input_data)
+        output.sum().backward()
+        grads = [p.grad.clone() for p in mps_module.parameters()
+                 if p.grad is not None]
+
+        mps_module.zero_grad()
+        mps_module.linear_region.renormalize = True
+        scores, log_norm = mps_module(input_data)
+        assert log_norm.shape == torch.Size([batch_size])
+        renorm_output = scores * torch.exp(log_norm)[:, None]
+        renorm_output.sum().backward()
+        renorm_grads = [p.grad for p in mps_module.parameters()
+                        if p.grad is not None]
+
+        assert torch.allclose(output, renorm_output, rtol=1e-4, atol=1e-6)
+        assert len(grads) == len(renorm_grads)
+        for grad, renorm_grad in zip(grads, renorm_grads):
+            assert torch.allclose(grad, renorm_grad, rtol=1e-4, atol=1e-4)
+
+# Check that a long chain of large cores overflows without renormalization,
+# but gives finite scores and log norms with it
+long_size = 2000
+long_data = torch.rand([batch_size, long_size])
+for renormalize in [False, True]:
+    torch.manual_seed(0)
+    mps_module = MPS(long_size, output_dim, bond_dim, init_std=0.1,
+                     renormalize=renormalize)
+    with torch.no_grad():
+        for param in mps_module.parameters():
+            param.mul_(3)
+        output = mps_module(long_data)
+
+    if renormalize:
+        scores, log_norm = output
+        assert torch.all(torch.isfinite(scores))
+        assert torch.all(torch.isfinite(log_norm))
+        assert torch.all(log_norm > 100)
+    else:
+        assert not torch.all(torch.isfinite(output))
+
+# Renormalization isn't supported for periodic or parallel contraction
+for options in [{'periodic_bc': True}, {'parallel_eval': True}]:
+    try:
+        MPS(input_size, output_dim, bond_dim, renormalize=True, **options)
+        assert False
+    except ValueError:
+        pass
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS
+
+batch_size = 11
+input_size = 21
+output_dim = 4
+bond_dim = 5
+
+torch.manual_seed(0)
+input_data = torch.rand([batch_size, input_size])
+
+# Check that streaming inputs through our cores one site at a time gives the 
+# same outputs and gradients as building all the site matrices up front
+for adaptive_mode, label_sites in [(False, [None, 0, input_size]), 
+                                   (True, [None, 0, 1, input_size])]:
+    for label_site in label_sites:
+        torch.manual_seed(0)
+        mps_module = MPS(input_size, output_dim, bond_dim, init_std=0.1,
+                         label_site=label_site, adaptive_mode=adaptive_mode)
+        output = mps_module(input_data)
+        output.sum().backward()
+        grads = [p.grad.clone() for p in mps_module.parameters() 
+                 if p.grad is not None]
+
+        for segment_size in [None, 3]:
+            mps_module.zero_grad()
+            mps_module.linear_region.stream_sites = True
+            mps_module.linear_region.segment_size = segment_size
+
+            stream_output = mps_module(input_data)
+            stream_output.sum().backward()
+            stream_grads = [p.grad for p in mps_module.parameters() 
+                            if p.grad is not None]
+
+            assert torch.allclose(output, stream_output, rtol=1e-4, atol=1e-6)
+            assert len(grads) == len(stream_grads)
+            for grad, stream_grad in zip(grads, stream_grads):
+                assert torch.allclose(grad, stream_grad, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS
+from contractables import jump_table, jump_schedule
+
+batch_size = 13
+input_size = 23
+output_dim = 3
+bond_dim = 4
+
+# Products of default matrices over jumps and non-default matrices, taken in
+# the order given by a jump schedule, should give the full chain product
+torch.manual_seed(0)
+default_mats = torch.randn([input_size, bond_dim, bond_dim])
+input_mats = torch.randn([batch_size, input_size, bond_dim, bond_dim])
+nondefault = torch.rand([batch_size, input_size]) < 0.3
+nondefault[0], nondefault[1] = False, True
+
+schedule = jump_schedule(nondefault)
+assert schedule.size(1) == input_size
+all_mats = torch.cat([jump_table(default_mats).view(-1, bond_dim, bond_dim),
+                      torch.eye(bond_dim)[None], input_mats[nondefault]])
+for b in range(batch_size):
+    full_prod, sparse_prod = torch.eye(bond_dim), torch.eye(bond_dim)
+    for s in range(input_size):
+        mat = input_mats[b, s] if nondefault[b, s] else default_mats[s]
+        full_prod = full_prod @ mat
+    for step in schedule[b]:
+        sparse_prod = sparse_prod @ all_mats[step]
+    assert torch.allclose(full_prod, sparse_prod, rtol=1e-4, atol=1e-4)
+
+# With a default input set, evaluation without gradients should agree with
+# the usual dense evaluation
+input_data = torch.rand([batch_size, input_size])
+input_data[torch.rand([batch_size, input_size]) < 0.7] = 0
+input_data[0] = 0
+for feature_map in [None, 'cos_sin']:
+    for options in [{}, {'block_size': 3}, {'stream_sites': True},
+                    {'renormalize': True}, {'chunk_size': 5}]:
+        for label_site in [None, 0, input_size]:
+            torch.manual_seed(0)
+            mps_module = MPS(input_size, output_dim, bond_dim, init_std=0.2,
+                             label_site=label_site, feature_map=feature_map,
+                             **options)
+            with torch.no_grad():
+                output = mps_module(input_data)
+                mps_module.set_default_input(0.)
+                sparse_output = mps_module(input_data)
+
+            if isinstance(output, tuple):
+                output = output[0] * output[1].exp()[:, None]
+                sparse_output = sparse_output[0] * \
+                                sparse_output[1].exp()[:, None]
+            assert torch.allclose(output, sparse_output, rtol=1e-4,
+                                  atol=1e-5)
+
+# Cached default products are refreshed after parameter updates, and
+# gradients are still computed from the dense evaluation
+mps_module = MPS(input_size, output_dim, bond_dim, init_std=0.2,
+                 default_input=0.)
+with torch.no_grad():
+    mps_module(input_data)
+    for param in mps_module.parameters():
+        param.mul_(1.1)
+    sparse_output = mps_module(input_data)
+output = mps_module(input_data)
+output.sum().backward()
+assert torch.allclose(output, sparse_output, rtol=1e-4, atol=1e-5)
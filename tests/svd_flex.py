@@ -3,7 +3,9 @@ import torch
 import sys
 
 sys.path.append('/home/jemis/torch_mps')
-from utils import svd_flex
+import utils
+from utils import svd_flex, lowrank_svd
+from torchmps import MPS
 
 shapes = [[2, 4],
           [7, 2, 4],
@@ -52,3 +54,82 @@ for i in range(len(svd_strs)):
         assert left_shape[i] == -1 or left_shape[i] == left_out.size(i)
     for i in range(len(right_shape)):
         assert right_shape[i] == -1 or right_shape[i] == right_out.size(i)
+
+# Batch characters shared by all strings split many tensors at once, giving
+# the same output as splitting each one separately
+batch_tensor = torch.randn([6, 5, 5, 3, 3])
+for cutoff_mode, cutoff in [('absolute', 1.), ('relative', 0.2),
+                            ('discarded', 1e-2)]:
+    sv_vecs = torch.empty([6, 5])
+    left_out, right_out, bond_dims = svd_flex(batch_tensor, 'slrij->slui,surj',
+                                              max_D=5, cutoff=cutoff,
+                                              sv_vec=sv_vecs,
+                                              cutoff_mode=cutoff_mode)
+    assert list(bond_dims.shape) == [6]
+    for s in range(6):
+        sv_vec = torch.empty([5])
+        left_ref, right_ref, bond_dim = svd_flex(batch_tensor[s],
+                                                 'lrij->lui,urj', max_D=5,
+                                                 cutoff=cutoff, sv_vec=sv_vec,
+                                                 cutoff_mode=cutoff_mode)
+        assert bond_dim == bond_dims[s]
+        assert torch.allclose(sv_vec, sv_vecs[s])
+        assert torch.allclose(left_out[s], left_ref, atol=1e-6)
+        assert torch.allclose(right_out[s], right_ref, atol=1e-6)
+
+# Relative and discarded weight cutoffs truncate the right singular values
+matrix = torch.diag(torch.tensor([4., 2., 1., 0.5]))
+for cutoff_mode, cutoff, bond_dim in [('absolute', 1., 3),
+                                      ('relative', 0.2, 3),
+                                      ('discarded', 0.1, 2)]:
+    left_out, right_out, bond = svd_flex(matrix, 'lr->lu,ur', cutoff=cutoff,
+                                         cutoff_mode=cutoff_mode)
+    assert bond == bond_dim
+    assert left_out.shape == torch.Size([4, bond_dim])
+
+# The lowrank backend finds the same truncated splitting as the full SVD for
+# matrices with decaying singular values, and falls back to a full SVD when
+# the matrix is too small for it to help
+left_q, _ = torch.linalg.qr(torch.randn([3, 60, 60], dtype=torch.float64))
+right_q, _ = torch.linalg.qr(torch.randn([3, 60, 60], dtype=torch.float64))
+decaying_svs = torch.exp(-torch.arange(60, dtype=torch.float64) / 4)
+matrices = (left_q * decaying_svs) @ right_q.transpose(1, 2)
+for max_D in [8, 40]:
+    full_out = svd_flex(matrices, 'slr->slu,sur', max_D=max_D, cutoff=1e-4)
+    lowrank_out = svd_flex(matrices, 'slr->slu,sur', max_D=max_D, cutoff=1e-4,
+                           svd_backend='lowrank', oversample=10)
+    assert torch.equal(full_out[2], lowrank_out[2])
+    full_mats = full_out[0] @ full_out[1]
+    lowrank_mats = lowrank_out[0] @ lowrank_out[1]
+    assert torch.allclose(full_mats, lowrank_mats, atol=1e-8)
+
+# Merged cores with feature_dim = 2 are 2D x 2D matrices, which are split
+# into bonds of size max_D = D. The lowrank backend should still be used for
+# these, with only the kept singular vectors checked for accuracy
+bond_dim = 30
+left_q, _ = torch.linalg.qr(torch.randn([3, 60, 60], dtype=torch.float64))
+right_q, _ = torch.linalg.qr(torch.randn([3, 60, 60], dtype=torch.float64))
+matrices = (left_q * decaying_svs) @ right_q.transpose(1, 2)
+assert lowrank_svd(matrices, bond_dim, oversample=10) is not None
+full_out = svd_flex(matrices, 'slr->slu,sur', max_D=bond_dim, cutoff=1e-4)
+lowrank_out = svd_flex(matrices, 'slr->slu,sur', max_D=bond_dim, cutoff=1e-4,
+                       svd_backend='lowrank', oversample=10)
+assert torch.equal(full_out[2], lowrank_out[2])
+assert torch.allclose(full_out[0] @ full_out[1],
+                      lowrank_out[0] @ lowrank_out[1], atol=1e-8)
+
+# The same holds for the merge updates of an adaptive MPS with feature_dim = 2
+lowrank_calls = []
+def logged_lowrank_svd(*args, **kwargs):
+    svd_out = lowrank_svd(*args, **kwargs)
+    lowrank_calls.append(svd_out is not None)
+    return svd_out
+
+utils.lowrank_svd = logged_lowrank_svd
+torch.manual_seed(0)
+mps_module = MPS(10, 3, 20, feature_dim=2, adaptive_mode=True,
+                 svd_backend='lowrank', merge_threshold=4)
+for _ in range(2):
+    mps_module(torch.rand([4, 10]))
+utils.lowrank_svd = lowrank_svd
+assert len(lowrank_calls) > 0 and all(lowrank_calls)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+import torch
+import sys
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS
+from paths import PATHS, get_path, apply_path
+
+def spiral_loop(height, width):
+    # Reference spiral built pixel by pixel
+    grid = torch.arange(height * width).view(height, width)
+    top, bottom, left, right = 0, height, 0, width
+    path = []
+    while top < bottom and left < right:
+        path += grid[top, left:right].tolist()
+        top += 1
+        path += grid[top:bottom, right-1].tolist()
+        right -= 1
+        if top < bottom:
+            path += grid[bottom-1, left:right].flip(0).tolist()
+            bottom -= 1
+        if left < right:
+            path += grid[top:bottom, left].flip(0).tolist()
+            left += 1
+    return torch.tensor(path)
+
+# Every path should visit each pixel exactly once
+for height, width in [(1, 1), (1, 5), (5, 1), (4, 4), (3, 7), (6, 5), (28, 28)]:
+    for name in PATHS:
+        path = get_path(name, height, width)
+        assert torch.equal(path.sort()[0], torch.arange(height * width))
+    assert torch.equal(get_path('spiral', height, width),
+                       spiral_loop(height, width))
+
+# Snake, spiral and Hilbert paths only ever step between neighboring pixels
+for name, height, width in [('snake', 5, 6), ('spiral', 5, 6),
+                            ('hilbert', 16, 16)]:
+    path = get_path(name, height, width)
+    rows, cols = path // width, path % width
+    assert torch.all(rows.diff().abs() + cols.diff().abs() == 1)
+
+assert get_path('block', 4, 4).tolist() == [0, 1, 4, 5, 2, 3, 6, 7,
+                                            8, 9, 12, 13, 10, 11, 14, 15]
+assert torch.equal(get_path('column', 3, 2), torch.tensor([0, 2, 4, 1, 3, 5]))
+
+# Paths given to an MPS should match reordering input before an MPS without
+# a custom path
+height, width = 5, 6
+images = torch.rand([7, height, width])
+for name in ['hilbert', 'spiral', 'block']:
+    path = get_path(name, height, width)
+    torch.manual_seed(0)
+    path_mps = MPS(height * width, 3, 4, init_std=0.2, path=path)
+    torch.manual_seed(0)
+    plain_mps = MPS(height * width, 3, 4, init_std=0.2)
+
+    output = path_mps(images.flatten(1))
+    assert torch.allclose(output, plain_mps(apply_path(images, path)))
+    assert torch.allclose(output, plain_mps(apply_path(images.flatten(1),
+                                                       path)))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+import copy
+import torch
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append('/home/jemis/torch_mps')
+from torchmps import MPS
+
+batch_size = 8
+input_size = 20
+output_dim = 3
+bond_dim = 5
+
+input_data = [torch.rand([batch_size, input_size]) for _ in range(4)]
+
+# Outputs computed with reusable buffers should match those computed without,
+# and the number of buffers should stay fixed after the first call
+for options in [{}, {'periodic_bc': True}, {'parallel_eval': True},
+                {'feature_map': 'cos_sin'}, {'adaptive_mode': True},
+                {'renormalize': True}]:
+    torch.manual_seed(0)
+    mps_module = MPS(input_size, output_dim, bond_dim, init_std=0.2,
+                     **options)
+    workspace = mps_module.linear_region.workspace
+
+    with torch.no_grad():
+        mps_module.linear_region.workspace = None
+        ref_outputs = [mps_module(inputs) for inputs in input_data]
+        mps_module.linear_region.workspace = workspace
+
+        for _ in range(2):
+            outputs = [mps_module(inputs) for inputs in input_data]
+            if _ == 0:
+                num_buffers = len(workspace)
+            assert len(workspace) == num_buffers
+            for output, ref_output in zip(outputs, ref_outputs):
+                if options.get('renormalize'):
+                    output, ref_output = output[0], ref_output[0]
+                assert torch.allclose(output, ref_output)
+
+    # Each thread gets its own buffers (and its own grad mode)
+    def eval_mps(inputs):
+        with torch.no_grad():
+            return mps_module(inputs)
+    with ThreadPoolExecutor(4) as executor:
+        outputs = list(executor.map(eval_mps, 10 * input_data))
+    for output, ref_output in zip(outputs, 10 * ref_outputs):
+        if options.get('renormalize'):
+            output, ref_output = output[0], ref_output[0]
+        assert torch.allclose(output, ref_output)
+
+# Calls with many batch sizes keep one buffer per name, which is only
+# reallocated when a larger batch comes along
+for options in [{}, {'periodic_bc': True}, {'parallel_eval': True},
+                {'adaptive_mode': True}]:
+    torch.manual_seed(0)
+    mps_module = MPS(input_size, output_dim, bond_dim, init_std=0.2,
+                     **options)
+    workspace = mps_module.linear_region.workspace
+    batch_sizes = [1, 16, 3, 9, 16, 2, 12, 5]
+    mixed_data = [torch.rand([size, input_size]) for size in batch_sizes]
+
+    with torch.no_grad():
+        mps_module.linear_region.workspace = None
+        ref_outputs = [mps_module(inputs) for inputs in mixed_data]
+        mps_module.linear_region.workspace = workspace
+
+        for i, inputs in enumerate(mixed_data):
+            output = mps_module(inputs)
+            assert torch.allclose(output, ref_outputs[i])
+            if i == 1:
+                num_buffers = len(workspace)
+                ptrs = [buf.data_ptr() for buf in
+                        workspace.buffers().values()]
+        assert len(workspace) == num_buffers
+        assert ptrs == [buf.data_ptr() for buf in
+                        workspace.buffers().values()]
+
+# Copies of a model start out with an empty workspace
+assert len(copy.deepcopy(mps_module).linear_region.workspace) == 0
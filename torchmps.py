@@ -1,8 +1,17 @@
+import copy
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from utils import init_tensor, svd_flex
+from feature_maps import get_feature_map, is_batched_map, vectorize_map, \
+                         find_affine_map
+from workspace import Workspace
 from contractables import SingleMat, MatRegion, OutputCore, ContractableList, \
-                          EdgeVec
+                          EdgeVec, sweep_mats, reduce_mats, stream_cores, \
+                          block_mats, choose_block_size, jump_table, \
+                          jump_schedule
 
 class MPS(nn.Module):
     """
@@ -11,7 +20,12 @@ class MPS(nn.Module):
     def __init__(self, input_dim, output_dim, bond_dim, feature_dim=2,
                  adaptive_mode=False, periodic_bc=False, parallel_eval=False,
                  label_site=None, path=None, cutoff=1e-10,
-                 merge_threshold=2000, init_std=1e-9):
+                 merge_threshold=2000, init_std=1e-9, chunk_size=None,
+                 memory_budget=None, stream_sites=False, segment_size=None,
+                 block_size=None, renormalize=False, compute_dtype=None,
+                 feature_map=None, input_levels=None, default_input=None,
+                 svd_backend='full', oversample=10, async_merge=False,
+                 max_staleness=1):
         super().__init__()
 
         if label_site is None:
@@ -46,16 +60,39 @@ class MPS(nn.Module):
             self.linear_region = MergedLinearRegion(module_list=module_list,
                                  periodic_bc=periodic_bc,
                                  parallel_eval=parallel_eval, cutoff=cutoff,
-                                 merge_threshold=merge_threshold)
+                                 merge_threshold=merge_threshold,
+                                 chunk_size=chunk_size,
+                                 memory_budget=memory_budget,
+                                 stream_sites=stream_sites,
+                                 segment_size=segment_size,
+                                 block_size=block_size,
+                                 renormalize=renormalize,
+                                 compute_dtype=compute_dtype,
+                                 svd_backend=svd_backend,
+                                 oversample=oversample,
+                                 async_merge=async_merge,
+                                 max_staleness=max_staleness)
         else:
             self.linear_region = LinearRegion(module_list=module_list,
                                  periodic_bc=periodic_bc,
-                                 parallel_eval=parallel_eval)
+                                 parallel_eval=parallel_eval,
+                                 chunk_size=chunk_size,
+                                 memory_budget=memory_budget,
+                                 stream_sites=stream_sites,
+                                 segment_size=segment_size,
+                                 block_size=block_size,
+                                 renormalize=renormalize,
+                                 compute_dtype=compute_dtype)
         assert len(self.linear_region) == input_dim
 
-        if path:
+        # Store custom paths as an index tensor, used to gather our input
+        if path is not None:
             assert isinstance(path, (list, torch.Tensor))
             assert len(path) == input_dim
+            path_index = torch.as_tensor(path, dtype=torch.long).flatten()
+            self.register_buffer('path_index', path_index, persistent=False)
+        else:
+            self.path_index = None
 
         self.input_dim = input_dim
         self.output_dim = output_dim
@@ -67,7 +104,25 @@ class MPS(nn.Module):
         self.path = path
         self.cutoff = cutoff
         self.merge_threshold = merge_threshold
+        self.svd_backend = svd_backend
+        self.oversample = oversample
+        self.async_merge = async_merge
+        self.max_staleness = max_staleness
+        self.chunk_size = chunk_size
+        self.memory_budget = memory_budget
+        self.stream_sites = stream_sites
+        self.segment_size = segment_size
+        self.block_size = block_size
+        self.renormalize = renormalize
+        self.compute_dtype = compute_dtype
         self.feature_map = None
+        self.batched_map = None
+        self.embedding_cache = None
+        self.input_levels = input_levels
+        self.register_buffer('level_embeddings', None, persistent=False)
+        self.default_input = default_input
+
+        self.register_feature_map(feature_map)
 
         # Initialize the list of bond dimensions, which starts out constant
         self.bond_list = bond_dim * torch.ones(input_dim + 2, dtype=torch.long)
@@ -77,7 +132,7 @@ class MPS(nn.Module):
         # Initialize the list of singular values, which start out unset (-1)
         self.sv_list = -1. * torch.ones([input_dim + 2, bond_dim])
 
-    def embed_input(self, input_data):
+    def embed_input(self, input_data, keys=None, workspace=None):
         """
         Embed pixels of input_data into separate local feature spaces
 
@@ -86,6 +141,13 @@ class MPS(nn.Module):
                                     [batch_size, input_dim, feature_dim]. In the
                                     latter case, the data is assumed to already
                                     be embedded, and is returned unchanged.
+            keys (list):            Keys identifying each input in our
+                                    embedding cache, such as dataset indices.
+                                    Only used when an embedding cache is set
+            workspace (Workspace):  Arena holding a reusable buffer for our
+                                    output when gradients aren't needed, in
+                                    which case the output is only valid until
+                                    the next call
 
         Returns:
             embedded_data (Tensor): Input embedded into a tensor with shape
@@ -102,32 +164,64 @@ class MPS(nn.Module):
                 f"{list(input_data.shape)}, feature_dim = {self.feature_dim})")
             return input_data
 
+        # Reuse cached embeddings when possible
+        cache = self.embedding_cache
+        if cache is not None and not input_data.requires_grad:
+            return cache.embed(input_data, self.apply_feature_map, keys)
+
+        return self.apply_feature_map(input_data, workspace)
+
+    def apply_feature_map(self, input_data, workspace=None):
+        """
+        Embed unembedded input_data using our feature map
+
+        Args:
+            input_data (Tensor):    Input with shape [batch_size, input_dim]
+            workspace (Workspace):  Arena holding a reusable output buffer
+
+        Returns:
+            embedded_data (Tensor): Input embedded into a tensor with shape
+                                    [batch_size, input_dim, feature_dim]
+        """
         embedded_shape = list(input_data.shape) + [self.feature_dim]
 
+        # When gradients aren't needed, embed into a reusable buffer
+        if workspace is not None and not torch.is_grad_enabled() and \
+           (self.feature_map is None or self.builtin_map):
+            dtype = input_data.dtype if self.feature_map is not None and \
+                    input_data.is_floating_point() else torch.get_default_dtype()
+            out = workspace.get('embed_input', embedded_shape, dtype,
+                                input_data.device)
+        else:
+            out = None
+
         # Apply a custom embedding map if it has been defined by the user
         if self.feature_map is not None:
-            f_map = self.feature_map
-            embedded_data = torch.stack([torch.stack([f_map(x) for x in batch])
-                                                      for batch in input_data])
+            if out is not None:
+                embedded_data = self.batched_map(input_data, out=out)
+            else:
+                embedded_data = self.batched_map(input_data)
 
             # Make sure our embedded input has the desired size
-            assert embedded_data.shape == torch.Size(
-                   [input_data.size(0), self.input_dim, self.feature_dim])
+            assert embedded_data.shape == torch.Size(embedded_shape)
 
         # Otherwise, use a simple linear embedding map with feature_dim = 2
         else:
             if self.feature_dim != 2:
                 raise RuntimeError(f"self.feature_dim = {self.feature_dim}, "
                       "but default feature_map requires self.feature_dim = 2")
-            embedded_data = torch.empty(embedded_shape)
-            print(embedded_data.shape, 'hi')
+            if out is not None:
+                embedded_data = out
+            else:
+                embedded_data = torch.empty(embedded_shape,
+                                            device=input_data.device)
 
             embedded_data[:,:,0] = input_data
             embedded_data[:,:,1] = 1 - input_data
 
         return embedded_data
 
-    def register_feature_map(self, feature_map):
+    def register_feature_map(self, feature_map, batched=None):
         """
         Register a custom feature map to be used for embedding input data
 
@@ -137,18 +231,168 @@ class MPS(nn.Module):
                                     image. The output size of the function must
                                     match self.feature_dim. If feature_map=None,
                                     then the feature map will be reset to a
-                                    simple default linear embedding
-        """
+                                    simple default linear embedding. This can
+                                    also be the name of a built-in feature map
+                                    from feature_maps.py, such as 'cos_sin'
+            batched (bool):         Whether feature_map instead acts on a full
+                                    batch of input, with shape [batch_size,
+                                    input_dim], and returns a tensor with shape
+                                    [batch_size, input_dim, feature_dim]. When
+                                    batched=None, this is inferred by calling
+                                    feature_map on a small batch of input
+        """
+        # Built-in feature maps can also write to preallocated output
+        self.builtin_map = isinstance(feature_map, str)
+        if self.builtin_map:
+            feature_map = get_feature_map(feature_map, self.feature_dim)
+            batched = True
+
         if feature_map is not None:
-            # Test to make sure feature_map outputs vector of proper size
-            out_shape = feature_map(torch.tensor(0)).shape
-            needed_shape = torch.Size([self.feature_dim])
+            if batched is None:
+                batched = is_batched_map(feature_map, self.feature_dim)
+
+            # Test to make sure feature_map outputs vectors of proper size
+            if batched:
+                probe = torch.linspace(0, 1, 6).view([2, 3])
+                out_shape = feature_map(probe).shape
+                needed_shape = torch.Size([2, 3, self.feature_dim])
+            else:
+                out_shape = feature_map(torch.tensor(0)).shape
+                needed_shape = torch.Size([self.feature_dim])
             if out_shape != needed_shape:
                 raise ValueError("Given feature_map returns values of size "
                                 f"{list(out_shape)}, but should return "
                                 f"values of size {list(needed_shape)}")
 
+            # Scalar feature maps are vectorized to act on full batches
+            batched_map = feature_map if batched else vectorize_map(feature_map)
+            affine_map = find_affine_map(batched_map, self.feature_dim)
+
+        elif self.feature_dim == 2:
+            # Our default feature map x -> [x, 1-x] is affine, x -> a + x*c
+            batched_map = None
+            affine_map = (torch.tensor([0., 1.]), torch.tensor([1., -1.]))
+        else:
+            batched_map, affine_map = None, None
+
         self.feature_map = feature_map
+        self.batched_map = batched_map
+        self.affine_map = affine_map
+
+        # Any cached embeddings came from our old feature map
+        if self.embedding_cache is not None:
+            self.embedding_cache.clear()
+        self.set_input_levels(self.input_levels)
+        self.set_default_input(self.default_input)
+
+    def set_input_levels(self, input_levels):
+        """
+        Set the levels taken by quantized or categorical input data
+
+        When set, integer-valued input data is treated as the level of each
+        input, and each core's matrices for every level are looked up in a
+        precomputed table, rather than contracting each core with embedded
+        input. This pays off when the batch size is larger than the number
+        of levels, and when gradients aren't needed the tables are cached
+        until our cores are next modified
+
+        Args:
+            input_levels:   Either an integer number of levels K, for input
+                            quantized to the values 0, 1, ..., K-1 (such as
+                            8-bit pixels, with K = 256), where level k is
+                            embedded by our feature map as the value
+                            k / (K-1); a list or tensor of K values, giving
+                            the value embedded for each level; or the string
+                            'categorical', for input taking the values 0, 1,
+                            ..., feature_dim-1, where each value is embedded
+                            as a one-hot vector. If input_levels=None, integer
+                            input data is embedded like any other input
+        """
+        if input_levels is None:
+            level_embeddings = None
+        elif isinstance(input_levels, str):
+            if input_levels != 'categorical':
+                raise ValueError(f"Unknown input_levels '{input_levels}', "
+                                  "must be an integer, a list of values, or "
+                                  "'categorical'")
+            level_embeddings = torch.eye(self.feature_dim)
+        else:
+            if isinstance(input_levels, int):
+                values = torch.linspace(0, 1, input_levels)
+            else:
+                values = torch.as_tensor(input_levels,
+                                         dtype=torch.get_default_dtype())
+            assert len(values.shape) == 1
+            with torch.no_grad():
+                level_embeddings = self.apply_feature_map(values[None])[0]
+
+        if level_embeddings is not None:
+            device = next(self.linear_region.parameters()).device
+            level_embeddings = level_embeddings.to(device)
+        self.input_levels = input_levels
+        self.level_embeddings = level_embeddings
+
+    def set_default_input(self, default_input):
+        """
+        Set a default input value, for evaluating mostly default input faster
+
+        When gradients aren't needed, serial contraction with open boundaries
+        then skips over each run of default inputs using a few cached
+        products of the default matrices over ranges of sites. For input
+        where k of the N inputs differ from the default, such as images with
+        mostly blank pixels, this takes O(k log N) steps instead of N
+
+        Args:
+            default_input (float):  The default value of unembedded input,
+                                    such as 0 for blank pixels. Embedded
+                                    input equal to the embedding of this
+                                    value is also treated as default. If
+                                    default_input=None, every input is
+                                    contracted with its core
+        """
+        if default_input is None:
+            default_embedding = None
+        else:
+            value = torch.tensor([[default_input]],
+                                 dtype=torch.get_default_dtype())
+            with torch.no_grad():
+                default_embedding = self.apply_feature_map(value)[0, 0]
+            device = next(self.linear_region.parameters()).device
+            default_embedding = default_embedding.to(device)
+
+        self.default_input = default_input
+        self.linear_region.default_embedding = default_embedding
+
+    def set_embedding_cache(self, embedding_cache):
+        """
+        Set a cache of embedded inputs to use when embedding input data
+
+        Args:
+            embedding_cache (EmbeddingCache): Cache which stores embedded
+                                              inputs across calls, so that
+                                              repeated inputs (e.g. over
+                                              several epochs) are only
+                                              embedded once. If None, then
+                                              caching is turned off
+        """
+        self.embedding_cache = embedding_cache
+
+    def register_optimizer(self, optimizer):
+        """
+        Carry the state of an optimizer through each merge in adaptive mode
+
+        The cores of an adaptive MPS are periodically rearranged, after which
+        they take a different shape and are held by a new parameter. This
+        replaces the old one in registered optimizers, and the state they hold
+        for our cores, such as momentum, is rearranged along with them.
+        Only a weak reference to optimizer is kept, and nothing is done for
+        fixed bond dimensions
+
+        Args:
+            optimizer (Optimizer):  Optimizer training our parameters
+        """
+        if isinstance(self.linear_region, MergedLinearRegion):
+            self.linear_region.register_optimizer(optimizer)
 
     def core_len(self):
         """
@@ -162,7 +406,7 @@ class MPS(nn.Module):
         """
         return self.input_dim
 
-    def forward(self, input_data):
+    def forward(self, input_data, keys=None):
         """
         Embed our data and pass it to an MPS with a single output site
 
@@ -171,24 +415,63 @@ class MPS(nn.Module):
                                  When using a user-specified path, the size of
                                  the second tensor mode need not exactly equal
                                  input_dim, since the path variable is used to
-                                 slice a certain subregion of input_data
+                                 slice a certain subregion of input_data.
+                                 When input levels are set, integer-valued
+                                 input_data gives the level of each input
+            keys (list):         Keys identifying each input in our embedding
+                                 cache, such as dataset indices. If None, the
+                                 contents of each input are hashed instead
+
+        Returns:
+            output (Tensor):     Output with shape [batch_size, output_dim].
+                                 When renormalize is set, the pair (output,
+                                 log_norm) is returned instead, where log_norm
+                                 has shape [batch_size] and the unnormalized
+                                 output is output * exp(log_norm)
         """
         # For custom paths, rearrange our input into the desired order
-        if self.path:
-            path_inputs = []
-            for site_num in self.path:
-                path_inputs.append(input_data[:, site_num])
-            input_data = torch.stack(path_inputs, dim=1)
-
-        # Embed our input data before feeding it into our linear region
-        input_data = self.embed_input(input_data)
-        output = self.linear_region(input_data)
-
-        # If we got a tuple as output, then use the last two entries to
-        # update our bond dimensions and singular values
-        if isinstance(output, tuple):
+        if self.path_index is not None:
+            input_data = torch.index_select(input_data, 1, self.path_index)
+
+        # Quantized or categorical input is passed to our linear region as
+        # levels, whose matrices get looked up instead of ever being embedded
+        levels = self.level_embeddings
+        quantized = levels is not None and len(input_data.shape) == 2 and \
+                    not input_data.is_floating_point()
+        if quantized:
+            assert input_data.size(1) == self.input_dim
+            input_data = input_data.long()
+
+        # Lookup tables are rebuilt on every call when gradients are needed,
+        # which doesn't pay off for batches smaller than the number of levels
+        if quantized and (not torch.is_grad_enabled() or
+                          input_data.size(0) >= len(levels)):
+            output = self.linear_region(input_data, levels=levels)
+
+        elif quantized:
+            output = self.linear_region(embed_levels(input_data, levels))
+
+        # When gradients aren't needed, affine feature maps are applied by our
+        # linear region, which avoids ever building the embedded input
+        elif self.affine_map is not None and len(input_data.shape) == 2 and \
+             self.embedding_cache is None and not torch.is_grad_enabled():
+            affine_map = self.affine_map
+            assert input_data.size(1) == self.input_dim
+            input_data = input_data.to(affine_map[0].dtype)
+            output = self.linear_region(input_data, affine=affine_map)
+
+        # Otherwise, embed our input data before feeding it into our region
+        else:
+            input_data = self.embed_input(input_data, keys,
+                                          self.linear_region.workspace)
+            output = self.linear_region(input_data)
+
+        # In adaptive mode, use the last two entries of our output to update
+        # our bond dimensions and singular values whenever they're given
+        if self.adaptive_mode:
             output, new_bonds, new_svs = output
 
+        if self.adaptive_mode and new_bonds is not None:
             assert len(new_bonds) == len(self.bond_list)
             assert len(new_bonds) == len(new_svs)
             for i, bond_dim in enumerate(new_bonds):
@@ -202,9 +485,47 @@ class MPS(nn.Module):
 class LinearRegion(nn.Module):
     """
     List of modules which feeds input to each module and returns reduced output
+
+    Setting chunk_size (a maximum number of inputs) or memory_budget (a rough
+    number of bytes) makes the contraction run over chunks of the input batch
+    one at a time. When gradients are needed, each chunk is checkpointed and
+    recomputed during the backward pass, so that the peak memory usage stays
+    bounded regardless of the batch size
+
+    Setting stream_sites makes serial contractions with open boundaries
+    contract inputs one site at a time, without ever building the matrices
+    for all sites at once. segment_size then gives the number of sites in
+    each checkpointed segment of the backward pass
+
+    Setting block_size makes serial contractions with open boundaries first
+    multiply together blocks of block_size matrices in parallel, then sweep
+    boundary vectors across the block products. block_size='auto' chooses
+    the block size for each module from a cost model
+
+    Setting renormalize makes serial contractions with open boundaries
+    normalize the boundary vectors after every step, which keeps long chains
+    from overflowing or underflowing. The output is then a pair (output,
+    log_norm), where the unnormalized output is output * exp(log_norm)
+
+    Setting compute_dtype (e.g. torch.bfloat16) runs the contraction in that
+    lower precision, while our cores are still stored in full precision.
+    Norms and log norms are accumulated in at least single precision, and
+    outputs are returned in the precision of our cores. Without a
+    compute_dtype, input is cast to the precision of our cores instead
+
+    When gradients aren't needed, intermediate tensors are written to
+    reusable buffers in self.workspace, which can be set to None to turn off
+    this reuse
+
+    Setting self.default_embedding to the embedded value of a default input
+    (such as a blank pixel) makes serial contractions with open boundaries
+    skip over runs of default inputs when gradients aren't needed, using
+    cached products of the default matrices of each InputRegion
     """
     def __init__(self, module_list, periodic_bc=False, parallel_eval=False,
-                 module_states=None):
+                 module_states=None, chunk_size=None, memory_budget=None,
+                 stream_sites=False, segment_size=None, block_size=None,
+                 renormalize=False, compute_dtype=None):
         # Check that module_list is a list whose entries are Pytorch modules
         if not isinstance(module_list, list) or module_list is []:
             raise ValueError("Input to LinearRegion must be nonempty list")
@@ -212,87 +533,415 @@ class LinearRegion(nn.Module):
             if not isinstance(item, nn.Module):
                 raise ValueError("Input items to LinearRegion must be PyTorch "
                                 f"Module instances, but item {i} is not")
+        if renormalize and (periodic_bc or parallel_eval):
+            raise ValueError("renormalize is only supported for open "
+                             "boundary conditions and serial evaluation")
         super().__init__()
 
         # Wrap as a ModuleList for proper parameter registration
         self.module_list = nn.ModuleList(module_list)
         self.periodic_bc = periodic_bc
         self.parallel_eval = parallel_eval
-
-    def forward(self, input_data):
-        """
-        Contract input with list of MPS cores and return result as contractable
+        self.chunk_size = chunk_size
+        self.memory_budget = memory_budget
+        self.stream_sites = stream_sites
+        self.segment_size = segment_size
+        self.block_size = block_size
+        self.renormalize = renormalize
+        self.compute_dtype = compute_dtype
+        self.workspace = Workspace()
+        self.default_embedding = None
+
+    def forward(self, input_data, affine=None, levels=None):
+        """
+        Contract input with list of MPS cores and return the output tensor
+
+        The batch is contracted in chunks as set by chunk_size or
+        memory_budget. Serial contractions with open boundaries sweep
+        boundary vectors in from both edges, and periodic boundaries trace
+        our output core against an environment matrix, while parallel
+        evaluation reduces the contractables of our modules in the order
+        chosen by the planner of ContractableList.reduce
 
         Args:
             input_data (Tensor): Input with shape [batch_size, input_dim,
                                                    feature_dim]
+            affine (tuple):      Pair of vectors (a, c) with length
+                                 feature_dim, given when our feature map is
+                                 affine, x -> a + x*c. In that case input_data
+                                 is unembedded, with shape [batch_size,
+                                 input_dim], and each module contracts it
+                                 with its cores without ever embedding it
+            levels (Tensor):     Embedded values of each input level, with
+                                 shape [num_levels, feature_dim], given for
+                                 quantized or categorical input. In that case
+                                 input_data holds integer levels, with shape
+                                 [batch_size, input_dim], and each module
+                                 looks up its matrices in a table of its
+                                 cores contracted with every level
+
+        Returns:
+            output (Tensor):     Output with shape [batch_size, output_dim],
+                                 or the pair (output, log_norm) when
+                                 renormalize is set
         """
         # Check that input_data has the correct shape
-        assert len(input_data.shape) == 3
+        unembedded = affine is not None or levels is not None
+        assert len(input_data.shape) == (2 if unembedded else 3)
         assert input_data.size(1) == len(self)
+
+        # Our modules cast their cores to the dtype of our input, so run our
+        # contraction in the compute precision if one is given, and
+        # otherwise in the precision of our cores
+        out_dtype = self.module_list[0].tensor.dtype
+        if self.compute_dtype is not None:
+            dtype = self.compute_dtype
+        else:
+            dtype = out_dtype
+
+        if levels is None:
+            input_data = input_data.to(dtype)
+        else:
+            levels = self.cast_levels(levels, dtype)
+        output = self.contract_chunks(input_data, affine, levels)
+
+        if self.compute_dtype is not None:
+            if self.renormalize:
+                return output[0].to(out_dtype), output[1]
+            return output.to(out_dtype)
+
+        return output
+
+    def cast_levels(self, levels, dtype):
+        """
+        Returns embedded input levels cast to the dtype of our contraction
+
+        The cast levels are kept between calls, so that the lookup tables
+        cached by our modules for those levels can be reused
+        """
+        if levels.dtype == dtype:
+            return levels
+
+        key = (id(levels), levels._version, dtype)
+        cache = getattr(self, 'level_cast', None)
+        if cache is None or cache[0] != key:
+            # Holding onto levels keeps its id from being reused
+            self.level_cast = (key, levels.to(dtype), levels)
+        return self.level_cast[1]
+
+    def contract_chunks(self, input_data, affine=None, levels=None):
+        """
+        Contract input with our cores, one chunk of the input batch at a time
+
+        Args:
+            input_data (Tensor): Input with shape [batch_size, input_dim,
+                                                   feature_dim]
+        """
+        chunk_size = self.get_chunk_size()
+        if chunk_size is None or chunk_size >= input_data.size(0):
+            return self.contract(input_data, affine, levels)
+
+        # Contract each chunk of our batch separately, using checkpointing to
+        # avoid storing intermediate tensors for all chunks at once
+        outputs = []
+        for chunk in torch.split(input_data, chunk_size):
+            if torch.is_grad_enabled():
+                outputs.append(checkpoint(self.contract, chunk, affine,
+                                          levels, use_reentrant=False))
+            else:
+                outputs.append(self.contract(chunk, affine, levels))
+
+        # When renormalizing, each chunk gives a pair (output, log_norm)
+        if self.renormalize:
+            return tuple(torch.cat(items) for items in zip(*outputs))
+        return torch.cat(outputs)
+
+    def get_chunk_size(self):
+        """
+        Returns the number of inputs contracted at once, or None if unbounded
+
+        When memory_budget is set, the chunk size is chosen so that the
+        intermediate tensors for a chunk, whose size per input is at most the
+        total size of our cores, fit within the budget
+        """
+        chunk_size = self.chunk_size
+        if self.memory_budget is not None:
+            tensors = [module.tensor for module in self.module_list]
+            input_bytes = sum([t.numel() * t.element_size() for t in tensors])
+            budget_size = max(1, int(self.memory_budget // input_bytes))
+            if chunk_size is None or budget_size < chunk_size:
+                chunk_size = budget_size
+
+        return chunk_size
+
+    def contract(self, input_data, affine=None, levels=None):
+        """
+        Contract a full batch of input with list of MPS cores
+
+        Args:
+            input_data (Tensor): Input with shape [batch_size, input_dim,
+                                                   feature_dim]
+        """
         periodic_bc = self.periodic_bc
         parallel_eval = self.parallel_eval
         lin_bonds = ['l', 'r']
 
+        # For open boundary conditions and serial evaluation, sweep boundary
+        # vectors in from both edges without building any contractables
+        if not periodic_bc and not parallel_eval:
+            return self.sweep(input_data, affine, levels)
+
+        # For periodic boundary conditions, multiply all input matrices into
+        # a single environment matrix and trace it against our output core
+        if periodic_bc:
+            return self.trace(input_data, affine, levels)
+
         # For each module, pull out the number of pixels needed and call that
-        # module's forward() method, putting the result in contractable_list
-        ind = 0
+        # module's forward() method, putting the result in contractable_list.
+        # Without gradients, the matrices of each input region are instead
+        # reduced right away, so that they can all share a workspace buffer
+        workspace = self.workspace
+        use_workspace = workspace is not None and not torch.is_grad_enabled()
         contractable_list = []
-        for module in self.module_list:
-            mod_len = len(module)
-            if mod_len == 1:
-                mod_input = input_data[:, ind]
+        for module, mod_input in zip(self.module_list,
+                                     self.split_input(input_data)):
+            if use_workspace and isinstance(module, (InputRegion,
+                                                     MergedInput)):
+                mats = module.get_mats(mod_input, affine, levels,
+                                       workspace=workspace)
+                item = SingleMat(reduce_mats(mats, workspace))
             else:
-                mod_input = input_data[:, ind:(ind+mod_len)]
-            ind += mod_len
+                item = module(mod_input, affine, levels)
+            contractable_list.append(item)
+
+        # For parallel evaluation with open boundary conditions, add dummy
+        # edge vectors to contractable_list and reduce everything to get our
+        # output, starting with the dimension of left and right bond indices
+        end_items = [contractable_list[i]for i in [0, -1]]
+        bond_strs = [item.bond_str for item in end_items]
+        bond_inds = [bs.index(c) for (bs, c) in zip(bond_strs, lin_bonds)]
+        bond_dims = [item.tensor.size(ind) for (item, ind) in
+                                           zip(end_items, bond_inds)]
+
+        # Build dummy end vectors and insert them at the ends of our list
+        batch_size = input_data.size(0)
+        dtype = input_data.dtype if levels is None else levels.dtype
+        if self.workspace is not None:
+            end_vecs = [self.workspace.onehot(dim, dtype, input_data.device)
+                        for dim in bond_dims]
+        else:
+            end_vecs = [torch.zeros(dim, dtype=dtype,
+                                    device=input_data.device)
+                        for dim in bond_dims]
+            for vec in end_vecs:
+                vec[0] = 1
+        contractable_list.insert(0, EdgeVec(end_vecs[0], is_left_vec=True,
+                                            batch_size=batch_size))
+        contractable_list.append(EdgeVec(end_vecs[1], is_left_vec=False,
+                                         batch_size=batch_size))
 
-            contractable_list.append(module(mod_input))
+        # Multiply together everything in contractable_list
+        contractable_list = ContractableList(contractable_list)
+        output = contractable_list.reduce(parallel_eval=parallel_eval)
 
-        # For periodic boundary conditions, reduce contractable_list and
-        # trace over the left and right indices to get our output
-        if periodic_bc:
-            contractable_list = ContractableList(contractable_list)
-            contractable = contractable_list.reduce(parallel_eval=True)
-
-            # Unpack the output (atomic) contractable
-            tensor, bond_str = contractable.tensor, contractable.bond_str
-            assert all(c in bond_str for c in lin_bonds)
-
-            # Build einsum string for the trace of tensor
-            in_str, out_str = "", ""
-            for c in bond_str:
-                if c in lin_bonds:
-                    in_str += 'l'
-                else:
-                    in_str += c
-                    out_str += c
-            ein_str = in_str + "->" + out_str
+        return output.tensor
 
-            # Return the trace over left and right indices
-            return torch.einsum(ein_str, [tensor])
+    def trace(self, input_data, affine=None, levels=None):
+        """
+        Contract input with our cores for periodic boundary conditions
+
+        The input matrices of all modules to the right of our output core,
+        followed by those to its left, are multiplied together in parallel
+        into a single environment matrix for each input. Tracing the output
+        core against this environment then gives our output, without ever
+        multiplying the output core into a larger intermediate tensor
 
-        # For open boundary conditions, add dummy edge vectors to
-        # contractable_list and reduce everything to get our output
+        Args:
+            input_data (Tensor): Input with shape [batch_size, input_dim,
+                                                   feature_dim]
+        """
+        modules, mod_inputs, out_num = self.split_modules(input_data)
+        core = modules[out_num].get_core(mod_inputs[out_num], affine,
+                                         levels)
+
+        # Going around our ring, the environment starts right of the output
+        order = list(range(out_num + 1, len(modules))) + list(range(out_num))
+
+        # Without any input matrices, our output is just a trace of the core
+        if len(order) == 0:
+            core_str = 'boll->bo' if len(core.shape) == 4 else 'oll->o'
+            output = torch.einsum(core_str, [core])
+            return output.expand([input_data.size(0), -1])
+
+        # Reduce each module on its own as soon as we have its matrices, to
+        # avoid copying all matrices, and so that all modules can share a
+        # single workspace buffer for their matrices. Modules with trimmed
+        # bonds can give differently shaped products, which are multiplied
+        # one at a time
+        workspace = self.workspace
+        envs = [reduce_mats(modules[i].get_mats(mod_inputs[i], affine, levels,
+                                                workspace=workspace),
+                            workspace) for i in order]
+        if all(e.shape == envs[0].shape for e in envs):
+            env = reduce_mats(torch.stack(envs, 1), workspace)
         else:
-            # Get the dimension of left and right bond indices
-            end_items = [contractable_list[i]for i in [0, -1]]
-            bond_strs = [item.bond_str for item in end_items]
-            bond_inds = [bs.index(c) for (bs, c) in zip(bond_strs, lin_bonds)]
-            bond_dims = [item.tensor.size(ind) for (item, ind) in
-                                               zip(end_items, bond_inds)]
-
-            # Build dummy end vectors and insert them at the ends of our list
-            end_vecs = [torch.zeros(dim) for dim in bond_dims]
-            for vec in end_vecs:
-                vec[0] = 1
-            contractable_list.insert(0, EdgeVec(end_vecs[0], is_left_vec=True))
-            contractable_list.append(EdgeVec(end_vecs[1], is_left_vec=False))
+            env = envs[0]
+            for next_env in envs[1:]:
+                env = torch.bmm(env, next_env)
+        core_str = 'bolr' if len(core.shape) == 4 else 'olr'
+        return torch.einsum(core_str + ',brl->bo', [core, env])
+
+    def split_modules(self, input_data):
+        """
+        Returns our modules, their inputs, and the position of the output core
+        """
+        modules = list(self.module_list)
+        mod_inputs = self.split_input(input_data)
+        out_num = [i for (i, module) in enumerate(modules)
+                   if isinstance(module, (OutputSite, MergedOutput))]
+        assert len(out_num) == 1
+
+        return modules, mod_inputs, out_num[0]
+
+    def sweep(self, input_data, affine=None, levels=None):
+        """
+        Contract input with our cores by sweeping in from both open edges
+
+        Boundary vectors are multiplied through the modules on either side of
+        our output core, starting at the open edges and moving inwards, before
+        being contracted with the output core. This gives the same output as
+        reducing a ContractableList with parallel_eval=False, but skips the
+        dummy edge vectors and the intermediate contractables
+
+        Args:
+            input_data (Tensor): Input with shape [batch_size, input_dim,
+                                                   feature_dim]
+        """
+        modules, mod_inputs, out_num = self.split_modules(input_data)
 
-            # Multiply together everything in contractable_list
-            contractable_list = ContractableList(contractable_list)
-            output = contractable_list.reduce(parallel_eval=parallel_eval)
+        # When renormalizing, keep track of the log norms of our vectors
+        if self.renormalize:
+            dtype = input_data.dtype if levels is None else levels.dtype
+            log_dtype = torch.promote_types(dtype, torch.float32)
+            log_norm = torch.zeros([input_data.size(0)], dtype=log_dtype,
+                                   device=input_data.device)
+        else:
+            log_norm = None
+
+        # Sweep in from the right edge first, then contract with output core
+        right_vec = None
+        for module, mod_input in zip(modules[:out_num:-1],
+                                     mod_inputs[:out_num:-1]):
+            right_vec, log_norm = self.sweep_module(module, mod_input,
+                                        right_vec, log_norm, from_left=False,
+                                        affine=affine, levels=levels)
+
+        core = modules[out_num].get_core(mod_inputs[out_num], affine,
+                                         levels)
+        if len(core.shape) == 3 and self.stream_sites:
+            # Avoid copying our output core across the batch index
+            if right_vec is None:
+                output = core[:, :, 0].unsqueeze(0).expand(
+                                        [input_data.size(0), -1, -1])
+            else:
+                output = torch.einsum('olr,br->bol', [core, right_vec])
+        else:
+            if len(core.shape) == 3:
+                core = core.unsqueeze(0).expand([input_data.size(0)] +
+                                                list(core.shape))
+            if right_vec is None:
+                output = core[:, :, :, 0]
+            else:
+                output = torch.einsum('bolr,br->bol', [core, right_vec])
+
+        # Sweep in from the left edge and contract with our output
+        left_vec = None
+        for module, mod_input in zip(modules[:out_num], mod_inputs[:out_num]):
+            left_vec, log_norm = self.sweep_module(module, mod_input,
+                                        left_vec, log_norm, from_left=True,
+                                        affine=affine, levels=levels)
+
+        if left_vec is None:
+            output = output[:, :, 0]
+        else:
+            output = torch.einsum('bl,bol->bo', [left_vec, output])
 
-            return output.tensor
+        return output if log_norm is None else (output, log_norm)
+
+    def sweep_module(self, module, mod_input, vec, log_norm, from_left,
+                     affine=None, levels=None):
+        """
+        Multiply a boundary vector through all the input cores of a module
+
+        Args:
+            module (Module):     Input module, such as an InputRegion
+            mod_input (Tensor):  The part of our input fed to module
+            vec (Tensor):        Boundary vectors with shape [batch_size, D],
+                                 or None at the open edges of our MPS
+            log_norm (Tensor):   Log norms of our boundary vectors with shape
+                                 [batch_size], or None if not renormalizing
+            from_left (bool):    Whether vec sits on the left of module
+            affine (tuple):      Coefficients of an affine feature map, when
+                                 mod_input is unembedded
+            levels (Tensor):     Embedded input levels, when mod_input holds
+                                 quantized or categorical input
+
+        Returns:
+            vec (Tensor),
+            log_norm (Tensor):   The updated boundary vectors and log norms
+        """
+        # Without gradients, mostly default input can skip over runs of
+        # default matrices
+        sparse = self.default_embedding is not None and \
+                 not torch.is_grad_enabled() and \
+                 hasattr(module, 'get_sparse_mats')
+
+        if self.stream_sites and not sparse and hasattr(module, 'stream'):
+            output = module.stream(mod_input, vec, from_left,
+                                   segment_size=self.segment_size,
+                                   log_norm=log_norm, affine=affine,
+                                   levels=levels)
+        else:
+            if sparse:
+                mats = module.get_sparse_mats(mod_input,
+                                              self.default_embedding,
+                                              affine, levels)
+            else:
+                mats = module.get_mats(mod_input, affine, levels,
+                                       workspace=self.workspace)
+
+            # In blocked mode, first multiply together blocks of matrices
+            block_size = self.block_size
+            if block_size == 'auto':
+                batch_size, num_mats, D = mats.shape[:3]
+                block_size = choose_block_size(batch_size, num_mats, D)
+            if block_size is not None and block_size > 1:
+                mats = block_mats(mats, block_size)
+
+            output = sweep_mats(mats, vec, from_left, log_norm=log_norm,
+                                workspace=self.workspace)
+
+        return output if log_norm is not None else (output, None)
+
+    def split_input(self, input_data):
+        """
+        Divide input_data into the pieces which are fed to each module
+
+        Modules taking a single input get a tensor with shape [batch_size,
+        feature_dim], while all others get a tensor with shape [batch_size,
+        len(module), feature_dim]
+        """
+        ind = 0
+        mod_inputs = []
+        for module in self.module_list:
+            mod_len = len(module)
+            if mod_len == 1:
+                mod_inputs.append(input_data[:, ind])
+            else:
+                mod_inputs.append(input_data[:, ind:(ind+mod_len)])
+            ind += mod_len
+
+        return mod_inputs
 
     def core_len(self):
         """
@@ -309,71 +958,505 @@ class LinearRegion(nn.Module):
 class MergedLinearRegion(LinearRegion):
     """
     Dynamic variant of LinearRegion that periodically rearranges its submodules
+
+    Setting async_merge makes each rearrangement run in a background thread,
+    starting from a snapshot of our cores, while the current cores keep being
+    used and trained. The result is installed at the start of a later forward
+    call, with at most max_staleness calls made in between (waiting for the
+    thread if needed). Any updates made to our cores between the
+    snapshot and its installation are discarded, since they live in a
+    different merge state than the one being installed
+
+    After each rearrangement, each bond is trimmed to drop the zero padding
+    left by truncated SVDs, and our cores are stored, trained and contracted
+    at these trimmed bond dimensions. The cores of a merged module can then
+    have different shapes, so each one is cut into runs of cores with the
+    same shape, which are still contracted together. Our cores are only
+    padded back out to bond_dim while being rearranged
+
+    Only the merged cores of our current merge state (offset) are stored,
+    in the single flat parameter self.core_store, and the modules in
+    self.module_list hold views of it which are rebuilt at each forward call.
+    When a rearrangement changes the size of our cores, self.core_store is
+    replaced by a new parameter, which is swapped into the optimizers passed
+    to register_optimizer. The state these optimizers hold for
+    self.core_store (such as momentum) is rearranged along with our cores,
+    while other optimizers have it swapped in at their next step, with their
+    state for it reset
+
+    Our offset and bond dimensions are saved in our state dict, and restored
+    whenever one is loaded. State dicts from older versions, which held the
+    merged cores of both offsets in module_list_0 and module_list_1, are
+    converted as they're loaded
     """
     def __init__(self, module_list, periodic_bc=False, parallel_eval=False,
-                 cutoff=1e-10, merge_threshold=2000):
+                 cutoff=1e-10, merge_threshold=2000, chunk_size=None,
+                 memory_budget=None, stream_sites=False, segment_size=None,
+                 block_size=None, renormalize=False, compute_dtype=None,
+                 svd_backend='full', oversample=10, async_merge=False,
+                 max_staleness=1):
         # Initialize a LinearRegion with our given module_list
-        super().__init__(module_list, periodic_bc, parallel_eval)
-
-        # Initialize attributes self.module_list_0 and self.module_list_1
-        # using the unmerged self.module_list, then redefine the latter in
-        # terms of one of the former lists
+        super().__init__(module_list, periodic_bc, parallel_eval,
+                         chunk_size=chunk_size, memory_budget=memory_budget,
+                         stream_sites=stream_sites, segment_size=segment_size,
+                         block_size=block_size, renormalize=renormalize,
+                         compute_dtype=compute_dtype)
+
+        # Record the types and shapes of the merged modules for each offset,
+        # which lets us rebuild either one when loading a state dict
+        unmerged_list = list(self.module_list)
+        with torch.no_grad():
+            merged_lists = [self.merge_modules(unmerged_list, offset)
+                            for offset in [0, 1]]
+        self.structures = [[module_structure(module) for module in merged_list]
+                           for merged_list in merged_lists]
+        self.bond_dim = max([max(core_view(module).shape[1:3])
+                             for module in merged_lists[0]])
+
+        # Our offset and bond dimensions (at the boundaries of each core) are
+        # kept in buffers, which lets them be restored from a state dict
+        self.register_buffer('merge_offset', torch.zeros([], dtype=torch.long))
+        self.register_buffer('core_bonds', torch.zeros(
+                                 self.core_len() + 1, dtype=torch.long))
+
+        # Start out using offset 0, whose trimmed cores fill our core store
+        tensor = merged_lists[0][0].tensor
+        self.core_store = nn.Parameter(torch.zeros([0], dtype=tensor.dtype,
+                                                   device=tensor.device))
         self.offset = 0
-        self.merge(offset=self.offset)
-        self.merge(offset=(self.offset+1)%2)
-        self.module_list = getattr(self, f"module_list_{self.offset}")
+        self.optimizers = []
+        with torch.no_grad():
+            self.install_cores(self.trim_modules(merged_lists[0]))
 
         # Initialize variables used during switching
         self.input_counter = 0
         self.merge_threshold = merge_threshold
         self.cutoff = cutoff
+        self.svd_backend = svd_backend
+        self.oversample = oversample
+        self.async_merge = async_merge
+        self.max_staleness = max_staleness
+        self.pending_merge = None
+        self.pending_items = []
+        self.pending_steps = 0
 
-    def forward(self, input_data):
+    def forward(self, input_data, affine=None, levels=None):
         """
-        Contract input with list of MPS cores and return result as contractable
+        Contract input with list of MPS cores and return the output tensor
 
         MergedLinearRegion keeps an input counter of the number of inputs, and
         when this exceeds its merge threshold, triggers an unmerging and
-        remerging of its parameter tensors.
+        remerging of its parameter tensors. The output is returned alongside
+        the new bond dimensions and singular values from the unmerging, both
+        of which are None if no unmerging took place.
 
         Args:
             input_data (Tensor): Input with shape [batch_size, input_dim,
                                                    feature_dim]
         """
+        # Install a finished (or overdue) background merge, then start a new
+        # one whenever we've hit our threshold
+        if self.async_merge:
+            bond_list, sv_list = self.install_merge()
+            if self.input_counter >= self.merge_threshold and \
+               self.pending_merge is None:
+                self.start_merge()
+                self.input_counter -= self.merge_threshold
+
         # If we've hit our threshold, flip the merge state of our tensors
-        if self.input_counter >= self.merge_threshold:
-            bond_list, sv_list = self.unmerge(cutoff=self.cutoff)
-            self.offset = (self.offset + 1) % 2
-            self.merge(offset=self.offset)
+        elif self.input_counter >= self.merge_threshold:
+            state_items = self.state_items()
+            with torch.no_grad():
+                self.bind_views()
+                rearrangement = self.rearrange(list(self.module_list),
+                                    (self.offset + 1) % 2,
+                                    [state[key] for state, key in state_items])
+            bond_list, sv_list = self.install_rearrangement(rearrangement,
+                                                            state_items)
             self.input_counter -= self.merge_threshold
-
-            # Point self.module_list to the appropriate merged module
-            self.module_list = getattr(self, f"module_list_{self.offset}")
         else:
             bond_list, sv_list = None, None
 
         # Increment our counter and call the LinearRegion's forward method
         self.input_counter += input_data.size(0)
-        output = super().forward(input_data)
+        self.bind_views()
+        output = super().forward(input_data, affine, levels)
+
+        return output, bond_list, sv_list
+
+    def register_optimizer(self, optimizer):
+        """
+        Rearrange the state optimizer holds for our core store with our cores
+
+        Only a weak reference to optimizer is kept
+        """
+        if any(optimizer_ref() is optimizer for optimizer_ref in
+               self.optimizers):
+            return
+        self.optimizers.append(weakref.ref(optimizer))
+
+    def state_items(self):
+        """
+        Returns the (state, key) pairs giving each tensor of optimizer state
+        which registered optimizers hold for our core store, and which has
+        one entry for each element of our cores
+        """
+        shape = self.core_store.shape
+        items = []
+        for optimizer_ref in self.optimizers:
+            optimizer = optimizer_ref()
+            if optimizer is None or self.core_store not in optimizer.state:
+                continue
+            state = optimizer.state[self.core_store]
+            items.extend([(state, key) for key, value in state.items()
+                          if torch.is_tensor(value) and value.shape == shape])
+        return items
+
+    def start_merge(self):
+        """
+        Start unmerging and remerging a snapshot of our cores in the background
+
+        The state of registered optimizers is included in the snapshot
+        """
+        state_items = self.state_items()
+        with torch.no_grad():
+            self.bind_views()
+            merged_list = copy.deepcopy(list(self.module_list))
+            states = [state[key].clone() for state, key in state_items]
+        new_offset = (self.offset + 1) % 2
+
+        def flip_merge_state():
+            return self.rearrange(merged_list, new_offset, states)
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.pending_merge = executor.submit(flip_merge_state)
+        self.pending_items = state_items
+        self.pending_steps = 0
+        executor.shutdown(wait=False)
+
+    def install_merge(self):
+        """
+        Swap in the cores from a background merge, if it's finished or overdue
+
+        Returns the new bond dimensions and singular values when a merge was
+        installed, and otherwise None, None
+        """
+        if self.pending_merge is None:
+            return None, None
+        if not self.pending_merge.done() and \
+           self.pending_steps < self.max_staleness:
+            self.pending_steps += 1
+            return None, None
+
+        rearrangement = self.pending_merge.result()
+        state_items = self.pending_items
+        self.pending_merge = None
+        self.pending_items = []
+
+        return self.install_rearrangement(rearrangement, state_items)
+
+    def rearrange(self, merged_list, offset, states=[]):
+        """
+        Unmerge a list of merged modules and merge them again with offset
+
+        Our cores are padded out to bond_dim while they're rearranged, and
+        the new cores are then trimmed as described in find_bonds. Each
+        tensor in states holds one entry for each element of the cores
+        in merged_list, laid out as in our core store, and is mapped to the
+        first order change in our new cores when the old ones change by it.
+        This holds fixed the singular vectors used to split each old core.
+        Tensors which are everywhere nonnegative (e.g. second moments) have
+        their square roots mapped instead, which keeps them nonnegative
+
+        Returns:
+            merged_list (list): Trimmed merged modules for offset
+            bond_list (list),
+            sv_list (list):     Bond dimensions and singular values found
+                                by unmerge_modules
+            states (list):      Tensors laid out as in the core store for
+                                the new merged_list
+        """
+        with torch.no_grad():
+            nonnegative = [bool(torch.all(state >= 0)) for state in states]
+            states = [state.sqrt() if nonneg else state
+                      for state, nonneg in zip(states, nonnegative)]
+
+            # Pad our cores and states, which lets the cores of each merged
+            # module be split together, then put back together once unmerged
+            states = [pad_flat(state, merged_list, self.bond_dim)
+                      for state in states]
+            merged_list = [pad_module(module, self.bond_dim)
+                           for module in merged_list]
+            unmerged_list, bond_list, sv_list, state_lists = \
+                self.unmerge_modules(merged_list, self.cutoff,
+                                     self.svd_backend, self.oversample, states)
+            new_list = self.merge_modules(unmerged_list, offset)
+
+            # Merging is bilinear in neighboring cores, so the change in our
+            # merged cores is half the difference of merging our cores plus
+            # and minus each change. This is done in double precision, to
+            # keep the error from cancellation small
+            new_states = []
+            for state, state_list, nonneg in zip(states, state_lists,
+                                                 nonnegative):
+                shifted_lists = [[module_like(core, core.tensor.double() +
+                                              sign * delta.tensor.double())
+                                  for core, delta in zip(unmerged_list,
+                                                         state_list)]
+                                 for sign in [1, -1]]
+                plus_list, minus_list = [self.merge_modules(shifted, offset)
+                                         for shifted in shifted_lists]
+                new_state = torch.cat([(plus.tensor - minus.tensor).reshape(-1)
+                                       for plus, minus in zip(plus_list,
+                                                              minus_list)])
+                new_state = (new_state / 2).to(state.dtype)
+                new_states.append(new_state ** 2 if nonneg else new_state)
+
+            # Trim our new cores, and each state along with them
+            bonds = self.find_bonds(new_list)
+            new_states = [cut_flat(new_state, new_list, bonds)
+                          for new_state in new_states]
+            new_list = cut_modules(new_list, bonds)
+
+        return new_list, bond_list, sv_list, new_states
+
+    def install_rearrangement(self, rearrangement, state_items):
+        """
+        Switch to the merged modules for our next offset given by rearrange
+
+        Args:
+            rearrangement (tuple):  The output of rearrange
+            state_items (list):     The (state, key) pairs of the optimizer
+                                    state given to rearrange, whose values
+                                    are replaced by the rearranged ones. Any
+                                    other optimizer state which was laid out
+                                    as in our core store is reset to zero
+
+        Returns:
+            bond_list (list),
+            sv_list (list):         Bond dimensions and singular values found
+                                    when unmerging
+        """
+        merged_list, bond_list, sv_list, new_states = rearrangement
+        new_states = {(id(state), key): new_state for (state, key), new_state
+                      in zip(state_items, new_states)}
+        old_items = self.state_items()
+
+        self.flip_offset()
+        self.install_cores(merged_list)
 
-        # If we flipped our merge state, then return the bond_list and output
-        if bond_list:
-            return output, bond_list, sv_list
+        for state, key in old_items:
+            new_state = new_states.get((id(state), key))
+            if new_state is None:
+                new_state = torch.zeros_like(self.core_store)
+            state[key] = new_state.to(self.core_store.device)
+
+        return bond_list, sv_list
+
+    def flip_offset(self):
+        """
+        Switch to the other merge offset, recording it in self.merge_offset
+        """
+        self.offset = (self.offset + 1) % 2
+        self.merge_offset.fill_(self.offset)
+
+    def install_cores(self, merged_list):
+        """
+        Copy a list of merged modules into our core store and use them as our
+        modules
+
+        The modules' own tensors are replaced by views of the core store,
+        which is replaced by a new parameter (see replace_store) when its size
+        changes. The bond dimensions of the modules are recorded in
+        self.core_bonds
+        """
+        core_store = self.core_store
+        with torch.no_grad():
+            cores = torch.cat([module.tensor.reshape(-1)
+                               for module in merged_list])
+            cores = cores.to(dtype=core_store.dtype, device=core_store.device)
+            if cores.shape == core_store.shape:
+                core_store.copy_(cores)
+            else:
+                self.replace_store(nn.Parameter(cores, requires_grad=
+                                                core_store.requires_grad))
+
+            self.core_bonds.zero_()
+            self.core_bonds[core_positions(merged_list)] = \
+                self.core_bonds.new_tensor(module_bonds(merged_list))
+
+        for module in merged_list:
+            if isinstance(module.tensor, nn.Parameter):
+                tensor = module.tensor.detach()
+                del module.tensor
+                module.tensor = tensor
+        self.module_list = nn.ModuleList(merged_list)
+        self.bind_views()
+
+    def replace_store(self, core_store):
+        """
+        Swap in a new parameter of a different size for our core store
+
+        Autograd graphs built from our old core store still expect its old
+        size, so it can't be resized in place. Registered optimizers have our
+        old core store replaced by the new one in their parameter groups, and
+        their state for it moved over, with each tensor of state laid out as
+        in our core store reset to zero. Other optimizers have it replaced
+        when they next take a step, as described in adopt_store
+        """
+        old_store = self.core_store
+        self.core_store = core_store
+        for optimizer_ref in self.optimizers:
+            optimizer = optimizer_ref()
+            if optimizer is None:
+                continue
+            for group in optimizer.param_groups:
+                group['params'] = [core_store if param is old_store else param
+                                   for param in group['params']]
+            if old_store not in optimizer.state:
+                continue
+
+            # Keep the same state dict, which rearranged state is written to
+            state = optimizer.state.pop(old_store)
+            for key, value in state.items():
+                if torch.is_tensor(value) and value.shape == old_store.shape:
+                    state[key] = torch.zeros_like(core_store)
+            optimizer.state[core_store] = state
+        retire_store(old_store, self)
+
+    def bind_views(self):
+        """
+        Point the tensor of each merged module to its part of our core store
+
+        This is done at each forward call, so that gradients flow back to our
+        core store, and so that our modules follow it to new devices or dtypes
+        """
+        modules = list(self.module_list)
+        for module, tensor in zip(modules, split_flat(self.core_store,
+                                                      modules)):
+            module.tensor = tensor
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        """
+        Switch to the offset and bond dimensions given by a state dict
+
+        Our core store is resized to hold the cores of the loaded offset, cut
+        to the loaded bond dimensions, before they're copied in. Any pending
+        background merge started from our old cores is dropped, and started
+        again by the next forward call
+        """
+        if f"{prefix}module_list_0.0.tensor" in state_dict:
+            self.convert_legacy_state(state_dict, prefix)
+
+        offset_key = f"{prefix}merge_offset"
+        if offset_key in state_dict:
+            if self.pending_merge is not None:
+                self.pending_merge = None
+                self.pending_items = []
+                self.input_counter += self.merge_threshold
+
+            self.offset = int(state_dict[offset_key])
+            merged_list = [build_module(module_type, left_output,
+                                        self.core_store.new_zeros(shape))
+                           for module_type, left_output, shape in
+                           self.structures[self.offset]]
+            core_bonds = state_dict[f"{prefix}core_bonds"]
+            bonds = core_bonds[core_positions(merged_list)].tolist()
+            with torch.no_grad():
+                self.install_cores(cut_modules(merged_list, bonds))
+
+        super()._load_from_state_dict(state_dict, prefix, local_metadata,
+                                      strict, missing_keys, unexpected_keys,
+                                      error_msgs)
+        with torch.no_grad():
+            self.bind_views()
+
+    def convert_legacy_state(self, state_dict, prefix):
+        """
+        Convert a state dict saved before our cores were kept in a core store
+
+        These hold the merged cores of each offset in module_list_0 and
+        module_list_1, along with those of the offset in use at the time in
+        module_list, which tells us that offset. Its cores are put into a
+        core store in place of all three lists, with bonds trimmed as usual
+        """
+        merged_lists = [[state_dict.pop(f"{prefix}module_list_{offset}."
+                                        f"{i}.tensor")
+                         for i in range(len(self.structures[offset]))]
+                        for offset in [0, 1]]
+        list_prefix = f"{prefix}module_list."
+        current = [state_dict.pop(key) for key in list(state_dict)
+                   if key.startswith(list_prefix)]
+        offset = int(len(current) != len(merged_lists[0]) or
+                     not all(torch.equal(tensor, old_tensor) for tensor,
+                             old_tensor in zip(current, merged_lists[0])))
+
+        with torch.no_grad():
+            self.install_cores(self.trim_modules([build_module(module_type,
+                                                    left_output, tensor)
+                               for (module_type, left_output, _), tensor in
+                               zip(self.structures[offset],
+                                   merged_lists[offset])]))
+
+        state_dict[f"{prefix}core_store"] = self.core_store.detach().clone()
+        state_dict[f"{prefix}merge_offset"] = torch.tensor(offset)
+        state_dict[f"{prefix}core_bonds"] = self.core_bonds.clone()
+
+    def find_bonds(self, merged_list):
+        """
+        Returns the trimmed bond dimensions of a list of merged modules
+
+        Each bond is trimmed to drop trailing indices where the cores on either
+        side of it are zero, which leaves the output of our contraction
+        unchanged. Bonds at open edges only ever use their first index
+
+        Returns:
+            bonds (list):   The dimension of the bond to the left of each
+                            core in merged_list, followed by that of the bond
+                            to the right of the last one
+        """
+        lefts, rights = [], []
+        for module in merged_list:
+            lefts.extend(bond_extents(module, right=False))
+            rights.extend(bond_extents(module, right=True))
+
+        # Each bond is shared by a pair of neighboring cores
+        bonds = [min(right, left) for right, left in zip(rights[:-1],
+                                                          lefts[1:])]
+        if self.periodic_bc:
+            edge_dim = min(rights[-1], lefts[0])
         else:
-            return output
+            edge_dim = 1
+        return [edge_dim] + bonds + [edge_dim]
+
+    def trim_modules(self, merged_list):
+        """
+        Returns a list of merged modules cut down to their trimmed bonds
+        """
+        return cut_modules(merged_list, self.find_bonds(merged_list))
 
     def merge(self, offset):
         """
         Convert unmerged modules in self.module_list to merged counterparts
 
-        This proceeds by first merging all unmerged cores internally, then
-        merging lone cores when possible during a second sweep
+        The merged cores are trimmed and copied into our core store, which
+        then holds the tensors of our new self.module_list
         """
         assert offset in [0, 1]
 
         with torch.no_grad():
-            unmerged_list = self.module_list
+            merged_list = self.merge_modules(self.module_list, offset)
+            self.install_cores(self.trim_modules(merged_list))
+
+    def merge_modules(self, unmerged_list, offset):
+        """
+        Returns a list of merged counterparts of a list of unmerged modules
 
+        This proceeds by first merging all unmerged cores internally, then
+        merging lone cores when possible during a second sweep
+        """
+        with torch.no_grad():
             # Merge each core internally and add the results to midway_list
             site_num = offset
             merged_list = []
@@ -425,79 +1508,70 @@ class MergedLinearRegion(LinearRegion):
                 else:
                     merged_list = combined_list
 
-            # Finally, update the appropriate merged module list
-            list_name = f"module_list_{offset}"
-            # If the merged module list hasn't been set yet, initialize it
-            if not hasattr(self, list_name):
-                setattr(self, list_name, nn.ModuleList(merged_list))
+            return merged_list
 
-            # Otherwise, do an in-place update so that all tensors remain
-            # properly registered with whatever optimizer we use
-            else:
-                module_list = getattr(self, list_name)
-                assert len(module_list) == len(merged_list)
-                for i in range(len(module_list)):
-                    assert module_list[i].tensor.shape == \
-                           merged_list[i].tensor.shape
-                    module_list[i].tensor[:] = merged_list[i].tensor
-
-    def unmerge(self, cutoff=1e-10):
+    def unmerge(self, cutoff=1e-10, svd_backend='full', oversample=10):
         """
         Convert merged modules to unmerged counterparts
 
         This proceeds by first unmerging all merged cores internally, then
-        combining lone cores where possible
+        combining lone cores where possible. The SVDs used to split merged
+        cores are computed with svd_backend, as described in svd_flex
         """
         with torch.no_grad():
-            list_name = f"module_list_{self.offset}"
-            merged_list = getattr(self, list_name)
+            merged_list = [pad_module(module, self.bond_dim)
+                           for module in self.module_list]
+        unmerged_list, bond_list, sv_list, _ = self.unmerge_modules(
+            merged_list, cutoff, svd_backend, oversample)
 
+        # Add our unmerged module list as a new attribute and return
+        # the updated bond dimensions
+        self.module_list = nn.ModuleList(unmerged_list)
+        return bond_list, sv_list
+
+    def unmerge_modules(self, merged_list, cutoff=1e-10, svd_backend='full',
+                        oversample=10, states=[]):
+        """
+        Returns a list of unmerged counterparts of a list of merged modules,
+        along with the new bond dimensions and singular values
+
+        Each tensor in states is laid out as in the core store for
+        merged_list, and is split up alongside our cores, as given by the
+        unmerge_state method of each merged module. The resulting lists of
+        unmerged modules are returned last
+        """
+        with torch.no_grad():
             # Unmerge each core internally and add results to unmerged_list
             unmerged_list, bond_list, sv_list = [], [-1], [-1]
-            for core in merged_list:
+            state_parts = [split_flat(state, merged_list) for state in states]
+            state_lists = [[] for state in states]
+            for i, core in enumerate(merged_list):
+                core_states = [parts[i] for parts in state_parts]
 
                 # Apply internal unmerging routine if our core supports it
                 if hasattr(core, 'unmerge'):
-                    new_cores, new_bonds, new_svs = core.unmerge(cutoff)
+                    new_cores, new_bonds, new_svs = core.unmerge(cutoff,
+                                                    svd_backend, oversample)
                     unmerged_list.extend(new_cores)
                     bond_list.extend(new_bonds[1:])
                     sv_list.extend(new_svs[1:])
+                    for state_list, state in zip(state_lists, core_states):
+                        state_list.extend(core.unmerge_state(state,
+                                                             new_cores))
                 else:
                     assert not isinstance(core, InputRegion)
-                    unmerged_list.append(core)
+                    unmerged_list.append(module_like(core,
+                                                     core.tensor.clone()))
                     bond_list.append(-1)
                     sv_list.append(-1)
+                    for state_list, state in zip(state_lists, core_states):
+                        state_list.append(module_like(core, state))
 
-            # Combine all combinable pairs of cores. This occurs in several
-            # passes, and for now acts nontrivially only on InputSite instances
-            while True:
-                mod_num = 0
-                combined_list = []
-
-                while mod_num < len(unmerged_list) - 1:
-                    left_core, right_core = unmerged_list[mod_num: mod_num+2]
-                    new_core = self.combine(left_core, right_core,
-                                                       merging=False)
-
-                    # If cores aren't combinable, move our sliding window by 1
-                    if new_core is None:
-                        combined_list.append(left_core)
-                        mod_num += 1
-                    # If we get something new, move to the next distinct pair
-                    else:
-                        combined_list.append(new_core)
-                        mod_num += 2
-
-                    # Add the last core if there's nothing to combine it with
-                    if mod_num == len(unmerged_list)-1:
-                        combined_list.append(unmerged_list[mod_num])
-                        mod_num += 1
-
-                # We're finished when unmerged_list remains unchanged
-                if len(combined_list) == len(unmerged_list):
-                    break
-                else:
-                    unmerged_list = combined_list
+            # Combine all combinable pairs of cores, which only depends on
+            # the types of our modules, so is the same for each state list
+            unmerged_list = self.combine_modules(unmerged_list)
+            state_lists = [self.combine_modules(state_list)
+                           for state_list in state_lists]
 
             # Find the average (log) norm of all of our cores
             log_norms = []
@@ -506,15 +1580,48 @@ class MergedLinearRegion(LinearRegion):
             log_scale = sum([sum(ns) for ns in log_norms])
             log_scale /= sum([len(ns) for ns in log_norms])
 
-            # Now rescale all cores so that their norms are roughly equal
+            # Now rescale all cores so that their norms are roughly equal,
+            # along with the matching parts of each state
             scales = [[torch.exp(log_scale-n) for n in ns] for ns in log_norms]
-            for core, these_scales in zip(unmerged_list, scales):
-                core.rescale_norm(these_scales)
+            for modules in [unmerged_list] + state_lists:
+                for core, these_scales in zip(modules, scales):
+                    core.rescale_norm(these_scales)
+
+            return unmerged_list, bond_list, sv_list, state_lists
+
+    def combine_modules(self, unmerged_list):
+        """
+        Returns a list of unmerged modules with all combinable pairs combined
 
-            # Add our unmerged module list as a new attribute and return
-            # the updated bond dimensions
-            self.module_list = nn.ModuleList(unmerged_list)
-            return bond_list, sv_list
+        This occurs in several passes, and for now acts nontrivially only on
+        InputSite instances
+        """
+        while True:
+            mod_num = 0
+            combined_list = []
+
+            while mod_num < len(unmerged_list) - 1:
+                left_core, right_core = unmerged_list[mod_num: mod_num+2]
+                new_core = self.combine(left_core, right_core, merging=False)
+
+                # If cores aren't combinable, move our sliding window by 1
+                if new_core is None:
+                    combined_list.append(left_core)
+                    mod_num += 1
+                # If we get something new, move to the next distinct pair
+                else:
+                    combined_list.append(new_core)
+                    mod_num += 2
+
+                # Add the last core if there's nothing to combine it with
+                if mod_num == len(unmerged_list)-1:
+                    combined_list.append(unmerged_list[mod_num])
+                    mod_num += 1
+
+            # We're finished when unmerged_list remains unchanged
+            if len(combined_list) == len(unmerged_list):
+                return unmerged_list
+            unmerged_list = combined_list
 
     def combine(self, left_core, right_core, merging):
         """
@@ -539,19 +1646,18 @@ class MergedLinearRegion(LinearRegion):
                                                             right_core.tensor])
             return MergedOutput(new_tensor, left_output=(not left_site))
 
-        # Combine an InputRegion with a stray InputSite, return an InputRegion
-        elif not merging and ((isinstance(left_core, InputRegion) and
-                               isinstance(right_core, InputSite)) or
-                                    (isinstance(left_core, InputSite) and
-                                    isinstance(right_core, InputRegion))):
+        # Combine an InputRegion with a stray InputSite or another
+        # InputRegion (from a cut up MergedInput), return an InputRegion
+        elif not merging and isinstance(left_core, (InputRegion, InputSite)) \
+                         and isinstance(right_core, (InputRegion, InputSite)) \
+                         and (isinstance(left_core, InputRegion) or
+                              isinstance(right_core, InputRegion)):
 
-            left_site = isinstance(left_core, InputSite)
-            if left_site:
-                left_tensor = left_core.tensor.unsqueeze(0)
-                right_tensor = right_core.tensor
-            else:
-                left_tensor = left_core.tensor
-                right_tensor = right_core.tensor.unsqueeze(0)
+            left_tensor, right_tensor = left_core.tensor, right_core.tensor
+            if isinstance(left_core, InputSite):
+                left_tensor = left_tensor.unsqueeze(0)
+            if isinstance(right_core, InputSite):
+                right_tensor = right_tensor.unsqueeze(0)
 
             assert left_tensor.shape[1:] == right_tensor.shape[1:]
             new_tensor = torch.cat([left_tensor, right_tensor])
@@ -574,6 +1680,33 @@ class MergedLinearRegion(LinearRegion):
         """
         return sum([len(module) for module in self.module_list])
 
+    def __getstate__(self):
+        # Background merges can't be copied or pickled, so drop any pending
+        # merge and let the next forward call start it again. Optimizers
+        # aren't copied along with us, so they're dropped too
+        state = self.__dict__.copy()
+        if state['pending_merge'] is not None:
+            state['pending_merge'] = None
+            state['pending_items'] = []
+            state['input_counter'] += self.merge_threshold
+        state['optimizers'] = []
+
+        # Views of our core store can't be copied while they're part of an
+        # autograd graph, so copy detached views which get rebound later
+        modules = []
+        for module in self.module_list:
+            module = copy.copy(module)
+            module.tensor = module.tensor.detach()
+            modules.append(module)
+        state['_modules'] = dict(state['_modules'],
+                                 module_list=nn.ModuleList(modules))
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        with torch.no_grad():
+            self.bind_views()
+
 class InputRegion(nn.Module):
     """
     Contiguous region of MPS cores taking in multiple input data, bond_str = 'slri'
@@ -585,7 +1718,7 @@ class InputRegion(nn.Module):
         # Register our tensor as a Pytorch Parameter
         self.tensor = nn.Parameter(tensor.contiguous())
 
-    def forward(self, input_data):
+    def forward(self, input_data, affine=None, levels=None):
         """
         Contract input with MPS cores and return result as a MatRegion
 
@@ -593,16 +1726,175 @@ class InputRegion(nn.Module):
             input_data (Tensor): Input with shape [batch_size, input_dim,
                                                    feature_dim]
         """
+        return MatRegion(self.get_mats(input_data, affine, levels))
+
+    def get_mats(self, input_data, affine=None, levels=None, workspace=None):
+        """
+        Contract input with MPS cores and return the resultant matrices
+
+        Args:
+            input_data (Tensor): Input with shape [batch_size, input_dim,
+                                                   feature_dim]
+            affine (tuple):      Coefficients (a, c) of an affine feature map,
+                                 x -> a + x*c, in which case input_data is
+                                 unembedded and has no feature_dim index
+            levels (Tensor):     Embedded input levels, with shape
+                                 [num_levels, feature_dim], in which case
+                                 input_data holds the level of each input
+            workspace (Workspace): Arena holding a reusable buffer for our
+                                 output when gradients aren't needed. The
+                                 output is then overwritten by the next call
+                                 given the same workspace
+
+        Returns:
+            mats (Tensor):       Matrices with shape [batch_size, input_dim,
+                                                      D_l, D_r]
+        """
+        # For quantized input, gather the matrices for each input level
+        if levels is not None:
+            assert len(input_data.shape) == 2
+            assert input_data.size(1) == len(self)
+            table = level_table(self, levels)
+            num_sites, D_l, D_r = table.shape[1:]
+
+            # Keep the matrices for each site contiguous, for fast sweeping
+            sites = torch.arange(num_sites, device=input_data.device)
+            index = input_data.t() * num_sites + sites[:, None]
+            table = table.view([-1, D_l, D_r])
+            out = mats_buffer(workspace, [index.numel(), D_l, D_r],
+                              table.dtype, table.device)
+            mats = torch.index_select(table, 0, index.flatten(), out=out)
+            mats = mats.view([num_sites, -1, D_l, D_r])
+            return mats.transpose(0, 1)
+
+        # For affine feature maps, add input-weighted deltas to base matrices
+        if affine is not None:
+            assert len(input_data.shape) == 2
+            assert input_data.size(1) == len(self)
+            base, delta = affine_parts(self, affine, input_data.dtype)
+
+            # Keep the matrices for each site contiguous, for fast sweeping
+            num_sites, D_l, D_r = base.shape
+            out = mats_buffer(workspace,
+                              [num_sites, input_data.size(0), D_l, D_r],
+                              base.dtype, base.device)
+            mats = torch.addcmul(base.unsqueeze(1),
+                                 input_data.t().contiguous()[:, :, None, None],
+                                 delta.unsqueeze(1), out=out)
+            return mats.transpose(0, 1)
+
         # Check that input_data has the correct shape
-        tensor = self.tensor
+        tensor = self.tensor.to(input_data.dtype)
         assert len(input_data.shape) == 3
         assert input_data.size(1) == len(self)
         assert input_data.size(2) == tensor.size(3)
 
         # Contract the input with our core tensor
-        mats = torch.einsum('slri,bsi->bslr', [tensor, input_data])
+        num_sites, D_l, D_r, feature_dim = tensor.shape
+        out = mats_buffer(workspace,
+                          [num_sites, input_data.size(0), D_l, D_r],
+                          tensor.dtype, tensor.device)
+        if out is None:
+            return torch.einsum('slri,bsi->bslr', [tensor, input_data])
+
+        # With a buffer, do a single bmm over sites into site-major matrices
+        tensor = tensor.permute(0, 3, 1, 2).reshape([num_sites, feature_dim,
+                                                     D_l * D_r])
+        torch.bmm(input_data.transpose(0, 1), tensor,
+                  out=out.view([num_sites, -1, D_l * D_r]))
+        return out.transpose(0, 1)
+
+    def get_sparse_mats(self, input_data, default_embedding, affine=None,
+                        levels=None):
+        """
+        Return matrices whose product equals that of our input matrices
+
+        Inputs equal to default_embedding all give the same matrix at each
+        site, and products of these over ranges of sites are cached until our
+        cores are next modified. Each run of default inputs is then replaced
+        by a few of these range products, so that for mostly default input,
+        far fewer matrices are needed than there are sites. Only for use
+        when gradients aren't needed
+
+        Args:
+            input_data (Tensor):        Input with shape [batch_size,
+                                        input_dim, feature_dim]
+            default_embedding (Tensor): Embedded default input, with shape
+                                        [feature_dim]
+            affine (tuple):             Coefficients of an affine feature
+                                        map, used to embed input_data
+            levels (Tensor):            Embedded input levels, used to embed
+                                        quantized input_data
+
+        Returns:
+            mats (Tensor):              Matrices with shape [batch_size,
+                                        num_steps, D_l, D_r], where shorter
+                                        products are padded with identities
+        """
+        if affine is not None:
+            input_data = embed_affine(input_data, affine)
+        if levels is not None:
+            input_data = embed_levels(input_data, levels)
+        tensor = self.tensor.to(input_data.dtype)
+        assert len(input_data.shape) == 3
+        assert input_data.size(1) == len(self)
+        assert input_data.size(2) == tensor.size(3)
+
+        default_embedding = default_embedding.to(device=input_data.device,
+                                                 dtype=input_data.dtype)
+        nondefault = (input_data != default_embedding).any(2)
+        schedule = jump_schedule(nondefault)
+
+        # Only contract the non-default inputs with (cached) slices of our
+        # cores, which are much faster to gather than the cores themselves
+        batch_inds, site_inds = nondefault.nonzero(as_tuple=True)
+        inputs = input_data[batch_inds, site_inds]
+        slices = contract_features(self, torch.eye(tensor.size(3)),
+                                   input_data.dtype, 'slice_cache', 'eye')
+        mats = torch.index_select(slices[0], 0, site_inds)
+        mats.mul_(inputs[:, 0, None, None])
+        for core_slice, feature in zip(slices[1:], inputs[:, 1:].t()):
+            mats.addcmul_(torch.index_select(core_slice, 0, site_inds),
+                          feature[:, None, None])
+
+        # Look up the matrices for every step in all of our candidates
+        jumps = default_jumps(self, default_embedding)
+        D_l, D_r = tensor.shape[1:3]
+        identity = torch.eye(D_l, D_r, dtype=mats.dtype, device=mats.device)
+        mats = torch.cat([jumps.view([-1, D_l, D_r]), identity[None], mats])
+        mats = torch.index_select(mats, 0, schedule.flatten())
+        return mats.view(list(schedule.shape) + [D_l, D_r])
+
+    def stream(self, input_data, vec, from_left, segment_size=None,
+               log_norm=None, affine=None, levels=None):
+        """
+        Multiply a boundary vector through our cores, one site at a time
+
+        Args:
+            input_data (Tensor):  Input with shape [batch_size, input_dim,
+                                                    feature_dim]
+            vec (Tensor):         Boundary vectors with shape [batch_size, D],
+                                  or None at the open edges of our MPS
+            from_left (bool):     Whether vec sits on the left of our cores
+            segment_size (int):   Number of sites in each checkpointed segment
+            log_norm (Tensor):    Log norms of our boundary vectors, or None
+                                  if not renormalizing
+            affine (tuple):       Coefficients of an affine feature map, used
+                                  to embed unembedded input_data
+            levels (Tensor):      Embedded input levels, used to embed
+                                  quantized input_data
+        """
+        if affine is not None:
+            input_data = embed_affine(input_data, affine)
+        if levels is not None:
+            input_data = embed_levels(input_data, levels)
+        tensor = self.tensor.to(input_data.dtype)
+        assert len(input_data.shape) == 3
+        assert input_data.size(1) == len(self)
+        assert input_data.size(2) == tensor.size(3)
 
-        return MatRegion(mats)
+        return stream_cores(tensor, input_data, vec, from_left, segment_size,
+                            log_norm=log_norm)
 
     def merge(self, offset):
         """
@@ -684,14 +1976,15 @@ class MergedInput(nn.Module):
     Contiguous region of merged MPS cores, each taking in a pair of input data
 
     Since MergedInput arises after contracting together existing input cores,
-    a merged input tensor is required for initialization
+    a merged input tensor is required for initialization. Several cores are
+    multiplied together, so must be square, unless we only hold one core
     """
     def __init__(self, tensor):
         # Check that our input tensor has the correct shape
         bond_str = 'slrij'
         shape = tensor.shape
         assert len(shape) == 5
-        assert shape[1] == shape[2]
+        assert shape[0] == 1 or shape[1] == shape[2]
         assert shape[3] == shape[4]
 
         super().__init__()
@@ -699,7 +1992,7 @@ class MergedInput(nn.Module):
         # Register our tensor as a Pytorch Parameter
         self.tensor = nn.Parameter(tensor.contiguous())
 
-    def forward(self, input_data):
+    def forward(self, input_data, affine=None, levels=None):
         """
         Contract input with merged MPS cores and return result as a MatRegion
 
@@ -708,8 +2001,39 @@ class MergedInput(nn.Module):
                                  feature_dim], where input_dim must be even
                                  (each merged core takes 2 inputs)
         """
+        return MatRegion(self.get_mats(input_data, affine, levels))
+
+    def get_mats(self, input_data, affine=None, levels=None, workspace=None):
+        """
+        Contract input with merged MPS cores and return resultant matrices
+
+        Args:
+            input_data (Tensor): Input with shape [batch_size, input_dim,
+                                 feature_dim], where input_dim must be even
+                                 (each merged core takes 2 inputs)
+            affine (tuple):      Coefficients of an affine feature map, used
+                                 to embed unembedded input_data. Since our
+                                 cores take pairs of inputs, which enter
+                                 quadratically, there's no fast path here
+            levels (Tensor):     Embedded input levels, used to embed
+                                 quantized input_data. Lookup tables for
+                                 pairs of inputs would need num_levels ** 2
+                                 entries per core, so aren't used here
+            workspace (Workspace): Arena holding reusable buffers for our
+                                 output and for the products of each pair of
+                                 inputs when gradients aren't needed
+
+        Returns:
+            mats (Tensor):       Matrices with shape [batch_size,
+                                 input_dim // 2, D_l, D_r]
+        """
+        if affine is not None:
+            input_data = embed_affine(input_data, affine)
+        if levels is not None:
+            input_data = embed_levels(input_data, levels)
+
         # Check that input_data has the correct shape
-        tensor = self.tensor
+        tensor = self.tensor.to(input_data.dtype)
         assert len(input_data.shape) == 3
         assert input_data.size(1) == len(self)
         assert input_data.size(2) == tensor.size(3)
@@ -718,40 +2042,120 @@ class MergedInput(nn.Module):
         # Divide input_data into inputs living on even and on odd sites
         inputs = [input_data[:, 0::2], input_data[:, 1::2]]
 
-        # Contract the odd (right-most) and even inputs with merged cores
-        tensor = torch.einsum('slrij,bsj->bslri', [tensor, inputs[1]])
-        mats = torch.einsum('bslri,bsi->bslr', [tensor, inputs[0]])
+        # Take the outer product of the even and odd (right-most) inputs at
+        # each site, then contract these with our merged cores in a single
+        # bmm over sites, which gives site-major matrices
+        num_sites, D_l, D_r, feature_dim = tensor.shape[:4]
+        batch_size = input_data.size(0)
+        out = mats_buffer(workspace, [num_sites, batch_size, D_l, D_r],
+                          tensor.dtype, tensor.device)
+        pairs = None
+        if out is not None:
+            pairs = workspace.get('pair_inputs', [num_sites, batch_size,
+                                                  feature_dim, feature_dim],
+                                  tensor.dtype, tensor.device)
+            out = out.view([num_sites, batch_size, D_l * D_r])
+        pairs = torch.mul(inputs[0].transpose(0, 1).unsqueeze(3),
+                          inputs[1].transpose(0, 1).unsqueeze(2), out=pairs)
+        tensor = tensor.permute(0, 3, 4, 1, 2).reshape([num_sites,
+                                                        feature_dim ** 2,
+                                                        D_l * D_r])
+        mats = torch.bmm(pairs.view([num_sites, batch_size, -1]), tensor,
+                         out=out)
+        return mats.view([num_sites, batch_size, D_l, D_r]).transpose(0, 1)
+
+    def stream(self, input_data, vec, from_left, segment_size=None,
+               log_norm=None, affine=None, levels=None):
+        """
+        Multiply a boundary vector through our cores, one site at a time
+
+        Each pair of inputs is combined into a single input living in the
+        product of both feature spaces before streaming through our cores
 
-        return MatRegion(mats)
+        Args:
+            input_data (Tensor):  Input with shape [batch_size, input_dim,
+                                                    feature_dim]
+            vec (Tensor):         Boundary vectors with shape [batch_size, D],
+                                  or None at the open edges of our MPS
+            from_left (bool):     Whether vec sits on the left of our cores
+            segment_size (int):   Number of sites in each checkpointed segment
+            log_norm (Tensor):    Log norms of our boundary vectors, or None
+                                  if not renormalizing
+            affine (tuple):       Coefficients of an affine feature map, used
+                                  to embed unembedded input_data
+            levels (Tensor):      Embedded input levels, used to embed
+                                  quantized input_data
+        """
+        if affine is not None:
+            input_data = embed_affine(input_data, affine)
+        if levels is not None:
+            input_data = embed_levels(input_data, levels)
+        tensor = self.tensor.to(input_data.dtype)
+        assert len(input_data.shape) == 3
+        assert input_data.size(1) == len(self)
+        assert input_data.size(2) == tensor.size(3)
+
+        num_cores, D_l, D_r, d = tensor.shape[:4]
+        pair_inputs = torch.einsum('bsi,bsj->bsij', [input_data[:, 0::2],
+                                                     input_data[:, 1::2]])
+        pair_inputs = pair_inputs.reshape([-1, num_cores, d * d])
+        cores = tensor.reshape([num_cores, D_l, D_r, d * d])
+
+        return stream_cores(cores, pair_inputs, vec, from_left, segment_size,
+                            log_norm=log_norm)
 
-    def unmerge(self, cutoff=1e-10):
+    def unmerge(self, cutoff=1e-10, svd_backend='full', oversample=10):
         """
         Separate the cores in our MergedInput and return an InputRegion
 
         The length of the resultant InputRegion will be identical to our
         original MergedInput (same number of inputs), but its core_len will
-        be doubled (twice as many individual cores)
+        be doubled (twice as many individual cores). All cores are split
+        together, using one batched SVD
         """
         bond_str = 'slrij'
         tensor = self.tensor
-        svd_string = 'lrij->lui,urj'
-        max_D = tensor.size(1)
-
-        # Split every one of the cores into two and add them both to core_list
-        core_list, bond_list, sv_list = [], [-1], [-1]
-        for merged_core in tensor:
-            sv_vec = torch.empty(max_D)
-            left_core, right_core, bond_dim = svd_flex(merged_core, svd_string,
-                                              max_D, cutoff, sv_vec=sv_vec)
-
-            core_list += [left_core, right_core]
+        svd_string = 'slrij->slui,surj'
+        num_cores, max_D = tensor.shape[:2]
+
+        # Split every one of the cores into two at once, then interleave them
+        sv_vecs = torch.empty([num_cores, max_D])
+        left_cores, right_cores, bond_dims = svd_flex(tensor, svd_string,
+                                             max_D, cutoff, sv_vec=sv_vecs,
+                                             svd_backend=svd_backend,
+                                             oversample=oversample)
+        tensor = torch.stack([left_cores, right_cores], dim=1)
+        tensor = tensor.reshape([2 * num_cores] + list(tensor.shape[2:]))
+
+        bond_list, sv_list = [-1], [-1]
+        for bond_dim, sv_vec in zip(bond_dims.tolist(), sv_vecs):
             bond_list += [bond_dim, -1]
             sv_list += [sv_vec, -1]
 
-        # Collate the split cores into one tensor and return as an InputRegion
-        tensor = torch.stack(core_list)
         return [InputRegion(tensor)], bond_list, sv_list
 
+    def unmerge_state(self, state, new_cores):
+        """
+        Split a tensor shaped like our cores in the same way as unmerge did
+
+        Args:
+            state (Tensor):     Tensor with the same shape as our cores, such
+                                as a change in them
+            new_cores (list):   The unmerged modules returned by unmerge
+
+        Returns:
+            new_states (list):  Modules like new_cores holding the change in
+                                the unmerged cores when our cores change by
+                                state, with the left cores (our singular
+                                vectors) held fixed
+        """
+        tensor = new_cores[0].tensor
+        left_cores = tensor[0::2]
+        right_states = torch.einsum('slui,slrij->surj', [left_cores, state])
+        new_state = torch.stack([torch.zeros_like(left_cores), right_states],
+                                dim=1)
+        return [InputRegion(new_state.reshape(tensor.shape))]
+
     def get_norm(self):
         """
         Returns list of the norm of each core in MergedInput
@@ -789,22 +2193,70 @@ class InputSite(nn.Module):
         # Register our tensor as a Pytorch Parameter
         self.tensor = nn.Parameter(tensor.contiguous())
 
-    def forward(self, input_data):
+    def forward(self, input_data, affine=None, levels=None):
         """
         Contract input with MPS core and return result as a SingleMat
 
         Args:
             input_data (Tensor): Input with shape [batch_size, feature_dim]
         """
+        return SingleMat(self.get_mats(input_data, affine,
+                                       levels).squeeze(1))
+
+    def get_mats(self, input_data, affine=None, levels=None, workspace=None):
+        """
+        Contract input with MPS core and return the resultant matrix
+
+        Args:
+            input_data (Tensor): Input with shape [batch_size, feature_dim]
+            affine (tuple):      Coefficients (a, c) of an affine feature map,
+                                 x -> a + x*c, in which case input_data is
+                                 unembedded and has no feature_dim index
+            levels (Tensor):     Embedded input levels, in which case
+                                 input_data holds the level of each input
+            workspace (Workspace): Arena holding a reusable buffer for our
+                                 output when gradients aren't needed
+
+        Returns:
+            mats (Tensor):       Matrix with shape [batch_size, 1, D_l, D_r]
+        """
+        # For quantized input, gather the matrix for each input level
+        if levels is not None:
+            assert len(input_data.shape) == 1
+            table = level_table(self, levels)
+            out = mats_buffer(workspace, [input_data.size(0)] +
+                              list(table.shape[1:]), table.dtype,
+                              table.device)
+            mat = torch.index_select(table, 0, input_data, out=out)
+            return mat.unsqueeze(1)
+
+        # For affine feature maps, add input-weighted delta to base matrix
+        if affine is not None:
+            assert len(input_data.shape) == 1
+            base, delta = affine_parts(self, affine, input_data.dtype)
+            out = mats_buffer(workspace, [input_data.size(0)] +
+                              list(base.shape), base.dtype, base.device)
+            mat = torch.addcmul(base, input_data[:, None, None], delta,
+                                out=out)
+            return mat.unsqueeze(1)
+
         # Check that input_data has the correct shape
-        tensor = self.tensor
+        tensor = self.tensor.to(input_data.dtype)
         assert len(input_data.shape) == 2
         assert input_data.size(1) == tensor.size(2)
 
         # Contract the input with our core tensor
-        mat = torch.einsum('lri,bi->blr', [tensor, input_data])
+        D_l, D_r, feature_dim = tensor.shape
+        out = mats_buffer(workspace, [input_data.size(0), D_l, D_r],
+                          tensor.dtype, tensor.device)
+        if out is None:
+            mat = torch.einsum('lri,bi->blr', [tensor, input_data])
+        else:
+            tensor = tensor.permute(2, 0, 1).reshape([feature_dim, D_l * D_r])
+            mat = torch.mm(input_data, tensor,
+                           out=out.view([-1, D_l * D_r])).view(out.shape)
 
-        return SingleMat(mat)
+        return mat.unsqueeze(1)
 
     def get_norm(self):
         """
@@ -838,11 +2290,22 @@ class OutputSite(nn.Module):
         # Register our tensor as a Pytorch Parameter
         self.tensor = nn.Parameter(tensor.contiguous())
 
-    def forward(self, input_data):
+    def forward(self, input_data, affine=None, levels=None):
         """
         Return the OutputSite wrapped as an OutputCore contractable
+
+        Since our core has no batch index, it is expanded to match the batch
+        size of input_data, which has shape [batch_size, 0, feature_dim]
+        """
+        return OutputCore(self.get_core(input_data, affine, levels),
+                          batch_size=input_data.size(0))
+
+    def get_core(self, input_data, affine=None, levels=None):
+        """
+        Return our core tensor, which has shape [output_dim, D_l, D_r]
         """
-        return OutputCore(self.tensor)
+        return self.tensor.to(input_data.dtype if levels is None
+                              else levels.dtype)
 
     def get_norm(self):
         """
@@ -889,24 +2352,52 @@ class MergedOutput(nn.Module):
         self.tensor = nn.Parameter(tensor.contiguous())
         self.left_output = left_output
 
-    def forward(self, input_data):
+    def forward(self, input_data, affine=None, levels=None):
         """
         Contract input with input index of core and return an OutputCore
 
         Args:
             input_data (Tensor): Input with shape [batch_size, feature_dim]
         """
+        return OutputCore(self.get_core(input_data, affine, levels))
+
+    def get_core(self, input_data, affine=None, levels=None):
+        """
+        Contract input with input index of core and return resultant tensor
+
+        Args:
+            input_data (Tensor): Input with shape [batch_size, feature_dim]
+            affine (tuple):      Coefficients (a, c) of an affine feature map,
+                                 x -> a + x*c, in which case input_data is
+                                 unembedded and has no feature_dim index
+            levels (Tensor):     Embedded input levels, in which case
+                                 input_data holds the level of each input
+
+        Returns:
+            core (Tensor):       Tensor with shape [batch_size, output_dim,
+                                                    D_l, D_r]
+        """
+        # For quantized input, gather the core for each input level
+        if levels is not None:
+            assert len(input_data.shape) == 1
+            return torch.index_select(level_table(self, levels), 0,
+                                      input_data)
+
+        # For affine feature maps, add input-weighted delta to base core
+        if affine is not None:
+            assert len(input_data.shape) == 1
+            base, delta = affine_parts(self, affine, input_data.dtype)
+            return torch.addcmul(base, input_data[:, None, None, None], delta)
+
         # Check that input_data has the correct shape
-        tensor = self.tensor
+        tensor = self.tensor.to(input_data.dtype)
         assert len(input_data.shape) == 2
         assert input_data.size(1) == tensor.size(3)
 
         # Contract the input with our core tensor
-        tensor = torch.einsum('olri,bi->bolr', [tensor, input_data])
+        return torch.einsum('olri,bi->bolr', [tensor, input_data])
 
-        return OutputCore(tensor)
-
-    def unmerge(self, cutoff=1e-10):
+    def unmerge(self, cutoff=1e-10, svd_backend='full', oversample=10):
         """
         Split our MergedOutput into an OutputSite and an InputSite
 
@@ -923,7 +2414,9 @@ class MergedOutput(nn.Module):
             sv_vec = torch.empty(max_D)
 
             output_core, input_core, bond_dim = svd_flex(tensor, svd_string,
-                                                max_D, cutoff, sv_vec=sv_vec)
+                                                max_D, cutoff, sv_vec=sv_vec,
+                                                svd_backend=svd_backend,
+                                                oversample=oversample)
             return ([OutputSite(output_core), InputSite(input_core)],
                     [-1, bond_dim, -1], [-1, sv_vec, -1])
 
@@ -933,10 +2426,39 @@ class MergedOutput(nn.Module):
             sv_vec = torch.empty(max_D)
 
             output_core, input_core, bond_dim = svd_flex(tensor, svd_string,
-                                                max_D, cutoff, sv_vec=sv_vec)
+                                                max_D, cutoff, sv_vec=sv_vec,
+                                                svd_backend=svd_backend,
+                                                oversample=oversample)
             return ([InputSite(input_core), OutputSite(output_core)],
                     [-1, bond_dim, -1], [-1, sv_vec, -1])
 
+    def unmerge_state(self, state, new_cores):
+        """
+        Split a tensor shaped like our core in the same way as unmerge did
+
+        Args:
+            state (Tensor):     Tensor with the same shape as our core, such
+                                as a change in it
+            new_cores (list):   The unmerged modules returned by unmerge
+
+        Returns:
+            new_states (list):  Modules like new_cores holding the change in
+                                the unmerged cores when our core changes by
+                                state, with the output core (our singular
+                                vectors) held fixed
+        """
+        if self.left_output:
+            output_core = new_cores[0].tensor
+            input_state = torch.einsum('olu,olri->uri', [output_core, state])
+            return [OutputSite(torch.zeros_like(output_core)),
+                    InputSite(input_state)]
+
+        else:
+            output_core = new_cores[1].tensor
+            input_state = torch.einsum('our,olri->lui', [output_core, state])
+            return [InputSite(input_state),
+                    OutputSite(torch.zeros_like(output_core))]
+
     def get_norm(self):
         """
         Returns the norm of our core tensor, wrapped as a singleton list
@@ -959,3 +2481,380 @@ class MergedOutput(nn.Module):
 
     def __len__(self):
         return 1
+
+def affine_parts(module, affine, dtype):
+    """
+    Contract the cores of a module with the coefficients of an affine map
+
+    For an affine feature map x -> a + x*c, contracting a core with embedded
+    input gives base + x*delta, where base and delta are the core contracted
+    with a and c. When gradients aren't needed, these are cached until the
+    core is next modified (e.g. by an optimizer step)
+
+    Args:
+        module (Module):    Module whose tensor has its input index last
+        affine (tuple):     Pair of vectors (a, c) with length feature_dim
+        dtype (dtype):      The dtype of our output
+
+    Returns:
+        base (Tensor),
+        delta (Tensor):     Contracted cores, whose shapes are that of
+                            module.tensor without its final index
+    """
+    coeff_key = (tuple(affine[0].tolist()), tuple(affine[1].tolist()))
+    base, delta = contract_features(module, torch.stack(affine), dtype,
+                                    'affine_cache', coeff_key)
+    return base, delta
+
+def level_table(module, levels):
+    """
+    Contract the cores of a module with the embedded value of each input level
+
+    This gives a lookup table holding the matrices (or output cores) of each
+    core for every possible input, which for categorical input with one-hot
+    levels are just slices of the cores. When gradients aren't needed, the
+    table is cached until the core is next modified, and otherwise gradients
+    flow back to the cores through the lookups, which scatter-add them
+
+    Args:
+        module (Module):    Module whose tensor has its input index last
+        levels (Tensor):    Embedded input levels, with shape [num_levels,
+                            feature_dim]
+
+    Returns:
+        table (Tensor):     Contiguous tensor with shape [num_levels] +
+                            the shape of module.tensor without its final
+                            index
+    """
+    # Our cache holds onto levels, so that its id can't be reused
+    level_key = (id(levels), levels._version)
+    return contract_features(module, levels, levels.dtype, 'level_cache',
+                             level_key)
+
+def default_jumps(module, default_embedding):
+    """
+    Build a jump table for the default matrices of an InputRegion
+
+    The table is cached until either the cores of module are modified, or
+    a different default_embedding is given
+
+    Args:
+        module (Module):            An InputRegion
+        default_embedding (Tensor): Embedded default input, with shape
+                                    [feature_dim]
+
+    Returns:
+        jumps (Tensor):             Products of the default matrices over
+                                    ranges of sites, as given by jump_table
+    """
+    tensor = module.tensor
+    cache_key = (tensor._version, tensor.data_ptr(), tensor.shape,
+                 default_embedding.dtype, tuple(default_embedding.tolist()))
+    cache = getattr(module, 'jump_cache', None)
+    if cache is not None and cache[0] == cache_key:
+        return cache[1]
+
+    tensor = tensor.to(default_embedding.dtype)
+    jumps = jump_table(torch.einsum('slri,i->slr', [tensor,
+                                                    default_embedding]))
+    module.jump_cache = (cache_key, jumps)
+    return jumps
+
+def core_view(module):
+    """
+    Returns the cores of a module as a tensor with shape [num_cores, D_l,
+    D_r, ...], where any other indices of each core come last
+    """
+    tensor = module.tensor
+    if isinstance(module, InputSite):
+        return tensor.unsqueeze(0)
+    if isinstance(module, (OutputSite, MergedOutput)):
+        return tensor.movedim(0, -1).unsqueeze(0)
+    return tensor
+
+def bond_slice(module, left_dim, right_dim):
+    """
+    Returns an index into the tensor of a module, which picks out the leading
+    left_dim x right_dim block of each of its core matrices
+    """
+    # InputSite cores start with their bond indices, while all other core
+    # modules have a leading site or output index
+    if isinstance(module, InputSite):
+        return (slice(0, left_dim), slice(0, right_dim))
+    return (slice(None), slice(0, left_dim), slice(0, right_dim))
+
+def pad_module(module, bond_dim):
+    """
+    Returns a copy of a core module with its bonds zero padded to bond_dim
+    """
+    tensor = module.tensor
+    bond_ind = 0 if isinstance(module, InputSite) else 1
+    shape = list(tensor.shape)
+    shape[bond_ind:bond_ind+2] = [bond_dim, bond_dim]
+
+    padded = tensor.new_zeros(shape)
+    padded[bond_slice(module, *tensor.shape[bond_ind:bond_ind+2])] = tensor
+    return module_like(module, padded)
+
+def cut_modules(merged_list, bonds):
+    """
+    Cut a list of merged modules down to the given bond dimensions
+
+    Cores with several sites are contracted together, so need to share a
+    single shape. The cores of such modules are split into runs of square
+    cores, which all have the same shape, while each other core is given
+    its own module
+
+    Args:
+        merged_list (list): Merged modules, such as those from merge_modules
+        bonds (list):       The dimension of the bond to the left of each
+                            core in merged_list, followed by that of the bond
+                            to the right of the last one
+
+    Returns:
+        merged_list (list): Merged modules holding the leading block of each
+                            of our cores
+    """
+    new_list, core_num = [], 0
+    for module in merged_list:
+        tensor = module.tensor
+        if not isinstance(module, (InputRegion, MergedInput)):
+            block = bond_slice(module, bonds[core_num], bonds[core_num+1])
+            new_list.append(module_like(module, tensor[block]))
+            core_num += 1
+            continue
+
+        cut_bonds = bonds[core_num:core_num+len(tensor)+1]
+        start = 0
+        while start < len(tensor):
+            stop = start + 1
+            while stop < len(tensor) and \
+                  cut_bonds[start] == cut_bonds[stop] == cut_bonds[stop+1]:
+                stop += 1
+            block = (slice(start, stop), slice(0, cut_bonds[start]),
+                     slice(0, cut_bonds[stop]))
+            new_list.append(module_like(module, tensor[block]))
+            start = stop
+        core_num += len(tensor)
+
+    assert core_num == len(bonds) - 1
+    return new_list
+
+def pad_flat(flat, modules, bond_dim):
+    """
+    Pad a flat tensor laid out like the tensors of several modules, in the
+    same way that pad_module pads each of their tensors
+    """
+    return torch.cat([pad_module(module_like(module, part),
+                                 bond_dim).tensor.reshape(-1)
+                      for module, part in zip(modules,
+                                              split_flat(flat, modules))])
+
+def cut_flat(flat, modules, bonds):
+    """
+    Cut a flat tensor laid out like the tensors of several modules, in the
+    same way that cut_modules cuts the modules
+    """
+    parts = [module_like(module, part) for module, part in
+             zip(modules, split_flat(flat, modules))]
+    return torch.cat([module.tensor.reshape(-1) for module in
+                      cut_modules(parts, bonds)])
+
+def bond_extents(module, right):
+    """
+    Returns one more than the last index of a bond where each core in a
+    module is nonzero, or 1 if the core is zero
+
+    Args:
+        module (Module):    Core module, whose tensor may be zero padded
+        right (bool):       Whether to look at the right bond of each core,
+                            rather than the left one
+    """
+    tensor = core_view(module)
+    bond_ind = 2 if right else 1
+    other_inds = [i for i in range(1, tensor.dim()) if i != bond_ind]
+    nonzero = torch.amax(tensor.abs(), dim=other_inds) > 0
+    inds = torch.arange(1, nonzero.size(1) + 1, device=nonzero.device)
+    return torch.amax(nonzero * inds, dim=1).clamp(min=1).tolist()
+
+def module_bonds(modules):
+    """
+    Returns the dimension of the bond to the left of each core in a list of
+    modules, followed by that of the bond to the right of the last one
+    """
+    views = [core_view(module) for module in modules]
+    bonds = [views[0].size(1)]
+    for view in views:
+        bonds.extend([view.size(2)] * view.size(0))
+    return bonds
+
+def core_positions(modules):
+    """
+    Returns the position of the bond to the left of each core in a list of
+    modules, followed by that of the bond to the right of the last one
+
+    Positions are counted in unmerged cores, so that a merged core spans two
+    positions
+    """
+    positions = [0]
+    for module in modules:
+        num_cores = core_view(module).size(0)
+        step = module.core_len() // num_cores
+        positions.extend([positions[-1] + step * (i + 1)
+                          for i in range(num_cores)])
+    return positions
+
+def module_structure(module):
+    """
+    Returns the type, left_output flag (or None) and shape of a core module
+    """
+    return (type(module), getattr(module, 'left_output', None),
+            tuple(module.tensor.shape))
+
+def build_module(module_type, left_output, tensor):
+    """
+    Returns a core module of module_type holding tensor
+
+    Args:
+        module_type (type): A core module class, such as InputRegion
+        left_output (bool): The left_output flag of a MergedOutput, and
+                            otherwise ignored
+        tensor (Tensor):    Tensor with the shape expected by module_type
+    """
+    if module_type is MergedOutput:
+        return MergedOutput(tensor, left_output=left_output)
+    return module_type(tensor)
+
+def module_like(module, tensor):
+    """
+    Returns a core module of the same kind as module, which holds tensor
+    """
+    return build_module(type(module), getattr(module, 'left_output', None),
+                        tensor)
+
+def split_flat(flat, modules):
+    """
+    Split a flat tensor into views shaped like the tensors of several modules
+
+    Args:
+        flat (Tensor):      Vector whose length is the total size of the
+                            tensors of modules
+        modules (list):     Core modules, whose tensors give our shapes
+
+    Returns:
+        tensors (list):     Views of consecutive parts of flat
+    """
+    tensors, start = [], 0
+    for module in modules:
+        size = module.tensor.numel()
+        tensors.append(flat[start:start+size].view(module.tensor.shape))
+        start += size
+    assert start == flat.numel()
+    return tensors
+
+def contract_features(module, vecs, dtype, cache_name, vecs_key):
+    """
+    Contract the input index of a module's cores with several feature vectors
+
+    When gradients aren't needed, the output is cached in the attribute
+    cache_name of module, and reused until either the cores are modified or
+    the feature vectors (identified by vecs_key) change
+
+    Args:
+        module (Module):    Module whose tensor has its input index last
+        vecs (Tensor):      Feature vectors, with shape [k, feature_dim]
+        dtype (dtype):      The dtype of our output
+        cache_name (str):   Name of the attribute holding our cache
+        vecs_key (tuple):   Hashable key identifying vecs
+
+    Returns:
+        output (Tensor):    Contiguous tensor with shape [k] + the shape of
+                            module.tensor without its final index
+    """
+    tensor = module.tensor
+    cache_key = (tensor._version, tensor.data_ptr(), tensor.shape, dtype,
+                 vecs_key)
+    if not torch.is_grad_enabled():
+        cache = getattr(module, cache_name, None)
+        if cache is not None and cache[0] == cache_key:
+            return cache[1]
+
+    features = vecs.to(device=tensor.device, dtype=dtype)
+    output = torch.einsum('...i,ki->k...', [tensor.to(dtype), features])
+    output = output.contiguous()
+
+    if not torch.is_grad_enabled():
+        setattr(module, cache_name, (cache_key, output, vecs))
+    return output
+
+def embed_affine(input_data, affine):
+    """
+    Embed unembedded input using the affine feature map x -> a + x*c
+    """
+    a, c = [v.to(device=input_data.device, dtype=input_data.dtype)
+            for v in affine]
+    return torch.addcmul(a, input_data.unsqueeze(-1), c)
+
+def embed_levels(input_data, levels):
+    """
+    Embed quantized input by looking up the embedded value of each level
+    """
+    return levels.to(input_data.device)[input_data]
+
+def mats_buffer(workspace, shape, dtype, device):
+    """
+    Returns a workspace buffer for the matrices output by get_mats
+
+    When there's no workspace or gradients are needed, None is returned, so
+    that output is freshly allocated
+    """
+    if workspace is None or torch.is_grad_enabled():
+        return None
+    return workspace.get('get_mats', shape, dtype, device)
+
+# Core stores which a MergedLinearRegion has replaced with a new parameter,
+# keyed by id, along with weak references to the old store and the region
+retired_stores = {}
+
+def retire_store(core_store, region):
+    """
+    Record a core store which region has replaced with a new parameter, so
+    that adopt_store can swap it out of any optimizer still holding it
+    """
+    key = id(core_store)
+
+    def forget(store_ref):
+        if key in retired_stores and retired_stores[key][0] is store_ref:
+            del retired_stores[key]
+
+    retired_stores[key] = (weakref.ref(core_store, forget),
+                           weakref.ref(region))
+
+def adopt_store(optimizer, args, kwargs):
+    """
+    Optimizer step pre-hook which swaps retired core stores for current ones
+
+    Optimizers which weren't passed to register_optimizer are left holding
+    an old core store when a merge replaces it, which no longer gets any
+    gradients. Before such an optimizer takes a step, the old core store is
+    replaced by the current one, with the state held for it reset, and the
+    optimizer is registered for later merges
+    """
+    if not retired_stores:
+        return
+    for group in optimizer.param_groups:
+        params = group['params']
+        for i, param in enumerate(params):
+            store_ref, region_ref = retired_stores.get(id(param), (None, None))
+            region = region_ref() if store_ref is not None and \
+                                     store_ref() is param else None
+            if region is None:
+                continue
+            optimizer.state.pop(param, None)
+            params[i] = region.core_store
+            region.register_optimizer(optimizer)
+
+# Step pre-hooks for all optimizers are only available in newer versions of
+# Pytorch, without which optimizers have to be registered
+if hasattr(torch.optim.optimizer, 'register_optimizer_step_pre_hook'):
+    torch.optim.optimizer.register_optimizer_step_pre_hook(adopt_store)
@@ -29,6 +29,7 @@ mps = MPS(input_dim=28**2, output_dim=10, bond_dim=bond_dim,
 loss_fun = torch.nn.CrossEntropyLoss()
 optimizer = torch.optim.Adam(mps.parameters(), lr=learn_rate, 
                              weight_decay=l2_reg)
+mps.register_optimizer(optimizer)
 
 # Get the training and test sets
 transform = transforms.ToTensor()
@@ -2,7 +2,8 @@ import numpy as np
 import torch
 
 def svd_flex(tensor, svd_string, max_D=None, cutoff=1e-10, sv_right=True,
-             sv_vec=None):
+             sv_vec=None, cutoff_mode='absolute', svd_backend='full',
+             oversample=10):
     """
     Split an input tensor into two pieces using a SVD across some partition
 
@@ -15,7 +16,10 @@ def svd_flex(tensor, svd_string, max_D=None, cutoff=1e-10, sv_right=True,
                             right output tensors. The characters of left_str
                             and right_str form a partition of the characters in
                             init_str, but each contain one additional character
-                            representing the new bond which comes from the SVD
+                            representing the new bond which comes from the SVD.
+                            Batch characters appearing in all three strings
+                            instead label batch indices, along which many
+                            tensors are split independently, all at once
 
                             Reversing the terms in svd_string to the left and
                             right of '->' gives an ein_string which can be used
@@ -34,7 +38,31 @@ def svd_flex(tensor, svd_string, max_D=None, cutoff=1e-10, sv_right=True,
                             merges it with the left output
 
         sv_vec (Tensor):    Pytorch vector with length max_D, which is modified
-                            in place to return the vector of singular values
+                            in place to return the vector of singular values.
+                            With batch indices, this instead has shape
+                            [batch dims] + [max_D]
+
+        cutoff_mode (str):  How cutoff is interpreted. 'absolute' compares it
+                            directly with each singular value, 'relative'
+                            compares it with each singular value divided by
+                            the largest one, and 'discarded' keeps the fewest
+                            singular values for which the truncated ones
+                            have a total squared weight of at most cutoff
+                            times that of all singular values
+
+        svd_backend (str):  Either 'full', which computes every singular value
+                            with torch.linalg.svd, or 'lowrank', which only
+                            finds the leading max_D + oversample singular
+                            values using the randomized torch.svd_lowrank.
+                            The latter is much cheaper for large matrices with
+                            a small max_D, and falls back to a full SVD when
+                            max_D isn't given, when the matrix is too small
+                            to benefit, or when its singular vectors fail an
+                            accuracy check
+
+        oversample (int):   Number of extra singular values found by the
+                            'lowrank' backend, which improves the accuracy of
+                            the max_D leading ones
 
     Returns:
         left_tensor (Tensor),
@@ -45,7 +73,9 @@ def svd_flex(tensor, svd_string, max_D=None, cutoff=1e-10, sv_right=True,
                                 the cutoff in our SVD. Note that this generally
                                 won't match the dimension of left_/right_tensor
                                 at this mode, which is padded with zeros
-                                whenever max_D is specified
+                                whenever max_D is specified. With batch
+                                indices, this is a tensor of bond dimensions
+                                with the shape of those indices
     """
     def prod(int_list):
         output = 1
@@ -64,90 +94,157 @@ def svd_flex(tensor, svd_string, max_D=None, cutoff=1e-10, sv_right=True,
         assert len(set(init_str+left_str+right_str)) == len(init_str) + 1
         assert len(set(init_str))+len(set(left_str))+len(set(right_str)) == \
                len(init_str)+len(left_str)+len(right_str)
+        assert cutoff_mode in ['absolute', 'relative', 'discarded']
+        assert svd_backend in ['full', 'lowrank']
 
-        # Get the special character representing our SVD-truncated bond
-        bond_char = set(left_str).intersection(set(right_str)).pop()
-        left_part = left_str.replace(bond_char, '')
-        right_part = right_str.replace(bond_char, '')
+        # Get the special character representing our SVD-truncated bond, and
+        # any batch characters shared by all of our tensors
+        shared_chars = set(left_str).intersection(set(right_str))
+        batch_part = ''.join([c for c in init_str if c in shared_chars])
+        bond_char = (shared_chars - set(batch_part)).pop()
+        left_part = ''.join([c for c in left_str if c not in shared_chars])
+        right_part = ''.join([c for c in right_str if c not in shared_chars])
 
         # Permute our tensor into something that can be viewed as a matrix
-        ein_str = f"{init_str}->{left_part+right_part}"
+        ein_str = f"{init_str}->{batch_part+left_part+right_part}"
         tensor = torch.einsum(ein_str, [tensor]).contiguous()
 
-        left_shape = list(tensor.shape[:len(left_part)])
-        right_shape = list(tensor.shape[len(left_part):])
+        num_batch, num_left = len(batch_part), len(left_part)
+        batch_shape = list(tensor.shape[:num_batch])
+        left_shape = list(tensor.shape[num_batch:num_batch+num_left])
+        right_shape = list(tensor.shape[num_batch+num_left:])
         left_dim, right_dim = prod(left_shape), prod(right_shape)
 
-        tensor = tensor.view([left_dim, right_dim])
-
-        # Get SVD and format so that left_mat * diag(svs) * right_mat = tensor
-        left_mat, svs, right_mat = torch.svd(tensor)
-        svs, _ = torch.sort(svs, descending=True)
-        right_mat = torch.t(right_mat)
-
-        # Decrease or increase our tensor sizes in the presence of max_D
-        if max_D and len(svs) > max_D:
-            svs = svs[:max_D]
-            left_mat = left_mat[:, :max_D]
-            right_mat = right_mat[:max_D]
-        elif max_D and len(svs) < max_D:
-            copy_svs = torch.zeros([max_D])
-            copy_svs[:len(svs)] = svs
-            copy_left = torch.zeros([left_mat.size(0), max_D])
-            copy_left[:, :left_mat.size(1)] = left_mat
-            copy_right = torch.zeros([max_D, right_mat.size(1)])
-            copy_right[:right_mat.size(0)] = right_mat
-            svs, left_mat, right_mat = copy_svs, copy_left, copy_right
+        tensor = tensor.view(batch_shape + [left_dim, right_dim])
 
-        # If given as input, copy singular values into sv_vec
-        if sv_vec is not None and svs.shape == sv_vec.shape:
-            sv_vec[:] = svs
-        elif sv_vec is not None and svs.shape != sv_vec.shape:
-            raise TypeError(f"sv_vec.shape must be {list(svs.shape)}, but is "
-                            f"currently {list(sv_vec.shape)}")
+        # Get SVD so that left_mat * diag(svs) * right_mat = tensor, with
+        # singular values sorted in descending order. The low rank SVD only
+        # gives the leading singular values, and is used when it's accurate
+        svd_out = None
+        if svd_backend == 'lowrank' and max_D:
+            svd_out = lowrank_svd(tensor, max_D, oversample)
+        if svd_out is None:
+            svd_out = torch.linalg.svd(tensor, full_matrices=False)
+        left_mat, svs, right_mat = svd_out
+        num_svs = svs.size(-1)
 
         # Find the truncation point relative to our singular value cutoff
-        truncation = 0
-        for s in svs:
-            if s < cutoff:
-                break
-            truncation += 1
-        if truncation == 0:
+        if cutoff_mode == 'absolute':
+            truncation = torch.sum(svs >= cutoff, dim=-1)
+        elif cutoff_mode == 'relative':
+            truncation = torch.sum(svs >= cutoff * svs[..., :1], dim=-1)
+        else:
+            # Keep singular values until the weight of the rest is small
+            weights = svs ** 2
+            tail_weights = torch.flip(torch.cumsum(torch.flip(weights, [-1]),
+                                                   dim=-1), [-1])
+
+            # The weight of any singular values we didn't compute is that of
+            # the whole tensor, minus that of the ones we did
+            if num_svs < min(left_dim, right_dim):
+                total_weights = torch.sum(tensor ** 2, dim=(-2, -1))
+                remainder = total_weights - tail_weights[..., 0]
+                tail_weights += torch.clamp(remainder, min=0)[..., None]
+            threshold = cutoff * tail_weights[..., :1]
+            truncation = torch.sum(tail_weights > threshold, dim=-1)
+        if max_D:
+            truncation = torch.clamp(truncation, max=max_D)
+        if torch.any(truncation == 0):
             raise RuntimeError("SVD cutoff too large, attempted to truncate "
                                "tensor to bond dimension 0")
 
-        # Perform the actual truncation
-        if max_D:
-            svs[truncation:] = 0
-            left_mat[:, truncation:] = 0
-            right_mat[truncation:] = 0
-        else:
-            # If max_D wasn't given, set it to the truncation index
-            max_D = truncation
-            svs = svs[:truncation]
-            left_mat = left_mat[:, :truncation]
-            right_mat = right_mat[:truncation]
+        # Our new bond has size max_D, or otherwise the largest truncation
+        new_D = max_D if max_D else int(truncation.max())
+        kept_D = min(new_D, num_svs)
+
+        # Copy our kept singular vectors into zero-padded outputs, with the
+        # singular values merged into the appropriate matrix
+        sv_out = svs.new_zeros(batch_shape + [new_D])
+        left_out = left_mat.new_zeros(batch_shape + [left_dim, new_D])
+        right_out = right_mat.new_zeros(batch_shape + [new_D, right_dim])
+        sv_out[..., :kept_D] = svs[..., :kept_D]
+        left_out[..., :kept_D] = left_mat[..., :kept_D]
+        right_out[..., :kept_D, :] = right_mat[..., :kept_D, :]
 
-        # Merge the singular values into the appropriate matrix
+        # If given as input, copy singular values into sv_vec
+        if sv_vec is not None and sv_out.shape == sv_vec.shape:
+            sv_vec[:] = sv_out
+        elif sv_vec is not None and sv_out.shape != sv_vec.shape:
+            raise TypeError(f"sv_vec.shape must be {list(sv_out.shape)}, but "
+                            f"is currently {list(sv_vec.shape)}")
+
+        # Perform the actual truncation, zeroing everything past the cutoff
+        kept = torch.arange(new_D, device=svs.device) < truncation[..., None]
+        sv_out = sv_out * kept
         if sv_right:
-            right_mat = torch.einsum('l,lr->lr', [svs, right_mat])
+            left_out *= kept[..., None, :]
+            right_out *= sv_out[..., None]
         else:
-            left_mat = torch.einsum('lr,r->lr', [left_mat, svs])
+            left_out *= sv_out[..., None, :]
+            right_out *= kept[..., None]
 
         # Reshape the matrices to make them proper tensors
-        left_tensor = left_mat.view(left_shape+[max_D])
-        right_tensor = right_mat.view([max_D]+right_shape)
+        left_tensor = left_out.view(batch_shape+left_shape+[new_D])
+        right_tensor = right_out.view(batch_shape+[new_D]+right_shape)
 
         # Finally, permute the indices into the desired order
-        if left_str != left_part + bond_char:
-            left_tensor = torch.einsum(f"{left_part+bond_char}->{left_str}",
-                                    [left_tensor])
-        if right_str != bond_char + right_part:
-            right_tensor = torch.einsum(f"{bond_char+right_part}->{right_str}",
-                                    [right_tensor])
-
+        left_order = batch_part + left_part + bond_char
+        right_order = batch_part + bond_char + right_part
+        if left_str != left_order:
+            left_tensor = torch.einsum(f"{left_order}->{left_str}",
+                                       [left_tensor])
+        if right_str != right_order:
+            right_tensor = torch.einsum(f"{right_order}->{right_str}",
+                                        [right_tensor])
+
+        if len(batch_shape) == 0:
+            truncation = int(truncation)
         return left_tensor, right_tensor, truncation
 
+def lowrank_svd(tensor, rank, oversample=10, niter=2):
+    """
+    Find the leading singular values and vectors of a batch of matrices
+
+    This uses the randomized range finder of torch.svd_lowrank, and checks
+    the accuracy of the leading rank singular vectors. None is returned when
+    the matrices are too small for a low rank SVD to be cheaper, or when the
+    check fails, in which case a full SVD should be used instead
+
+    Args:
+        tensor (Tensor):    Matrices with shape [batch dims] + [m, n]
+        rank (int):         Number of singular values needed
+        oversample (int):   Number of extra singular values found, which
+                            improves the accuracy of the leading rank ones.
+                            The size of our sketch is capped at min(m, n)
+        niter (int):        Number of power iterations used to find the range
+                            of each matrix
+
+    Returns:
+        left_mat (Tensor),
+        svs (Tensor),
+        right_mat (Tensor): Singular vectors and values, in the same format as
+                            the output of torch.linalg.svd, including the
+                            extra oversampled ones
+    """
+    min_dim = min(tensor.shape[-2:])
+    if 2 * rank > min_dim:
+        return None
+
+    q = min(rank + oversample, min_dim)
+    left_mat, svs, right_mat = torch.svd_lowrank(tensor, q=q, niter=niter)
+
+    # Each kept singular triplet should satisfy tensor @ v = s * u, up to an
+    # error which is small relative to the largest singular value. The
+    # oversampled triplets only serve to improve these, so aren't checked
+    kept_left, kept_svs = left_mat[..., :rank], svs[..., :rank]
+    residual = tensor @ right_mat[..., :rank] - \
+               kept_left * kept_svs[..., None, :]
+    tolerance = torch.finfo(tensor.dtype).eps ** 0.5 * svs[..., :1]
+    if torch.any(torch.linalg.norm(residual, dim=-2) > tolerance):
+        return None
+
+    return left_mat, svs, right_mat.transpose(-2, -1)
+
 def init_tensor(shape, bond_str, init_method):
     """
     Initialize a tensor with a given shape
@@ -0,0 +1,73 @@
+import threading
+import torch
+
+class Workspace:
+    """
+    Arena of reusable buffers for the intermediate tensors of a forward pass
+
+    Buffers are looked up by a name along with their dtype and device, and
+    each name holds a single flat buffer, which is grown whenever a larger
+    shape is requested and otherwise sliced to the requested shape. Repeated
+    calls then reuse the same memory, so that steady-state evaluation makes
+    (almost) no allocations, and calls with many different batch sizes don't
+    keep around more than one buffer per name. Each thread gets its own set
+    of buffers, so a single model can be evaluated from several threads at
+    once
+
+    Since buffers get overwritten by later calls, they should only be used
+    when gradients aren't needed, and never for tensors that outlive a call
+    """
+    def __init__(self):
+        self.local = threading.local()
+
+    def get(self, name, shape, dtype, device):
+        """
+        Returns an uninitialized buffer with a given name and shape
+
+        Buffers with the same name share memory, so a buffer should only be
+        requested again once the last one with that name is no longer needed
+        """
+        buffers = self.buffers()
+        key = (name, dtype, device)
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        if key not in buffers or buffers[key].numel() < numel:
+            buffers[key] = torch.empty(numel, dtype=dtype, device=device)
+        return buffers[key][:numel].view(shape)
+
+    def onehot(self, dim, dtype, device):
+        """
+        Returns a constant vector of size dim whose first entry is 1
+
+        Unlike other buffers, this is never overwritten, and can also be used
+        when gradients are needed
+        """
+        buffers = self.buffers()
+        key = ('onehot', dim, dtype, device)
+        if key not in buffers:
+            vec = torch.zeros(dim, dtype=dtype, device=device)
+            vec[0] = 1
+            buffers[key] = vec
+        return buffers[key]
+
+    def buffers(self):
+        """
+        Returns the dictionary of buffers belonging to the current thread
+        """
+        if not hasattr(self.local, 'buffers'):
+            self.local.buffers = {}
+        return self.local.buffers
+
+    def clear(self):
+        """
+        Free all buffers belonging to the current thread
+        """
+        self.local.buffers = {}
+
+    def __len__(self):
+        return len(self.buffers())
+
+    def __reduce__(self):
+        # Buffers aren't worth copying or pickling, so start out empty
+        return (Workspace, ())